@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import glob
+import json
+import shutil
+import logging
+import argparse
+import datetime
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from instrumentation import setup_logging, stage, summary_table
+from synthetic_data import (START_DATE, FakeResponse, write_purple_archive, write_doee_export,
+                            write_isd_wind)
+from get_purply import save_output, save_output_days
+from correct_purple_pm25 import CorrectPurpleAir
+from purple_storage import convert_csv_archive
+from run_correct_purple import save_hour_csv, save_day_csv
+from create_windrose import get_windy_withit
+from wind_cube import WindCube
+
+
+log = logging.getLogger(__name__)
+
+## Scale name -> (sensors, days), from one sensor day to 20 sensor years
+SCALES = {'sensor_day':(1, 1), 'sensor_week':(1, 7), 'sensor_month':(1, 30), 'sensor_year':(1, 365),
+          'network_year':(5, 365), 'network_4year':(5, 1461)}
+
+## Bump when the generators change so cached synthetic data are rebuilt
+GENERATOR_VERSION = 1
+
+## Days of one sensor pushed through save_output, it writes a file per call
+SAVE_OUTPUT_DAYS = 7
+
+HISTORY_FN = 'benchmark_history.jsonl'
+
+
+def generate_inputs(data_dir, n_sensors, days, seed=0, start_date=START_DATE):
+    ''' Write the synthetic PurpleAir archive, DOEE export and ISD wind files for one scale
+            Existing data are reused when they were made with the same parameters
+    '''
+
+    params = {'version':GENERATOR_VERSION, 'n_sensors':n_sensors, 'days':days, 'seed':seed,
+              'start_date':start_date}
+    marker_fn = os.path.join(data_dir, 'synthetic.json')
+
+    sensor_ids = [900001+i for i in range(n_sensors)]
+    first_year = pd.Timestamp(start_date).year
+    last_year = (pd.Timestamp(start_date)+pd.DateOffset(days=days-1)).year
+    inputs = {'raw':os.path.join(data_dir, 'raw'), 'sensors':sensor_ids,
+              'doee_fn':os.path.join(data_dir, 'doee_nearroad.csv'),
+              'isd_files':[os.path.join(data_dir, 'isd', f'dca_asos_{year}.csv')
+                           for year in range(first_year, last_year+1)]}
+
+    if os.path.exists(marker_fn):
+        with open(marker_fn) as f:
+            if json.load(f) == params:
+                log.info(f'Reusing synthetic data in {data_dir}')
+                return inputs
+
+    log.info(f'Generating {n_sensors} sensors x {days} days of synthetic data in {data_dir}')
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.makedirs(data_dir)
+
+    true_hourly = write_purple_archive(inputs['raw'], sensor_ids, start_date, days, seed)
+    write_doee_export(inputs['doee_fn'], true_hourly, seed)
+    write_isd_wind(os.path.join(data_dir, 'isd'), range(first_year, last_year+1), seed)
+
+    ## Written last, an interrupted generation is redone
+    with open(marker_fn, 'w') as f:
+        json.dump(params, f)
+
+    return inputs
+
+
+def raw_files(inputs, sensor_id):
+    ''' Daily CSVs of one synthetic sensor, in date order
+    '''
+
+    return sorted(glob.glob(os.path.join(inputs['raw'], str(sensor_id), 'raw_data', '*.csv')))
+
+
+def bench_save_output(inputs, out_dir):
+    ''' save_output on API style responses, rows out of order, a day per call
+    '''
+
+    sensor_id = inputs['sensors'][0]
+    for file in raw_files(inputs, sensor_id)[:SAVE_OUTPUT_DAYS]:
+        purple_df = pd.read_csv(file)
+        data_date = datetime.datetime.strptime(file[-14:-4], '%Y-%m-%d')
+        response = FakeResponse(purple_df.iloc[::-1])
+        with stage('save_output', rows_in=len(purple_df)):
+            save_output(response, sensor_id, data_date, out_dir)
+
+
+def bench_save_output_days(inputs, out_dir):
+    ''' save_output_days splitting one multi-day window into daily CSVs
+    '''
+
+    sensor_id = inputs['sensors'][0]
+    files = raw_files(inputs, sensor_id)[:SAVE_OUTPUT_DAYS]
+
+    purple_df = pd.concat([pd.read_csv(file) for file in files], ignore_index=True)
+    starttime = datetime.datetime.strptime(files[0][-14:-4], '%Y-%m-%d')
+    save_output_days(purple_df, sensor_id, starttime, starttime+datetime.timedelta(days=len(files)), out_dir)
+
+
+def bench_correction(inputs, sensor_id, out_dir, tz='et'):
+    ''' Batch and streamed correction of one sensor, and the hourly and daily CSV writes
+            Returns the corrected hourly means in UTC for the colocation stages
+    '''
+
+    files = raw_files(inputs, sensor_id)
+
+    pa = CorrectPurpleAir(files)
+    pa.load_data()
+    pa.remove_pm25_outliers()
+    pa.calculate_mean(f'datetime_{tz}')
+    pa.apply_correction_models()
+
+    os.makedirs(os.path.join(out_dir, f'hour_{tz}'), exist_ok=True)
+    save_hour_csv(pa, os.path.join(out_dir, f'hour_{tz}'), sensor_id)
+    save_day_csv(pa, os.path.join(out_dir, f'{sensor_id}_daily_mean_{tz}.csv'), tz)
+
+    CorrectPurpleAir(files).stream_mean(f'datetime_{tz}')
+
+    ## Hour bins line up in both time zones
+    hour_utc = pa.avg_data_hour.copy()
+    hour_utc.index = hour_utc.index.tz_convert('UTC').tz_localize(None)
+    hour_utc.index.name = 'datetime_utc'
+
+    return hour_utc
+
+
+def bench_parquet(inputs, sensor_id, root):
+    ''' CSV archive conversion into the Parquet store and the projected Parquet load
+    '''
+
+    in_path = os.path.join(inputs['raw'], str(sensor_id), 'raw_data')
+    with stage('convert_csv_archive'):
+        convert_csv_archive(in_path, root, sensor_id)
+
+    pa = CorrectPurpleAir([])
+    pa.load_parquet(root, sensor_id)
+
+
+def bench_colocation(inputs, hour_utc, out_dir):
+    ''' DOEE load, PurpleAir hourly load, merge and regression against the near road monitor
+            Skipped with a warning where colocation_analysis can't be imported (its plotting module)
+    '''
+
+    try:
+        from colocation_analysis import AnalyzeColocation
+    except ImportError as err:
+        log.warning(f'Skipping colocation stages, colocation_analysis could not be imported ({err})')
+        return
+
+    ## The hourly files colocation reads carry the corrected PM2.5 as pm2.5_ab_corrected
+    hour_dir = os.path.join(out_dir, 'hour_utc_colocation')
+    os.makedirs(hour_dir, exist_ok=True)
+    hour_df = hour_utc.rename(columns={'pm2.5_ab_epa_corr':'pm2.5_ab_corrected'})
+    for day, day_df in hour_df.groupby(pd.Grouper(freq='D')):
+        day_df.to_csv(os.path.join(hour_dir, f'{day.date()}.csv'))
+
+    colocation = AnalyzeColocation(inputs['doee_fn'], hour_dir)
+    colocation.load_doee_data()
+    colocation.load_purple_data(0)
+    colocation.combine_pm_data()
+    colocation.get_linear_model()
+
+
+def bench_wind(inputs):
+    ''' ISD wind parsing and the wind rose cube
+    '''
+
+    with stage('get_windy_withit') as record:
+        tme, windd, winds = get_windy_withit(inputs['isd_files'])
+        record['rows_out'] = len(tme)
+
+    with stage('WindCube.from_records', rows_in=len(tme)):
+        WindCube.from_records(tme, windd, winds)
+
+
+def git_commit():
+    ''' Commit of this checkout and whether tracked files have local changes, None outside git
+    '''
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, len(status) != 0
+
+
+def stage_results(records):
+    ''' Per stage summary of one run's records as a JSON friendly dictionary
+    '''
+
+    summary = summary_table(records)
+    if 'py_peak_mb' in records:
+        summary['py_peak_mb'] = records.groupby('stage')['py_peak_mb'].max()
+
+    summary = summary.astype(float).replace({np.nan:None})
+
+    return {name:row.to_dict() for name, row in summary.iterrows()}
+
+
+def run_benchmark(scale, work_dir, history_fn=HISTORY_FN, trace_memory=False, seed=0):
+    ''' Generate (or reuse) the synthetic inputs for a scale, run every benchmarked stage and
+            append the per stage timings and memory to the JSON lines history
+    '''
+
+    n_sensors, days = SCALES[scale]
+    inputs = generate_inputs(os.path.join(work_dir, f'{scale}_data'), n_sensors, days, seed)
+
+    out_dir = os.path.join(work_dir, f'{scale}_output')
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(os.path.join(out_dir, 'save_output'))
+    os.makedirs(os.path.join(out_dir, 'save_output_days'))
+
+    run_id = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    instrumentation.enable(trace_memory=trace_memory, run=run_id, scale=scale)
+
+    ## A failing stage is recorded and the rest still run
+    failures = {}
+    steps = [('save_output', bench_save_output, (inputs, os.path.join(out_dir, 'save_output'))),
+             ('save_output_days', bench_save_output_days, (inputs, os.path.join(out_dir, 'save_output_days'))),
+             ('wind', bench_wind, (inputs,))]
+    for sensor_id in inputs['sensors']:
+        steps.append((f'correction {sensor_id}', bench_correction,
+                      (inputs, sensor_id, os.path.join(out_dir, str(sensor_id)))))
+        steps.append((f'parquet {sensor_id}', bench_parquet, (inputs, sensor_id, os.path.join(out_dir, 'store'))))
+
+    hour_utc = None
+    with stage('benchmark'):
+        for name, func, args in steps:
+            log.info(f'Running {name}')
+            try:
+                result = func(*args)
+            except Exception as err:
+                log.exception(f'{name} failed')
+                failures[name] = f'{type(err).__name__}: {err}'
+                continue
+            if hour_utc is None and func is bench_correction:
+                hour_utc = result
+
+        if hour_utc is not None:
+            try:
+                bench_colocation(inputs, hour_utc, out_dir)
+            except Exception as err:
+                log.exception('colocation failed')
+                failures['colocation'] = f'{type(err).__name__}: {err}'
+    instrumentation.disable()
+
+    records = pd.DataFrame([record for record in instrumentation.RECORDS if record.get('run') == run_id])
+    commit, dirty = git_commit()
+    result = {'run':run_id, 'commit':commit, 'dirty':dirty, 'scale':scale, 'n_sensors':n_sensors, 'days':days,
+              'seed':seed, 'trace_memory':trace_memory, 'python':platform.python_version(),
+              'numpy':np.__version__, 'pandas':pd.__version__, 'platform':platform.platform(),
+              'failures':failures, 'stages':stage_results(records)}
+
+    with open(history_fn, 'a') as f:
+        f.write(json.dumps(result)+'\n')
+
+    return result
+
+
+def load_history(history_fn=HISTORY_FN, scale=None):
+    ''' Benchmark runs from the history, oldest first, optionally for one scale
+    '''
+
+    with open(history_fn) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+
+    return [run for run in runs if scale is None or run['scale'] == scale]
+
+
+def find_run(runs, ref):
+    ''' Latest run whose run id or commit starts with ref
+    '''
+
+    matches = [run for run in runs if run['run'].startswith(ref) or (run['commit'] or '').startswith(ref)]
+    if len(matches) == 0:
+        raise ValueError(f'No benchmark run matches {ref}')
+
+    return matches[-1]
+
+
+def compare_runs(history_fn, scale, base=None, new=None):
+    ''' Wall time and peak memory per stage of two runs at one scale, with the new / base ratio
+            base and new are run ids or commits (prefixes work), by default the last two runs
+    '''
+
+    runs = load_history(history_fn, scale)
+    if len(runs) < 2 and (base is None or new is None):
+        raise ValueError(f'Need two {scale} runs in {history_fn} to compare')
+
+    base_run = runs[-2] if base is None else find_run(runs, base)
+    new_run = runs[-1] if new is None else find_run(runs, new)
+
+    columns = {}
+    for label, run in [('base', base_run), ('new', new_run)]:
+        stages = pd.DataFrame(run['stages']).T
+        columns[f'{label}_wall_s'] = stages['wall_s']
+        ## Runs from before the per stage peak have the process lifetime peak_rss_mb
+        columns[f'{label}_peak_rss_mb'] = stages['stage_peak_rss_mb' if 'stage_peak_rss_mb' in stages else 'peak_rss_mb']
+
+    comparison = pd.DataFrame(columns).astype(float)
+    comparison['ratio'] = comparison['new_wall_s']/comparison['base_wall_s']
+    comparison.attrs = {'base':base_run['commit'] or base_run['run'], 'new':new_run['commit'] or new_run['run']}
+
+    return comparison.sort_values(by='ratio', ascending=False)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Time and memory profile the pipeline on synthetic data')
+    parser.add_argument('--scale', default='sensor_month', choices=list(SCALES))
+    parser.add_argument('--work-dir', default='benchmark_data', help='synthetic data and output folder')
+    parser.add_argument('--history', default=HISTORY_FN, help='JSON lines file the results are appended to')
+    parser.add_argument('--trace-memory', action='store_true', help='add tracemalloc peaks (slower)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', nargs='*', default=None, metavar='RUN',
+                        help='compare two runs (run ids or commits, default the last two) instead of running')
+    parser.add_argument('--threshold', type=float, default=1.2, help='wall time ratio reported as a regression')
+    args = parser.parse_args()
+
+    setup_logging(fmt='%(message)s')
+
+    if args.compare is None:
+        result = run_benchmark(args.scale, args.work_dir, args.history, args.trace_memory, args.seed)
+        print(pd.DataFrame(result['stages']).T.sort_values(by='wall_s', ascending=False).to_string())
+        for name, err in result['failures'].items():
+            log.error(f'{name} failed: {err}')
+        sys.exit(len(result['failures']) != 0)
+
+    comparison = compare_runs(args.history, args.scale, *args.compare[:2])
+    print(f"{comparison.attrs['base']} -> {comparison.attrs['new']}")
+    print(comparison.to_string())
+    regressions = comparison[comparison['ratio'] > args.threshold]
+    for name, row in regressions.iterrows():
+        log.warning(f"{name} is {row['ratio']:.2f}x slower")
+    sys.exit(len(regressions) != 0)
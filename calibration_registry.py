@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import datetime
+import numpy as np
+import pandas as pd
+
+
+REGISTRY_COLUMNS = ['sensor_id', 'valid_from', 'valid_to', 'slope', 'intercept', 'version', 'source', 'created']
+
+## Stand ins for open ended validity intervals
+MIN_TIME = np.iinfo(np.int64).min
+MAX_TIME = np.iinfo(np.int64).max
+
+## In process cache, file name -> (mtime, CalibrationRegistry)
+_REGISTRIES = {}
+
+
+def to_utc_ns(times, fill=MIN_TIME):
+    ''' Convert timestamps to UTC nanoseconds, naive values are taken as UTC and NaT becomes fill
+            Each value is parsed on its own as ISO 8601, so date only, timed and offset strings can mix
+    '''
+
+    times = pd.to_datetime(pd.Series(times), utc=True, format='ISO8601')
+    utc_ns = times.dt.tz_localize(None).to_numpy().astype('datetime64[ns]').astype('int64')
+    utc_ns[times.isna().to_numpy()] = fill
+
+    return utc_ns
+
+
+class CalibrationRegistry():
+    ''' DOEE slope and intercept per sensor with validity intervals and versions
+            Where intervals overlap the highest version wins. The table is flattened into
+            non-overlapping segments per sensor so lookups are a single searchsorted.
+            Plain correction CSVs with only sensor_id, slope and intercept load as always valid
+    '''
+    def __init__(self, table=None):
+        self.table = pd.DataFrame(columns=REGISTRY_COLUMNS) if table is None else table
+        self.build_index()
+
+
+    @classmethod
+    def load(cls, fn):
+        ''' Read a registry CSV
+        '''
+
+        table = pd.read_csv(fn, dtype={'sensor_id':str})
+        for col in REGISTRY_COLUMNS:
+            if col not in table.columns:
+                table[col] = 1 if col == 'version' else None
+
+        return cls(table[REGISTRY_COLUMNS])
+
+
+    def save(self, fn):
+        ''' Write the registry CSV
+        '''
+
+        self.table.to_csv(f'{fn}.tmp', index=False)
+        os.replace(f'{fn}.tmp', fn)
+
+
+    def build_index(self):
+        ''' Flatten each sensor's intervals into sorted segment start, end, slope and intercept arrays
+        '''
+
+        self.index = {}
+        if len(self.table) == 0:
+            return
+
+        starts = to_utc_ns(self.table['valid_from'], MIN_TIME)
+        ends = to_utc_ns(self.table['valid_to'], MAX_TIME)
+        sensors = self.table['sensor_id'].astype(str).to_numpy()
+        versions = self.table['version'].to_numpy()
+
+        for sensor in np.unique(sensors):
+            rows = np.where(sensors == sensor)[0]
+            bounds = np.unique(np.concatenate([starts[rows], ends[rows]]))
+
+            ## Paint the elementary segments in version order so later versions overwrite
+            seg_slope = np.full(len(bounds)-1, np.nan)
+            seg_inter = np.full(len(bounds)-1, np.nan)
+            for row in rows[np.argsort(versions[rows], kind='stable')]:
+                first = np.searchsorted(bounds, starts[row])
+                last = np.searchsorted(bounds, ends[row])
+                seg_slope[first:last] = self.table['slope'].iloc[row]
+                seg_inter[first:last] = self.table['intercept'].iloc[row]
+
+            self.index[sensor] = (bounds, seg_slope, seg_inter)
+
+
+    def get_factors(self, sensor_id, times):
+        ''' Slope and intercept arrays for a sensor at each time, NaN where no factor is valid
+        '''
+
+        missing = pd.isna(pd.Series(times)).to_numpy()
+        times = to_utc_ns(times)
+        if str(sensor_id) not in self.index:
+            raise KeyError(f'No calibration for sensor {sensor_id}')
+        bounds, seg_slope, seg_inter = self.index[str(sensor_id)]
+
+        seg = np.searchsorted(bounds, times, side='right')-1
+        inside = (seg >= 0) & (seg < len(seg_slope)) & ~missing
+        seg = np.clip(seg, 0, len(seg_slope)-1)
+
+        slope = np.where(inside, seg_slope[seg], np.nan)
+        intercept = np.where(inside, seg_inter[seg], np.nan)
+
+        return slope, intercept
+
+
+    def add(self, sensor_id, slope, intercept, valid_from=None, valid_to=None, source=''):
+        ''' Add factors for a sensor as a new version, returns the version number
+        '''
+
+        return self.add_many([(sensor_id, slope, intercept, valid_from, valid_to, source)])[0]
+
+
+    def add_many(self, entries):
+        ''' Add (sensor_id, slope, intercept, valid_from, valid_to, source) entries, each a new version
+                The index is rebuilt once at the end. Returns the version numbers
+        '''
+
+        created = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        latest = self.table.groupby(self.table['sensor_id'].astype(str))['version'].max().to_dict()
+
+        rows = []
+        for sensor_id, slope, intercept, valid_from, valid_to, source in entries:
+            latest[str(sensor_id)] = int(latest.get(str(sensor_id), 0))+1
+            rows.append({'sensor_id':str(sensor_id), 'valid_from':valid_from, 'valid_to':valid_to,
+                         'slope':slope, 'intercept':intercept, 'version':latest[str(sensor_id)],
+                         'source':source, 'created':created})
+
+        new_rows = pd.DataFrame(rows, columns=REGISTRY_COLUMNS)
+        self.table = new_rows if len(self.table) == 0 else pd.concat([self.table, new_rows], ignore_index=True)
+        self.build_index()
+
+        return [row['version'] for row in rows]
+
+
+    def add_colocation(self, sensor_id, doee_pa, valid_from=None, valid_to=None):
+        ''' Add the linear model from an AnalyzeColocation after get_linear_model
+        '''
+
+        return self.add(sensor_id, doee_pa.slope, doee_pa.inter, valid_from, valid_to, source='colocation')
+
+
+    def add_windows(self, results):
+        ''' Add rolling window fits from colocation_regression.fit_colocation, one version per window
+        '''
+
+        return self.add_many([(row.sensor, row.slope, row.intercept, row.window_start, row.window_end,
+                               f'rolling lag {row.lag}') for row in results.itertuples()])
+
+
+def get_registry(fn):
+    ''' Load a registry once per process, reloading only if the file changed
+    '''
+
+    mtime = os.stat(fn).st_mtime_ns
+    cached = _REGISTRIES.get(fn)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, CalibrationRegistry.load(fn))
+        _REGISTRIES[fn] = cached
+
+    return cached[1]
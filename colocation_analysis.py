@@ -6,66 +6,78 @@ Created on Sun Jul 16 10:46:43 EDT 2023
 
 import glob
 import os
+import hashlib
 import pandas as pd
 import datetime
 import numpy as np
 from scipy import stats
 import matplotlib.pyplot as plt
 
-from plot_purple import plot_colocation
+## plot_purple is a local plotting module that isn't always around, nothing here needs it to run
+try:
+    from plot_purple import plot_colocation
+except ImportError:
+    plot_colocation = None
+from purple_storage import read_average_parquet
+from hourly_grid import HourlyTable, hourly_table
+from instrumentation import instrumented
+
+
+def doee_purple_table(doee_df, purple_dfs, value_col='pm25_ab_corrected', ref_col='PM25',
+                      doee_time='dtime', purple_time='datetime_utc', dtype=np.float32):
+    ''' HourlyTable of the DOEE reference (column ref_col) and PurpleAir sensors
+            purple_dfs is a dictionary of sensor name -> dataframe, each sensor's value_col becomes
+            a column named after the sensor
+    '''
+
+    doee_time = doee_time if doee_time in doee_df.columns else purple_time
+
+    series = {ref_col:(doee_df[doee_time], doee_df[ref_col])}
+    for sensor, df in purple_dfs.items():
+        series[sensor] = (df[purple_time], df[value_col])
+
+    return hourly_table(series, purple_time, dtype)
+
+
+def doee_on_grid(doee_df, grid, doee_time='dtime'):
+    ''' DOEE rows reindexed onto a table's grid, indexed by datetime_utc, a later duplicate hour wins
+    '''
+
+    doee_df = doee_df.rename(columns={doee_time:'datetime_utc'})
+    doee_df = doee_df.assign(datetime_utc=doee_df['datetime_utc'].dt.floor('h'))
+    doee_df = doee_df.dropna(subset=['datetime_utc']).drop_duplicates('datetime_utc', keep='last')
+
+    return doee_df.set_index('datetime_utc').reindex(grid)
+
+
+def combine_sensor_columns(doee_df, df_list, value_col):
+    ''' DOEE data with value_col of every PurpleAir dataframe as value_col_1 ... value_col_N
+            Hours where no dataset has data are left out, like an outer merge
+    '''
+
+    purple_dfs = {f'{value_col}_{i+1}':df for i, df in enumerate(df_list)}
+    table = doee_purple_table(doee_df, purple_dfs, value_col)
+
+    sensor_df = pd.DataFrame(table.values[:, 1:], index=table.grid, columns=list(purple_dfs))
+    doee_merged = pd.concat([doee_on_grid(doee_df, table.grid), sensor_df], axis=1)
+
+    return doee_merged[table.rows_with_data(how='any')].reset_index()
+
 
 def combine_dataframes(doee_df, df_list):
     ''' Function for combining PM2.5 dataframes
-            Used for initial testin
+            Used for initial testin. Takes any number of PurpleAir dataframes
     '''
-    
-    doee_df = doee_df.rename(columns={'dtime':'datetime_utc'})
-    
-    ## Merge all PurpleAir dataframes together 
-    df_orig = df_list[0][['datetime_utc', 'pm25_ab_avg']]
-    df_orig.rename(columns={'pm25_ab_avg':'pm25_ab_avg_1'}, inplace=True)
-    
-    df_merged = df_orig.merge(df_list[1][['datetime_utc','pm25_ab_avg']], on='datetime_utc', how='outer')
-    df_merged.rename(columns={'pm25_ab_avg':'pm25_ab_avg_2'}, inplace=True)
-    
-    df_merged = df_merged.merge(df_list[2][['datetime_utc','pm25_ab_avg']], on='datetime_utc', how='outer')
-    df_merged.rename(columns={'pm25_ab_avg':f'pm25_ab_avg_3'}, inplace=True)
-    
-    df_merged = df_merged.merge(df_list[3][['datetime_utc','pm25_ab_avg']], on='datetime_utc', how='outer')
-    df_merged.rename(columns={'pm25_ab_avg':f'pm25_ab_avg_4'}, inplace=True)
-    
-    ## Merge combined PurpleAir data into DOEE dataframe
-    doee_merged = doee_df.merge(df_merged[['datetime_utc','pm25_ab_avg_1', 'pm25_ab_avg_2', 'pm25_ab_avg_3', 
-                                           'pm25_ab_avg_4']], on='datetime_utc', how='outer')
-        
-    return doee_merged
+
+    return combine_sensor_columns(doee_df, df_list, 'pm25_ab_avg')
 
 
 def combine_corrected_dataframes(doee_df, df_list):
     ''' Function for combining PM2.5 dataframes using previously corrected PurpleAir
-            Data. Used for initial testing
+            Data. Used for initial testing. Takes any number of PurpleAir dataframes
     '''
-    
-    doee_df = doee_df.rename(columns={'dtime':'datetime_utc'})
-    
-    ## Merge all PurpleAir dataframes together 
-    df_orig = df_list[0][['datetime_utc', 'pm25_ab_corrected']]
-    df_orig.rename(columns={'pm25_ab_corrected':'pm25_ab_corrected_1'}, inplace=True)
-    
-    df_merged = df_orig.merge(df_list[1][['datetime_utc','pm25_ab_corrected']], on='datetime_utc', how='outer')
-    df_merged.rename(columns={'pm25_ab_corrected':'pm25_ab_corrected_2'}, inplace=True)
-    
-    df_merged = df_merged.merge(df_list[2][['datetime_utc','pm25_ab_corrected']], on='datetime_utc', how='outer')
-    df_merged.rename(columns={'pm25_ab_corrected':f'pm25_ab_corrected_3'}, inplace=True)
-    
-    df_merged = df_merged.merge(df_list[3][['datetime_utc','pm25_ab_corrected']], on='datetime_utc', how='outer')
-    df_merged.rename(columns={'pm25_ab_corrected':f'pm25_ab_corrected_4'}, inplace=True)
-    
-    ## Merge combined PurpleAir data into DOEE dataframe
-    doee_merged = doee_df.merge(df_merged[['datetime_utc','pm25_ab_corrected_1', 'pm25_ab_corrected_2', 'pm25_ab_corrected_3', 
-                                           'pm25_ab_corrected_4']], on='datetime_utc', how='outer')
-        
-    return doee_merged
+
+    return combine_sensor_columns(doee_df, df_list, 'pm25_ab_corrected')
 
 def fix_doee_time(dtime):
     ''' Function applied to the DOEE time data to properly convert them to timestamps
@@ -79,17 +91,48 @@ def fix_doee_time(dtime):
     return dtime_good
 
 
+def parse_doee_times(dtime):
+    ''' Vectorized version of fix_doee_time, parses both %m/%d/%y %H:%M and %m/%d/%y
+    '''
+    
+    dtime_good = pd.to_datetime(dtime, format='%m/%d/%y %H:%M', errors='coerce')
+    
+    ## Midnight readings are exported without a time
+    date_only = dtime_good.isna()
+    dtime_good[date_only] = pd.to_datetime(dtime[date_only], format='%m/%d/%y', errors='coerce')
+    
+    return dtime_good
+
+
+def file_hash(fn):
+    ''' SHA-256 of a file, read in blocks
+    '''
+    
+    sha = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+            
+    return sha.hexdigest()
+
+
+## Bump when load_doee_data changes so old cached files are not reused
+DOEE_CACHE_VERSION = 1
+
+
 class AnalyzeColocation():
     ''' Class for reading, storing, and manipulating the DOEE and PurpleAir PM2.5 data
             and applying a linear correction factor
     '''
-    def __init__(self, doee_fn, purple_fn):
+    def __init__(self, doee_fn, purple_fn, cache_dir=None):
         self.doee_fn   = doee_fn
         self.purple_fn = purple_fn
+        self.cache_dir = cache_dir
         self.doee_df   = None
         self.purple_df = None
     
 
+    @instrumented('load_purple_data', rows=lambda result, self, *args: len(self.purple_df))
     def load_purple_data(self, time_offset):
         ''' Function to load in PurpleAir Data
         '''
@@ -103,6 +146,24 @@ class AnalyzeColocation():
         ## Convert date column to a timestamp
         purple_df['datetime_utc'] = pd.to_datetime(purple_df['datetime_utc'])
             
+        self.purple_df = self.prepare_purple_data(purple_df, time_offset)
+        
+    @instrumented('load_purple_parquet', rows=lambda result, self, *args, **kwargs: len(self.purple_df))
+    def load_purple_parquet(self, root, sensor_index, time_offset, start=None, end=None):
+        ''' Function to load hourly UTC PurpleAir data from the Parquet store
+                self.purple_fn is not used
+        '''
+        purple_df = read_average_parquet(root, sensor_index, 'hour', 'datetime_utc', start, end)
+        purple_df = purple_df.reset_index()
+        
+        ## Drop the timezone to match the naive UTC times in the CSVs and DOEE data
+        purple_df['datetime_utc'] = purple_df['datetime_utc'].dt.tz_convert('UTC').dt.tz_localize(None)
+        
+        self.purple_df = self.prepare_purple_data(purple_df, time_offset)
+        
+    def prepare_purple_data(self, purple_df, time_offset):
+        ''' Function to rename PurpleAir columns and apply the time offset
+        '''
         ## Rename columns
         purple_df.rename(columns={'pm2.5_ab_avg':'pm25_ab_avg', 'pm2.5_cf_1_a':'pm25_cf_1_a',              
                               'pm2.5_cf_1_b':'pm25_cf_1_b', 'pm2.5_ab_corrected':'pm25_ab_corrected'}, inplace=True)
@@ -111,63 +172,81 @@ class AnalyzeColocation():
         delta = pd.Timedelta(hours=time_offset)
         purple_df['datetime_utc'] = purple_df['datetime_utc'] - delta
 
-        self.purple_df = purple_df
+        return purple_df
 
+    @instrumented('load_doee_data', rows=lambda result, self: len(self.doee_df))
     def load_doee_data(self):
         ''' Function to laod in DC DOEE CSV data
+                With a cache_dir the cleaned data are cached as Parquet keyed by the file's hash
         '''
+        
+        if self.cache_dir is not None:
+            cache_fn = os.path.join(self.cache_dir, f'doee_v{DOEE_CACHE_VERSION}_{file_hash(self.doee_fn)}.parquet')
+            if os.path.exists(cache_fn):
+                self.doee_df = pd.read_parquet(cache_fn)
+                return
 
         doee_df          = pd.read_csv(self.doee_fn)
 
         doee_df          = doee_df.rename(columns={"Unnamed: 0":"dtime"})
         doee_df          = doee_df.rename(columns={"NEARROAD PM25LC-1022 001h":"PM25"})
         doee_df          = doee_df.iloc[1:]
-        doee_df['PM25']  = doee_df['PM25'].astype(float)
+        
+        ## Everything but the time is a measurement, the units row made them strings
+        for col in doee_df.columns.drop('dtime'):
+            doee_df[col] = pd.to_numeric(doee_df[col], errors='coerce')
 
         ## Remove single outlier reading of 100000
-        doee_df          = doee_df[doee_df['PM25']<10000]
+        doee_df          = doee_df[doee_df['PM25']<10000].copy()
 
 
         ## Fix DOEE timestamp issue
-        doee_df['dtime'] = doee_df['dtime'].apply(fix_doee_time)
+        doee_df['dtime'] = parse_doee_times(doee_df['dtime'])
 
         ## Convert pressure to mb and temperature to fahrenheit
-        doee_df['NEARROAD BARPRESS 001h'] = doee_df['NEARROAD BARPRESS 001h'].astype(float)
-        doee_df['NEARROAD BARPRESS 001h'] = doee_df['NEARROAD BARPRESS 001h'].apply(lambda x: x*1.33322)
-        doee_df['NEARROAD AT_BAM25 001h'] = doee_df['NEARROAD AT_BAM25 001h'].astype(float)
-        doee_df['NEARROAD AT_BAM25 001h'] = doee_df['NEARROAD AT_BAM25 001h'].apply(lambda x: ((x*(9/5))+32))
+        doee_df['NEARROAD BARPRESS 001h'] = doee_df['NEARROAD BARPRESS 001h'].to_numpy()*1.33322
+        doee_df['NEARROAD AT_BAM25 001h'] = doee_df['NEARROAD AT_BAM25 001h'].to_numpy()*(9/5)+32
 
 
         doee_df.rename(columns={'NEARROAD BARPRESS 001h':'Baropress_001h', 'NEARROAD RELHUM 001h':'Relhum_001h', 
                         'NEARROAD AT_BAM25 001h':'Temp_001h', 'NEARROAD WSP 001h':'Wsp_001h', 'NEARROAD WDR 001h':'Wdr_001h'}, inplace=True)
 
-        doee_df.Baropress_001h.multiply(1.33322)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            doee_df.to_parquet(f'{cache_fn}.tmp')
+            os.replace(f'{cache_fn}.tmp', cache_fn)
 
         self.doee_df = doee_df
         
+    @instrumented('combine_pm_data', rows=lambda result, self: len(self.doee_purple_df))
     def combine_pm_data(self):
         ''' Function to combine DC DOEE and PurpleAir PM2.5 data
         '''
         
         self.doee_df = self.doee_df.rename(columns={'dtime':'datetime_utc'})
-        self.doee_purple_df = self.doee_df.merge(self.purple_df[['datetime_utc','pm25_ab_corrected']], on='datetime_utc', how='outer')
-    
-        ## Drop rows without data for creating linear model
-        self.doee_purple_df.dropna(subset=['PM25', 'pm25_ab_corrected'],
-                         inplace=True)
+        ## Full precision, float32 values shift the regression
+        self.table = doee_purple_table(self.doee_df, {'pm25_ab_corrected':self.purple_df}, dtype=np.float64)
+
+        ## Keep hours with both DOEE and PurpleAir data for creating linear model
+        both = self.table.rows_with_data()
+        self.doee_purple_df = doee_on_grid(self.doee_df, self.table.grid, 'datetime_utc')[both]
+        self.doee_purple_df['pm25_ab_corrected'] = self.table.column('pm25_ab_corrected')[both]
+        self.doee_purple_df = self.doee_purple_df.reset_index()
         
         ## Save DOEE and PurpleAir PM2.5 data out to lists
         self.doee_pm     = self.doee_purple_df['PM25'].to_list()
         self.purple_pm   = self.doee_purple_df['pm25_ab_corrected'].to_list()
     
 
+    @instrumented('get_linear_model')
     def get_linear_model(self, plot=False, title=None):
         ''' Function for finding the linear model between the DOEE and PurpleAir PM2.5 data
                 the function can also create a scatter plot with regression data
         '''    
         
         ## Apply a linear regression model
-        self.slope, self.inter, self.rval, self.pval, self.stderr = stats.linregress(self.doee_pm, self.purple_pm)
+        self.slope, self.inter, self.rval, self.pval, self.stderr = stats.linregress(
+            np.asarray(self.doee_pm, dtype=np.float64), np.asarray(self.purple_pm, dtype=np.float64))
         self.r_squared = round(self.rval**2,3)
 
         ## Plot correlation scatter
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+from colocation_analysis import AnalyzeColocation, doee_purple_table
+from hourly_grid import regression_from_sums
+
+
+def align_hourly(doee_df, purple_dfs, value_col='pm25_ab_corrected', ref_col='PM25',
+                 doee_time='dtime', purple_time='datetime_utc'):
+    ''' Put the DOEE reference and every PurpleAir sensor on one hourly grid
+            purple_dfs is a dictionary of sensor name -> dataframe, missing hours are NaN
+            Returns the grid, the reference array and a sensors x hours float32 matrix
+    '''
+
+    table = doee_purple_table(doee_df, purple_dfs, value_col, ref_col, doee_time, purple_time)
+
+    return table.grid, table.column(ref_col), table.values[:, 1:].T
+
+
+def lagged_cumsums(ref, purple, lags):
+    ''' Cumulative sums of n, x, y, xx, yy and xy for one sensor at every lag
+            A lag of L hours pairs the reference at hour i with PurpleAir at hour i+L, the same as
+            AnalyzeColocation.load_purple_data(L). Arrays are lags x (hours+1) with a leading 0
+    '''
+
+    n_hours = len(ref)
+    idx = np.arange(n_hours)[None, :] + np.asarray(lags)[:, None]
+    in_range = (idx >= 0) & (idx < n_hours)
+    y = np.where(in_range, purple[np.clip(idx, 0, n_hours-1)], np.nan)
+    x = np.broadcast_to(ref, y.shape)
+
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x = np.where(valid, x, 0.)
+    y = np.where(valid, y, 0.)
+
+    sums = {}
+    for name, values in [('n', valid.astype(float)), ('sx', x), ('sy', y), ('sxx', x*x), ('syy', y*y), ('sxy', x*y)]:
+        sums[name] = np.concatenate([np.zeros((len(lags), 1)), np.cumsum(values, axis=1)], axis=1)
+
+    return sums
+
+
+def fit_colocation(grid, ref, purple, sensors, lags=(0,), window_hours=None, step_hours=24, min_count=24):
+    ''' Regression of each sensor on the reference for every lag and rolling window
+            window_hours None fits the whole period, otherwise windows of window_hours ending
+            every step_hours. Each window costs O(1) from the cumulative sums.
+            Returns a dataframe with one row per sensor, lag and window
+    '''
+
+    lags = np.asarray(lags)
+    n_hours = len(grid)
+
+    if window_hours is None:
+        starts, ends = np.array([0]), np.array([n_hours])
+    else:
+        ends = np.arange(window_hours, n_hours+1, step_hours)
+        starts = ends-window_hours
+
+    ## Center on the overall means so the differenced sums keep their precision, in float64
+    ## since the aligned table is float32
+    ref = np.asarray(ref, dtype=float)
+    purple = np.asarray(purple, dtype=float)
+    x_mean = np.nanmean(ref)
+
+    results = []
+    for i, sensor in enumerate(sensors):
+        y_mean = np.nanmean(purple[i])
+        sums = lagged_cumsums(ref-x_mean, purple[i]-y_mean, lags)
+        window = {name:cum[:, ends]-cum[:, starts] for name, cum in sums.items()}
+
+        slope, intercept, r_squared, rmse = regression_from_sums(**window)
+        intercept = intercept + y_mean - slope*x_mean
+
+        results.append(pd.DataFrame({
+            'sensor':sensor,
+            'lag':np.repeat(lags, len(ends)),
+            'window_start':np.tile(grid[starts], len(lags)),
+            'window_end':np.tile(grid[ends-1]+pd.Timedelta(hours=1), len(lags)),
+            'n':window['n'].ravel().astype(int),
+            'slope':slope.ravel(), 'intercept':intercept.ravel(),
+            'r_squared':r_squared.ravel(), 'rmse':rmse.ravel()}))
+
+    results = pd.concat(results, ignore_index=True)
+
+    return results[results['n'] >= min_count].reset_index(drop=True)
+
+
+def best_lags(results):
+    ''' Lag with the highest R squared for each sensor (and window)
+    '''
+
+    best = results.loc[results.groupby(['sensor', 'window_start'])['r_squared'].idxmax()]
+
+    return best.reset_index(drop=True)
+
+
+def load_colocation_data(doee_fn, purple_dirs, cache_dir=None):
+    ''' Load the DOEE reference and hourly PurpleAir folders once with no time offset
+            purple_dirs is a dictionary of sensor name -> folder of hourly CSVs
+    '''
+
+    doee_pa = AnalyzeColocation(doee_fn, None, cache_dir=cache_dir)
+    doee_pa.load_doee_data()
+
+    purple_dfs = {}
+    for sensor, purple_dir in purple_dirs.items():
+        sensor_pa = AnalyzeColocation(doee_fn, purple_dir)
+        sensor_pa.load_purple_data(0)
+        purple_dfs[sensor] = sensor_pa.purple_df
+
+    return doee_pa.doee_df, purple_dfs
+
+
+if __name__ == '__main__':
+
+    doee_fn = '/path/to/doee/data'
+    purple_dirs = {'ECA_1':'/path/to/ECA_1/hourly', 'ECA_2':'/path/to/ECA_2/hourly'}
+
+    doee_df, purple_dfs = load_colocation_data(doee_fn, purple_dirs)
+    grid, ref, purple = align_hourly(doee_df, purple_dfs)
+
+    ## Best overall offset per sensor, then 30-day calibration drift at that offset
+    overall = fit_colocation(grid, ref, purple, list(purple_dfs), lags=range(-12, 13))
+    print(best_lags(overall))
+
+    drift = fit_colocation(grid, ref, purple, list(purple_dfs), lags=[5], window_hours=30*24)
+    print(drift)
@@ -6,149 +6,479 @@ Created on Sun Jul 29 15:22:42 2022
 @author: shaunhowe
 """
 
+import logging
 import numpy as np
 import pandas as pd
 from datetime import datetime
 
+from purple_schema import CORRECTION_COLUMNS, PURPLE_DTYPES, read_dtypes
+from purple_storage import read_purple_parquet
+from time_aggregation import base_sums, aggregate_sums, sampling_interval
+from correction_models import apply_models
+from instrumentation import stage
+
+
+log = logging.getLogger(__name__)
+
+
+## Time zone of each averaging time variable, rows stay in Unix time and only the
+## averaged output is labelled in local time
+TIME_ZONES = {'datetime_utc':'UTC', 'datetime_et':'US/Eastern'}
+
+## Columns calculate_mean averages, the rest of the raw fields are not carried into the means
+MEAN_COLUMNS = ['pm2.5_filt_a', 'pm2.5_filt_b', 'pm2.5_ab_avg', 'humidity', 'temperature',
+                'pm2.5_cf_1_a', 'pm2.5_cf_1_b']
+
+
+## QC limits, temperature in F and RH in %
+TEMPERATURE_MAX = 1000.
+HUMIDITY_MAX = 100.
+
+## Channels disagreeing by more than this many SD of the percent difference are removed
+PCT_DIFF_SD = 2
+
+## 24 hour A/B rule from Barkjohn et al 2021, a day is removed when the channels differ by
+## more than AB_DIFF_MAX µg/m³ and by more than AB_PCT_MAX relative difference
+AB_DIFF_MAX = 5.
+AB_PCT_MAX = 0.7
+
+
+class QCMask():
+    ''' One boolean keep mask built up from QC rules, with the number of rows each rule rejects
+            Rules are applied in order and a row counts against the first rule that rejects it,
+            so the counts add up to the total rejected. The data is only sliced once at the end
+    '''
+    def __init__(self, n_rows):
+        self.keep = np.ones(n_rows, dtype=bool)
+        self.counts = {}
+        
+    def apply(self, name, reject):
+        ''' Fold a rule's reject array into the mask, NaN comparisons are False so they are kept
+        '''
+        
+        reject = np.asarray(reject, dtype=bool) & self.keep
+        self.counts[name] = self.counts.get(name, 0)+int(reject.sum())
+        self.keep &= ~reject
+        
+    def summary(self):
+        ''' Rows rejected by each rule and rows kept
+        '''
+        
+        return pd.Series({**self.counts, 'kept':int(self.keep.sum())}, name='rows')
+
+
+class QCCounts():
+    ''' Per rule rejection counts summed over chunks, for streaming where no row mask is kept
+            Has the same counts and summary as QCMask
+    '''
+    def __init__(self):
+        self.counts = {}
+        self.n_rows = 0
+        self.n_kept = 0
+        
+    def add(self, qc):
+        ''' Add one chunk's QCMask
+        '''
+        
+        for name, count in qc.counts.items():
+            self.counts[name] = self.counts.get(name, 0)+count
+        self.n_rows += len(qc.keep)
+        self.n_kept += int(qc.keep.sum())
+        
+    def summary(self):
+        ''' Rows rejected by each rule and rows kept
+        '''
+        
+        return pd.Series({**self.counts, 'kept':self.n_kept}, name='rows')
+
+
+def met_qc(qc, data):
+    ''' Temperature and RH rules
+    '''
+    
+    qc.apply('temperature', data['temperature'].to_numpy() >= TEMPERATURE_MAX)
+    qc.apply('humidity', data['humidity'].to_numpy() > HUMIDITY_MAX)
+
+
+def pm25_qc(qc, data, pct_thresh, max_difference=None):
+    ''' A/B channel percent difference rule, optional absolute difference rule and missing values
+    '''
+    
+    pm25_a = data['pm2.5_cf_1_a'].to_numpy()
+    pm25_b = data['pm2.5_cf_1_b'].to_numpy()
+    
+    qc.apply('pct_difference', pct_difference(pm25_a, pm25_b) > pct_thresh)
+    if max_difference is not None:
+        qc.apply('ab_difference', np.abs(pm25_a-pm25_b) > max_difference)
+    qc.apply('missing', np.isnan(pm25_a) | np.isnan(pm25_b) | data['humidity'].isna().to_numpy())
+
+
+def ab_difference_qc(qc, pm25_a, pm25_b, max_difference=AB_DIFF_MAX, max_pct=AB_PCT_MAX):
+    ''' A/B channel rule on averages, both the absolute and relative difference have to be exceeded
+            Shared by the daily means and the live readings
+    '''
+    
+    pm25_a = np.asarray(pm25_a, dtype=float)
+    pm25_b = np.asarray(pm25_b, dtype=float)
+    
+    qc.apply('ab_difference', (np.abs(pm25_a-pm25_b) > max_difference) &
+             (pct_difference(pm25_a, pm25_b) > max_pct))
+
+
+def filter_bad_met(raw_data):
+    ''' Filter out erroneous temperature and humidity values
+    '''
+    
+    qc = QCMask(len(raw_data))
+    met_qc(qc, raw_data)
+    
+    return raw_data[qc.keep]
+
+
+def pct_difference(pm25_a, pm25_b):
+    ''' A/B channel relative difference used by Barkjohn et al 2021
+    '''
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.abs(pm25_a-pm25_b)*2)/(pm25_a+pm25_b)
+
+
+def accumulate(total, part):
+    ''' Add a chunk's per bin sums or counts into the running totals
+    '''
+    
+    return part if total is None else total.add(part, fill_value=0)
+
+
+def apply_completeness(means, counts, expected, completeness):
+    ''' Mask means built from too few samples then drop rows missing PM2.5 or RH
+    '''
+    
+    ## Create time resampling completeness mask
+    data_avail = counts.div(expected, axis=0)
+    mask = data_avail >= completeness
+    
+    ## Apply time resampling completeness mask and filter out masked data
+    means = means[mask]
+    
+    return means.dropna(subset=['pm2.5_ab_avg', 'humidity'])
+
+
+class RunningStd():
+    ''' Online population standard deviation (Welford with Chan's batch update), NaNs are ignored
+    '''
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        
+    def update(self, values):
+        ''' Fold an array of values into the running statistics
+        '''
+        
+        values = values[~np.isnan(values)]
+        n_b = len(values)
+        if n_b == 0:
+            return
+        
+        mean_b = values.mean()
+        m2_b = ((values-mean_b)**2).sum()
+        
+        n = self.n+n_b
+        delta = mean_b-self.mean
+        self.mean += delta*n_b/n
+        self.m2 += m2_b + delta**2*self.n*n_b/n
+        self.n = n
+        
+    def std(self):
+        ''' Population standard deviation, same as np.nanstd
+        '''
+        
+        return np.sqrt(self.m2/self.n) if self.n != 0 else np.nan
+
 
 class CorrectPurpleAir():
     ''' Class for correcting PurpleAir data using the Barkjohn (EPA) correction method
     '''
-    def __init__(self, fn):
+    def __init__(self, fn, mean_columns=MEAN_COLUMNS):
         self.filenames = fn
+        self.mean_columns = mean_columns
+        self.interval = None
+        
+        ## Raw columns read from the files, the correction inputs and any raw field being averaged
+        self.columns = CORRECTION_COLUMNS + [col for col in mean_columns
+                                             if col in PURPLE_DTYPES and col not in CORRECTION_COLUMNS]
+        self.dtypes = read_dtypes(self.columns)
         
 
     def load_data(self):
         ''' Load CSV data into dataframe
         '''
         
-        print('Loading in Data')
-        
-        df_all = []
+        log.info('Loading in Data')
         
-        ## loop through CSVs
-        for file in self.filenames:
+        with stage('load_data') as record:
+            df_all = []
             
-            ## Read in sensor data
-            raw_data = pd.read_csv(file)
-
-            ## Convert Unix timestamp to datetime then make timezone eastern for daily averaging
-            raw_data['datetime_utc'] = pd.to_datetime(raw_data['time_stamp'], unit='s', utc=True)
-            raw_data['datetime_et'] = raw_data['datetime_utc'].dt.tz_convert('US/Eastern')
-            
-            df_all.append(raw_data)
-
-        self.raw_data = pd.concat(df_all)
+            ## loop through CSVs
+            for file in self.filenames:
+                
+                ## Read in sensor data, only the columns used and in their compact dtypes
+                raw_data = self.read_csv(file)
+                
+                df_all.append(raw_data)
+    
+            self.raw_data = pd.concat(df_all)
+            record['rows_out'] = len(self.raw_data)
+        self.interval = sampling_interval(self.raw_data['time_stamp'])
 
         
         ## call class to automatically remove lines with bad met data
         self.remove_bad_met()
         
         
+    def load_parquet(self, root, sensor_index, start=None, end=None):
+        ''' Load only the columns needed for the correction from the Parquet store
+        '''
+        
+        log.info('Loading in Parquet data')
+        
+        with stage('load_parquet') as record:
+            self.raw_data = read_purple_parquet(root, sensor_index, start, end, columns=self.columns)
+            record['rows_out'] = len(self.raw_data)
+        self.interval = sampling_interval(self.raw_data['time_stamp'])
+        
+        ## call class to automatically remove lines with bad met data
+        self.remove_bad_met()
+        
+        
     def remove_bad_met(self):
         ''' Remove erroneous high and low T and RH
                 T above 540C 
                 RH above 100%
         '''
         
-        print('Removing bad met')
+        log.info('Removing bad met')
         
-        ## Filter out erroneous temperature and humidity values
-        self.filter_data = self.raw_data[~(self.raw_data['temperature'] >= 1000.)]  
-        self.filter_data = self.raw_data[~(self.raw_data['humidity'] > 100.)]
+        with stage('remove_bad_met', rows_in=len(self.raw_data)) as record:
+            self.qc = QCMask(len(self.raw_data))
+            met_qc(self.qc, self.raw_data)
+            record['rows_out'] = int(self.qc.keep.sum())
         
         
-    def remove_pm25_outliers(self):
+    def remove_pm25_outliers(self, max_difference=None):
         ''' Remove PM2.5 Outliers
                 Remove PM2.5 values where percent different larger than 2 SD (61%)
                     Used the same method for relative difference as Barkjohn et al 2021
-                Remove PM2.5 values where different is greater than 5 micrograms
+                Remove PM2.5 values where different is greater than max_difference micrograms
+                    Barkjohn et al 2021 only used this on the 24 hour averages, see remove_day_outliers
         '''
         
-        print('Removing PM2.5 outliers')
+        log.info('Removing PM2.5 outliers')
+        
+        with stage('remove_pm25_outliers', rows_in=int(self.qc.keep.sum())) as record:
+            ## SD of the percent difference over the rows that passed the met rules
+            pct_diff = pct_difference(self.raw_data['pm2.5_cf_1_a'].to_numpy(), self.raw_data['pm2.5_cf_1_b'].to_numpy())
+            pct_thresh = PCT_DIFF_SD*np.nanstd(pct_diff[self.qc.keep])
+            
+            pm25_qc(self.qc, self.raw_data, pct_thresh, max_difference)
+            record['rows_out'] = int(self.qc.keep.sum())
         
-        pm25_a = self.filter_data['pm2.5_cf_1_a'].to_numpy()
-        pm25_b = self.filter_data['pm2.5_cf_1_b'].to_numpy()
-
-        ## Percent difference filtering
-        pct_diff = (np.abs(pm25_a-pm25_b)*2)/(pm25_a+pm25_b)
-        pm25_a_filt = np.where(pct_diff>(2*np.nanstd(pct_diff)), np.nan, pm25_a)
-        pm25_b_filt = np.where(pct_diff>(2*np.nanstd(pct_diff)), np.nan, pm25_b)
-
-        ## Difference filtering (only for 24 hour averages)
-        ## This condition was used only on the 24 hour averages
-#        pm25_a_filt = np.where(np.abs(pm25_a_filt-pm25_b_filt)>5, np.nan, pm25_a_filt)
-#        pm25_b_filt = np.where(np.abs(pm25_a_filt-pm25_b_filt)>5, np.nan, pm25_b_filt)
-
-        ## Put filtered data back into dictionary
-        self.filter_data.insert(0, 'pm2.5_filt_a', pm25_a_filt, True)
-        self.filter_data.insert(1, 'pm2.5_filt_b', pm25_b_filt, True)
-
-#        ## Drop columns with NaN values
-        self.filter_data = self.filter_data.dropna(subset=['pm2.5_filt_a', 'pm2.5_filt_b', 'humidity'])
-
         
-    def calculate_mean(self, time_var, completeness=None):
+    def calculate_mean(self, time_var, completeness=None, resolutions=('hour', 'day')):
         ''' Average A and B channels and perform Hourly and Daily averaging
+                Other resolutions ('15min', '8hour', 'month') can be added and are kept in
+                self.avg_data, they come from the same pass over the data
         '''
         
-        print('Calculating PM2.5 A/B channel mean')
+        self.calculate_sums()
         
-        ## Drop columns with NaN values
-        self.filter_data = self.filter_data.dropna(subset=['pm2.5_filt_a', 'pm2.5_filt_b', 'humidity'])
+        log.info('Calculating PM2.5 daily and hourly mean')
         
-        ## Hourly and Daily averaging
-        self.filter_data['pm2.5_ab_avg'] = self.filter_data[['pm2.5_filt_a','pm2.5_filt_b']].mean(axis=1)
+        interval = self.interval if self.interval is not None else sampling_interval(self.filter_data['time_stamp'])
+        self.set_means(self.sums_df, self.sums_names(), time_var, completeness, resolutions, interval)
         
-
-        print('Calculating PM2.5 daily and hourly mean')
         
-        ## Create Hourly and Daily average
-        self.avg_data_hour = self.filter_data.resample('H', on=time_var).mean()
-        self.avg_data_day = self.filter_data.resample('D', on=time_var).mean()
-    
+    def calculate_sums(self):
+        ''' Average A and B channels and sum every mean column into 15 minute buckets in one pass
+                Every resolution is built from self.sums_df, which is small enough to cache
+        '''
         
-        ## Filter data based on completeness from time resampling
-        if completeness != None:
-            data_avail_hour = self.filter_data.resample('H', on=time_var).count()/30
-            data_avail_day = self.filter_data.resample('D', on=time_var).count()/720
+        log.info('Calculating PM2.5 A/B channel mean')
         
-            ## Create time resampling completeness mask
-            mask_hour = data_avail_hour >= completeness
-            mask_day = data_avail_day >= completeness
-
-            ## Apply time resampling completeness mask
-            self.avg_data_hour = self.avg_data_hour[mask_hour]
-            self.avg_data_day = self.avg_data_day[mask_day]
+        with stage('calculate_sums', rows_in=len(self.raw_data)) as record:
+            ## The only copy of the data, rows that passed every QC rule
+            self.filter_data = self.raw_data[self.qc.keep]
             
-            ## Filter out masked data
-            self.avg_data_hour = self.avg_data_hour.dropna(subset=['pm2.5_ab_avg', 'humidity'])
-            self.avg_data_day = self.avg_data_day.dropna(subset=['pm2.5_ab_avg', 'humidity'])
+            self.sums_df = base_sums(self.filter_data['time_stamp'].to_numpy(), self.mean_values(self.filter_data))
+            record['rows_out'] = len(self.sums_df)
+        
+        return self.sums_df
+        
+        
+    def mean_values(self, data):
+        ''' Arrays to sum for each of self.mean_columns present, in that order
+                The A/B channel columns are derived from the cf_1 channels of the QC'd rows
+        '''
+        
+        pm25_a = data['pm2.5_cf_1_a'].to_numpy(dtype=float)
+        pm25_b = data['pm2.5_cf_1_b'].to_numpy(dtype=float)
+        derived = {'pm2.5_filt_a':pm25_a, 'pm2.5_filt_b':pm25_b, 'pm2.5_ab_avg':(pm25_a+pm25_b)/2.}
+        
+        return {col:derived[col] if col in derived else data[col].to_numpy()
+                for col in self.mean_columns if col in derived or col in data}
+        
+        
+    def sums_names(self):
+        ''' Mean columns present in self.sums_df
+        '''
+        
+        return [col for col in self.mean_columns if f'{col}_sum' in self.sums_df]
+        
+        
+    def remove_day_outliers(self, max_difference=AB_DIFF_MAX, max_pct=AB_PCT_MAX):
+        ''' Remove daily averages where the A and B channels differ by more than max_difference
+                and max_pct. The 24 hour rule from Barkjohn et al 2021, rejected days are counted in self.qc_day
+        '''
+        
+        log.info('Removing PM2.5 daily outliers')
+        
+        day_data = self.avg_data['day']
+        self.qc_day = QCMask(len(day_data))
+        ab_difference_qc(self.qc_day, day_data['pm2.5_filt_a'], day_data['pm2.5_filt_b'], max_difference, max_pct)
+        
+        self.avg_data['day'] = self.avg_data_day = day_data[self.qc_day.keep]
+        
+        
+    def set_means(self, sums_df, names, time_var, completeness, resolutions, interval):
+        ''' Build the averages from base bucket sums and apply the completeness threshold
+                Expected samples per bucket come from the sampling interval, so a 2-minute
+                sensor expects 30 per hour and 690, 720 or 750 per day depending on DST
+        '''
+        
+        with stage('set_means', rows_in=len(sums_df)) as record:
+            aggregated = aggregate_sums(sums_df, names, TIME_ZONES[time_var],
+                                        ['hour', 'day'] + [res for res in resolutions if res not in ('hour', 'day')],
+                                        interval)
+            record['rows_out'] = len(aggregated['hour'][0])
+        
+        self.avg_data = {}
+        for resolution, (means, counts, expected) in aggregated.items():
+            means.index.name = time_var
             
+            ## Filter data based on completeness from time resampling
+            if completeness != None:
+                means = apply_completeness(means, counts, expected, completeness)
+                
+            self.avg_data[resolution] = means
+            
+        self.avg_data_hour = self.avg_data['hour']
+        self.avg_data_day = self.avg_data['day']
+        
+        
+    def read_csv(self, file, chunk_size=None):
+        ''' Read the needed columns of a raw CSV with the schema dtypes (purple_schema)
+        '''
+        
+        return pd.read_csv(file, usecols=lambda col: col in self.dtypes, dtype=self.dtypes, chunksize=chunk_size)
+        
+        
+    def iter_chunks(self, chunk_size=None):
+        ''' Yield the raw data one file, or chunk_size rows of a file, at a time
+        '''
+        
+        for file in self.filenames:
+            if chunk_size is None:
+                yield self.read_csv(file)
+            else:
+                yield from self.read_csv(file, chunk_size)
+                    
+                    
+    def stream_mean(self, time_var, completeness=None, chunk_size=None, resolutions=('hour', 'day')):
+        ''' Streaming version of load_data, remove_pm25_outliers and calculate_mean
+                Makes two passes over the files: the first finds the percent difference SD
+                with a running estimate, the second accumulates 15 minute sums and counts.
+                Memory is bounded by the chunk size and the number of output buckets. Only the
+                QC counts are kept (self.qc is a QCCounts), not a mask over every row
+        '''
+        
+        log.info('Finding PM2.5 percent difference spread')
+        
+        with stage('stream_spread') as record:
+            running_std = RunningStd()
+            intervals = []
+            for raw_data in self.iter_chunks(chunk_size):
+                intervals.append(sampling_interval(raw_data['time_stamp']))
+                qc = QCMask(len(raw_data))
+                met_qc(qc, raw_data)
+                running_std.update(pct_difference(raw_data['pm2.5_cf_1_a'].to_numpy(),
+                                                  raw_data['pm2.5_cf_1_b'].to_numpy())[qc.keep])
+            pct_thresh = PCT_DIFF_SD*running_std.std()
+            record['rows_out'] = running_std.n
+        
+        log.info('Accumulating PM2.5 daily and hourly mean')
+        
+        with stage('stream_sums') as record:
+            sums_df = None
+            self.qc = QCCounts()
+            for raw_data in self.iter_chunks(chunk_size):
+                
+                ## Same rules remove_bad_met and remove_pm25_outliers apply
+                qc = QCMask(len(raw_data))
+                met_qc(qc, raw_data)
+                pm25_qc(qc, raw_data, pct_thresh)
+                self.qc.add(qc)
+                if not qc.keep.any():
+                    continue
+                chunk = raw_data[qc.keep]
+                
+                sums_df = accumulate(sums_df, base_sums(chunk['time_stamp'].to_numpy(), self.mean_values(chunk)))
+                
+            ## Every chunk empty or rejected
+            if sums_df is None:
+                sums_df = base_sums(np.empty(0, dtype=np.int64), {col:np.empty(0) for col in self.mean_columns})
+                
+            self.sums_df = sums_df.sort_index()
+            record['rows_in'] = self.qc.n_rows
+            record['rows_out'] = len(self.sums_df)
+        self.interval = np.nanmedian(intervals)
+        
+        self.set_means(self.sums_df, self.sums_names(), time_var, completeness, resolutions, self.interval)
+        
         
     def apply_epa_correction_model(self, data_dict):
         ''' Correct PM2.5 counts from Barkjohn et al 2021 model
         '''
         
-        print('Calculating EPA corrected PM2.5 values')
-        
-        pm25_ab = data_dict['pm2.5_ab_avg'].to_numpy()
-        rh = data_dict['humidity'].to_numpy()
+        log.info('Calculating EPA corrected PM2.5 values')
         
         ## Apply Barkjohn et al 2021 correction model
-        pm25_corrected = 0.524*pm25_ab-0.0862*rh+5.75
+        apply_models([data_dict], ['epa_2021'])
+        
+        
+    def apply_correction_models(self, models=None, resolutions=('hour', 'day')):
+        ''' Apply registered correction models (correction_models.CORRECTION_MODELS) to the averages
+                Every model runs once over all of the resolutions together
+        '''
+        
+        log.info('Calculating corrected PM2.5 values')
+        
+        frames = [self.avg_data[res] for res in resolutions]
+        n_rows = sum(len(frame) for frame in frames)
+        with stage('apply_correction_models', rows_in=n_rows) as record:
+            apply_models(frames, models)
+            record['rows_out'] = n_rows
         
-        ## Add corrected PM2.5 data back into data dictionary
-        data_dict['pm2.5_ab_epa_corr'] = pm25_corrected
         
     def apply_doee_correction_model(self, data_dict, intercept, slope):
         ''' Apply second correction from DOEE colocation analysis
+                intercept and slope can be single values or arrays matching data_dict
         '''
         
-        print('Calculating DOEE corrected PM2.5 values')
+        log.info('Calculating DOEE corrected PM2.5 values')
         
-        pm_data = data_dict['pm2.5_ab_epa_corr'].to_list()
-        data_dict['pm2.5_ab_epa_doee_corr'] = (np.asarray(pm_data)-intercept)/slope
+        pm_data = data_dict['pm2.5_ab_epa_corr'].to_numpy()
+        data_dict['pm2.5_ab_epa_doee_corr'] = (pm_data-intercept)/slope
         
 
 if __name__ == '__main__':
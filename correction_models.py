@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+
+def barkjohn_2021(pm25, rh):
+    ''' US wide PurpleAir correction from Barkjohn et al 2021, pm25 is the A/B mean of cf_1
+    '''
+
+    return 0.524*pm25-0.0862*rh+5.75
+
+
+def epa_smoke_2023(pm25, rh):
+    ''' EPA piecewise correction extended to high (smoke) concentrations (Barkjohn et al 2023)
+            Barkjohn 2021 below 30 µg/m³, blends into 0.786x by 50, then into a quadratic
+            between 210 and 260 and above. The RH term fades out over the last blend
+    '''
+
+    ## Blend weights, 0 at the lower breakpoint and 1 at the upper one
+    low = np.clip(pm25/20.-3./2., 0., 1.)
+    high = np.clip(pm25/50.-21./5., 0., 1.)
+
+    mid = (0.786*low+0.524*(1.-low))*pm25-0.0862*rh+5.75
+    mid_top = (0.69*high+0.786*(1.-high))*pm25-0.0862*rh*(1.-high)+2.966*high+5.75*(1.-high) \
+        + 8.84e-4*pm25**2*high
+
+    return np.where(pm25 < 210., mid, mid_top)
+
+
+def humidity_growth(pm25, rh, kappa=0.4, rh_max=99.):
+    ''' Remove hygroscopic growth with the single parameter kappa-Kohler factor (Crilley et al 2018)
+            RH is capped at rh_max so the growth factor stays finite
+    '''
+
+    a_w = np.clip(rh, 0., rh_max)/100.
+    with np.errstate(divide='ignore'):
+        growth = 1.+(kappa/1.65)/(-1.+1./a_w)
+
+    return pm25/growth
+
+
+## Model name -> (kernel, input columns, output column). Kernels take and return NumPy arrays
+CORRECTION_MODELS = {
+    'epa_2021':(barkjohn_2021, ('pm2.5_ab_avg', 'humidity'), 'pm2.5_ab_epa_corr'),
+    'epa_smoke_2023':(epa_smoke_2023, ('pm2.5_ab_avg', 'humidity'), 'pm2.5_ab_epa_smoke_corr'),
+    'humidity_growth':(humidity_growth, ('pm2.5_ab_avg', 'humidity'), 'pm2.5_ab_kohler_corr'),
+    }
+
+
+def register_model(name, kernel, inputs, column):
+    ''' Add a correction model, kernel is called with one array per input column
+    '''
+
+    CORRECTION_MODELS[name] = (kernel, tuple(inputs), column)
+
+
+def evaluate_models(frames, models=None):
+    ''' Run several correction models on several frames in one batched call
+            The input columns of all frames are stacked once and every kernel writes one row of a
+            preallocated models x rows block. Returns the block and the row offset of each frame
+    '''
+
+    models = list(CORRECTION_MODELS) if models is None else list(models)
+    offsets = np.cumsum([0]+[len(frame) for frame in frames])
+
+    ## Each input column is pulled out of the frames once, however many models use it
+    inputs = {col for name in models for col in CORRECTION_MODELS[name][1]}
+    arrays = {col:np.concatenate([frame[col].to_numpy(dtype=float) for frame in frames]) for col in inputs}
+
+    block = np.empty((len(models), offsets[-1]))
+    for i, name in enumerate(models):
+        kernel, columns, _ = CORRECTION_MODELS[name]
+        block[i] = kernel(*[arrays[col] for col in columns])
+
+    return block, offsets
+
+
+def apply_models(frames, models=None):
+    ''' Evaluate the models on every frame and add each model's output column in place
+    '''
+
+    models = list(CORRECTION_MODELS) if models is None else list(models)
+    block, offsets = evaluate_models(frames, models)
+
+    for j, frame in enumerate(frames):
+        for i, name in enumerate(models):
+            frame[CORRECTION_MODELS[name][2]] = block[i, offsets[j]:offsets[j+1]]
+
+    return frames
+
+
+def compare_models(frame, models=None):
+    ''' All model outputs for one frame side by side, for comparing models across an archive
+    '''
+
+    models = list(CORRECTION_MODELS) if models is None else list(models)
+    block, _ = evaluate_models([frame], models)
+
+    return pd.DataFrame(block.T, index=frame.index, columns=models)
@@ -9,116 +9,110 @@ Created on Sat Jul 30 10:26:01 2022
 import glob
 import numpy as np
 import pandas as pd
-from datetime import datetime
 
-from windrose import WindroseAxes
+from wind_cube import WindCube, plot_rose_table
 
-def get_windy_withit(file_list, sigma_thresh=2):
+## ISD/ASOS WND field: direction, direction QC, observation type, speed (m/s x 10), speed QC
+WND_COLUMNS = ['windd', 'windd_qc', 'wind_type', 'winds', 'winds_qc']
+
+## Season of each month (January first): 0 winter, 1 spring, 2 summer, 3 fall
+SEASON_OF_MONTH = np.array([0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+
+## Months (1-12) of each season for slicing a WindCube
+SEASON_MONTHS = {season:np.flatnonzero(SEASON_OF_MONTH == i)+1 for i, season in enumerate(['winter', 'spring', 'summer', 'fall'])}
+
+
+def read_wind_records(file):
+    ''' Parse the DATE and WND columns of an ISD/ASOS CSV into typed columns, QC codes kept
+    '''
+    
+    met_data = pd.read_csv(file, usecols=['DATE', 'WND'], dtype={'WND':str})
+    
+    wind = met_data['WND'].str.split(',', n=4, expand=True)
+    wind.columns = WND_COLUMNS
+    
+    wind_df = pd.DataFrame({'time':pd.to_datetime(met_data['DATE'], format='%Y-%m-%dT%H:%M:%S'),
+                            'windd':pd.to_numeric(wind['windd'], errors='coerce'),
+                            'windd_qc':wind['windd_qc'],
+                            'wind_type':wind['wind_type'],
+                            'winds':pd.to_numeric(wind['winds'], errors='coerce')/10., ## scaling factor 10
+                            'winds_qc':wind['winds_qc']})
+    
+    return wind_df
+
+
+def get_windy_withit(file_list, sigma_thresh=2, bad_qc=None):
     ''' Analyze yearly wind data
+            bad_qc optionally lists QC codes (e.g. ['2', '3']) to drop
+            Returns datetime64 times, wind direction and wind speed arrays
     '''
     
-    master_time = np.array([])
-    master_windd = np.array([])
-    master_winds = np.array([])
+    wind_list = []
     
     for file in file_list:
         year = file.split('_')[-1].split('.')[0]
         print(f'Analyzing met data from {year}')
         
-    
-        met_data = pd.read_csv(file)
-        
-        time_str = met_data['DATE'].to_list()
-        time_dt = [datetime.strptime(tme, '%Y-%m-%dT%H:%M:%S') for tme in time_str]
-        wind = met_data['WND'].to_list()
-        
-        
-        
-        split_wind = [i.split(',') for i in wind]
-        
-        split_wind = np.asarray(split_wind)
-        
-        raw_windd = split_wind[:,0].astype(float)
-        # windd_qc = split_wind[:,1].astype(int)
-        # wind_type = split_wind[:,2].astype(float)
-        raw_winds = split_wind[:,3].astype(float)/10. ## scaling factor 10
-        # winds_qc = split_wind[:,4].astype(int)
+        wind_df = read_wind_records(file)
         
         ## Find missing wind measurements
+        good = (wind_df['windd'] != 999) & (wind_df['winds'] != 999.9) & \
+            wind_df['windd'].notna() & wind_df['winds'].notna()
         
-        missing_windd = np.where(raw_windd==999)[0]
-        missing_winds = np.where(raw_winds==9999)[0]
-        missing_combined = np.concatenate((missing_windd, missing_winds))
-        missing_wind_final = np.unique(missing_combined)
+        if bad_qc is not None:
+            good &= ~wind_df['windd_qc'].isin(bad_qc) & ~wind_df['winds_qc'].isin(bad_qc)
         
-        # sus_windd = np.where(windd_qc==2)[0]
-        # erron_windd = np.where(windd_qc==3)[0]
-        # sus_winds = np.where(winds_qc==2)[0]
-        # erron_winds = np.where(winds_qc==3)[0]
-        
-        ## Remove missing values
-        good_windd = np.delete(raw_windd, missing_wind_final)
-        good_winds = np.delete(raw_winds, missing_wind_final)
-        good_time = np.delete(time_dt, missing_wind_final)
+        wind_df = wind_df[good]
         
         ## Standard deviation filter
-        winds_sigma = np.std(good_winds)
-        sigma_filt = np.where(good_winds>(sigma_thresh*winds_sigma))[0]
-        
-        normal_windd = np.delete(good_windd, sigma_filt)
-        normal_winds = np.delete(good_winds, sigma_filt)
-        normal_time = np.delete(good_time, sigma_filt)
+        winds_sigma = np.std(wind_df['winds'].to_numpy())
+        wind_df = wind_df[~(wind_df['winds'] > (sigma_thresh*winds_sigma))]
         
-        master_time = np.append(master_time, normal_time)
-        master_windd = np.append(master_windd, normal_windd)
-        master_winds = np.append(master_winds, normal_winds)
+        wind_list.append(wind_df)
+    
+    master_df = pd.concat(wind_list, ignore_index=True)
+    
+    return master_df['time'].to_numpy(), master_df['windd'].to_numpy(dtype=float), master_df['winds'].to_numpy(dtype=float)
+
 
+def group_wind(keys, n_groups, windd, winds):
+    ''' Split direction and speed into n_groups by an integer key with one stable sort
+    '''
+    
+    order = np.argsort(keys, kind='stable')
+    splits = np.searchsorted(keys[order], np.arange(1, n_groups))
     
-    return master_time, master_windd, master_winds
+    return list(zip(np.split(np.asarray(windd)[order], splits), np.split(np.asarray(winds)[order], splits)))
 
 
 def get_seasonal_withit(tme, windd, winds):
     ''' Sort the wind data seasonally
     '''
     
-    winter_windd = np.array([])
-    winter_winds = np.array([])
-    spring_windd = np.array([])
-    spring_winds = np.array([])
-    summer_windd = np.array([])
-    summer_winds = np.array([])
-    fall_windd = np.array([])
-    fall_winds = np.array([])
-    
-    for i in range(len(tme)):
-        month = tme[i].month
-        if month in {12,1,2}:
-            winter_windd = np.append(winter_windd, windd[i])
-            winter_winds = np.append(winter_winds, winds[i])
-        elif month in {3,4,5}:
-            spring_windd = np.append(spring_windd, windd[i])
-            spring_winds = np.append(spring_winds, winds[i])
-        elif month in {6,7,8}:
-            summer_windd = np.append(summer_windd, windd[i])
-            summer_winds = np.append(summer_winds, winds[i])
-        elif month in {9,10,11}:
-            fall_windd = np.append(fall_windd, windd[i])
-            fall_winds = np.append(fall_winds, winds[i])
-            
-        
-    return (winter_windd, winter_winds), (spring_windd, spring_winds), (summer_windd, summer_winds), (fall_windd, fall_winds)
+    month = pd.DatetimeIndex(tme).month.to_numpy()
+    winter, spring, summer, fall = group_wind(SEASON_OF_MONTH[month-1], 4, windd, winds)
+    
+    return winter, spring, summer, fall
+
+
+def get_monthly_withit(tme, windd, winds):
+    ''' Sort the wind data by month, returns a list of 12 (direction, speed) pairs from January
+    '''
+    
+    month = pd.DatetimeIndex(tme).month.to_numpy()
+    
+    return group_wind(month-1, 12, windd, winds)
         
 
-def plot_windrose(windd, winds, bins, title):
-    ''' Function for plotting a windrose          
+def plot_windrose(cube, bins, title, years=None, months=None, hours=None):
+    ''' Function for plotting a windrose from a time slice of a WindCube
+            years, months and hours are lists like WindCube.select, None keeps everything
     '''
     ## Plot windrose
 
-    ax = WindroseAxes.from_ax()
-    # ax.bar(good_windd, good_winds, normed=True, opening=0.8, edgecolor='white')
-    ax.bar(windd, winds, normed=True, opening=0.8, bins=bins, edgecolor='white')
-    ax.set_legend()
-    ax.set_title(title, fontsize=20.)
+    table, edges = cube.select(years=years, months=months, hours=hours, bins=bins)
+    
+    return plot_rose_table(table, edges, title)
             
 
 
@@ -134,13 +128,11 @@ if __name__ == '__main__':
     file_list = glob.glob(file_path)
     sigma = 2.0
     
-    tme, windd, winds = get_windy_withit(file_list, sigma_thresh=sigma)
-    
-    winter, spring, summer, fall = get_seasonal_withit(tme, windd, winds)
+    cube = WindCube.from_files(file_list, sigma_thresh=sigma)
     
     bins = np.arange(1,5,.5)
     
-    plot_windrose(fall[0], fall[1], bins, 'Reagan National Airport Wind Rose \n Fall - 2007 to 2022')
-    # plot_windrose(windd, winds, bins, 'Reagan National Airport Wind Rose \n 2007 to 2022')
+    plot_windrose(cube, bins, 'Reagan National Airport Wind Rose \n Fall - 2007 to 2022', months=SEASON_MONTHS['fall'])
+    # plot_windrose(cube, bins, 'Reagan National Airport Wind Rose \n 2007 to 2022')
 
     
\ No newline at end of file
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import time
+import datetime
+
+
+MANIFEST_COLUMNS = ['sensor_index', 'average_period', 'date', 'status', 'rows',
+                    'content_hash', 'last_time_stamp', 'fetched_at']
+
+
+class DownloadManifest():
+    ''' CSV manifest recording the outcome of every downloaded sensor day
+            status is ok (rows written), empty (API returned no rows) or failed (request error)
+            A day fetched before it was over plus settle_hours is treated as stale and refetched
+    '''
+    def __init__(self, fn, settle_hours=2.):
+        self.fn = fn
+        self.settle = settle_hours*3600.
+        self.entries = {}
+
+        if os.path.exists(fn):
+            self.load()
+
+
+    def load(self):
+        ''' Read the manifest CSV into a dictionary keyed by (sensor_index, average_period, date)
+        '''
+
+        with open(self.fn, newline='') as f:
+            for row in csv.DictReader(f):
+                row['average_period'] = int(row['average_period'])
+                row['rows'] = int(row['rows'])
+                row['last_time_stamp'] = int(row['last_time_stamp']) if row['last_time_stamp'] else None
+                row['fetched_at'] = float(row['fetched_at'])
+                self.entries[(row['sensor_index'], row['average_period'], row['date'])] = row
+
+
+    def save(self):
+        ''' Write the manifest, through a temporary file so a crash never leaves it half written
+        '''
+
+        tmp_fn = f'{self.fn}.tmp'
+        with open(tmp_fn, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+            writer.writeheader()
+            for key in sorted(self.entries):
+                writer.writerow(self.entries[key])
+
+        os.replace(tmp_fn, self.fn)
+
+
+    def record_day(self, sensor_index, average_period, day, status, rows=0, content_hash='',
+                   last_time_stamp=None, fetched_at=None):
+        ''' Record the outcome for one sensor day
+        '''
+
+        date_str = day.strftime('%Y-%m-%d')
+        self.entries[(str(sensor_index), average_period, date_str)] = {
+            'sensor_index':str(sensor_index), 'average_period':average_period, 'date':date_str,
+            'status':status, 'rows':rows, 'content_hash':content_hash, 'last_time_stamp':last_time_stamp,
+            'fetched_at':time.time() if fetched_at is None else fetched_at}
+
+
+    def record_window(self, sensor_index, average_period, day_summary, fetched_at=None):
+        ''' Record the per day output of get_purply.save_output_days
+        '''
+
+        for day, rows, content_hash, last_time_stamp in day_summary:
+            status = 'ok' if rows != 0 else 'empty'
+            self.record_day(sensor_index, average_period, day, status, rows, content_hash,
+                            last_time_stamp, fetched_at)
+
+
+    def record_failure(self, sensor_index, average_period, starttime, endtime):
+        ''' Mark every day in a window as failed
+                A day already on record keeps its rows, hash and last_time_stamp so a failed
+                refetch of a good day does not lose the data it points to
+        '''
+
+        day = starttime
+        while day < endtime:
+            entry = self.entries.get((str(sensor_index), average_period, day.strftime('%Y-%m-%d')))
+            if entry is None:
+                self.record_day(sensor_index, average_period, day, 'failed')
+            else:
+                self.record_day(sensor_index, average_period, day, 'failed', entry['rows'],
+                                entry['content_hash'], entry['last_time_stamp'])
+            day += datetime.timedelta(days=1)
+
+
+    def is_done(self, sensor_index, average_period, day):
+        ''' Check if a sensor day was downloaded after it was complete
+        '''
+
+        entry = self.entries.get((str(sensor_index), average_period, day.strftime('%Y-%m-%d')))
+        if entry is None or entry['status'] == 'failed':
+            return False
+
+        ## Data uploads lag, so only trust days fetched well after they ended
+        day_end = time.mktime((day+datetime.timedelta(days=1)).timetuple())
+        return entry['fetched_at'] >= day_end+self.settle
+
+
+    def pending_windows(self, sensor_index, average_period, start_dt, end_dt, max_days):
+        ''' Group the missing, failed and stale days of a date range into windows of at most max_days
+        '''
+
+        windows = []
+        window_start = None
+        day = start_dt
+        while day < end_dt:
+            next_day = day+datetime.timedelta(days=1)
+
+            if self.is_done(sensor_index, average_period, day):
+                if window_start is not None:
+                    windows.append((window_start, day))
+                    window_start = None
+            else:
+                if window_start is None:
+                    window_start = day
+                elif (next_day-window_start).days > max_days:
+                    windows.append((window_start, day))
+                    window_start = day
+
+            day = next_day
+
+        if window_start is not None:
+            windows.append((window_start, end_dt))
+
+        return windows
+
+
+    def last_time_stamp(self, sensor_index, average_period):
+        ''' Latest time_stamp downloaded for a sensor, None if nothing was downloaded yet
+        '''
+
+        stamps = [entry['last_time_stamp'] for (sensor, period, _), entry in self.entries.items()
+                  if sensor == str(sensor_index) and period == average_period
+                  and entry['last_time_stamp'] is not None]
+
+        return max(stamps) if len(stamps) != 0 else None
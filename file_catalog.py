@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import bisect
+
+from purple_storage import RAW_FILE_PATTERN
+
+
+## In process cache, directory -> FileCatalog
+_CATALOGS = {}
+
+
+class FileCatalog():
+    ''' Index of the {sensor_index}_{YYYY-MM-DD}.csv files in a raw data directory
+            Built from one directory scan, dates are kept sorted per sensor for bisect range queries
+    '''
+    def __init__(self, in_path, mtime=None, files=None):
+        self.in_path = in_path
+        self.mtime = mtime
+        self.files = files if files is not None else {}
+
+
+    @classmethod
+    def scan(cls, in_path):
+        ''' Build the catalog from a single scan of the directory
+        '''
+
+        mtime = os.stat(in_path).st_mtime_ns
+
+        files = {}
+        with os.scandir(in_path) as entries:
+            for entry in entries:
+                match = RAW_FILE_PATTERN.match(entry.name)
+                if match is not None:
+                    files.setdefault(match['sensor'], []).append((match['date'], entry.name))
+
+        ## Dates and file names stored as parallel sorted lists
+        for sensor, sensor_files in files.items():
+            sensor_files.sort()
+            files[sensor] = ([date for date, _ in sensor_files], [name for _, name in sensor_files])
+
+        return cls(in_path, mtime, files)
+
+
+    def is_current(self):
+        ''' Check the directory hasn't had files added, removed or renamed since the scan
+        '''
+
+        return os.stat(self.in_path).st_mtime_ns == self.mtime
+
+
+    def sensors(self):
+        ''' Sensor indices found in the directory
+        '''
+
+        return sorted(self.files)
+
+
+    def get_files(self, sensor_index, start_date, end_date):
+        ''' Files for a sensor from start_date to end_date (YYYY-MM-DD, both inclusive)
+        '''
+
+        if str(sensor_index) not in self.files:
+            return []
+        dates, names = self.files[str(sensor_index)]
+
+        first = bisect.bisect_left(dates, start_date)
+        last = bisect.bisect_right(dates, end_date)
+
+        return [os.path.join(self.in_path, name) for name in names[first:last]]
+
+
+    def save(self, cache_fn):
+        ''' Save the catalog as JSON so later runs only need to stat the directory
+        '''
+
+        with open(f'{cache_fn}.tmp', 'w') as f:
+            json.dump({'in_path':self.in_path, 'mtime':self.mtime, 'files':self.files}, f)
+        os.replace(f'{cache_fn}.tmp', cache_fn)
+
+
+    @classmethod
+    def load(cls, cache_fn):
+        ''' Load a catalog saved with save
+        '''
+
+        with open(cache_fn) as f:
+            cached = json.load(f)
+
+        return cls(cached['in_path'], cached['mtime'], {sensor:tuple(lists) for sensor, lists
+                                                        in cached['files'].items()})
+
+
+def get_catalog(in_path, cache_fn=None):
+    ''' Get the catalog for a directory, rescanning only when the directory mtime changed
+            cache_fn optionally persists the catalog between runs, keep it outside in_path
+            since writing it inside would change the directory mtime
+    '''
+
+    in_path = os.path.abspath(in_path)
+
+    catalog = _CATALOGS.get(in_path)
+    if catalog is None and cache_fn is not None and os.path.exists(cache_fn):
+        try:
+            catalog = FileCatalog.load(cache_fn)
+        except (OSError, ValueError, KeyError):
+            ## Unreadable catalog files are rebuilt
+            catalog = None
+        if catalog is not None and catalog.in_path != in_path:
+            catalog = None
+
+    if catalog is None or not catalog.is_current():
+        catalog = FileCatalog.scan(in_path)
+        if cache_fn is not None:
+            catalog.save(cache_fn)
+
+    _CATALOGS[in_path] = catalog
+
+    return catalog
@@ -10,50 +10,70 @@ import requests
 import time
 import datetime
 import json
+import io
+import re
+import hashlib
+import logging
+import numpy as np
 import pandas as pd
 
+from purple_schema import PURPLE_DTYPES, api_fields
+import instrumentation
+from instrumentation import stage, setup_logging
 
-def get_hist_purple_data(my_api_read_key, sensor_index, starttime, endtime, average_period=0):
+
+log = logging.getLogger(__name__)
+
+
+## Base URL for the PurpleAir API, pass a different one to point at a stub server
+API_URL = 'https://api.purpleair.com/v1'
+
+## Start of the rows in a history response body and the end of the last row
+DATA_KEY = re.compile(rb'"data"\s*:\s*\[')
+ROWS_END = re.compile(rb'\]\s*\]')
+ROW_BREAKS = bytes.maketrans(b']', b'\n')
+
+
+def get_hist_purple_data(my_api_read_key, sensor_index, starttime, endtime, average_period=0,
+                         session=None, api_url=API_URL, field_profile='archive'):
     ''' Function for pulling historical purple air data through PurpleAir API
+            A requests session can be passed in to reuse pooled connections.
+            field_profile='correction' only downloads the fields the correction uses
     '''
     
-    print('Querying API')
+    log.info('Querying API')
     
     ## Get Unix timestamp for query date/time range
     starttime_unix = time.mktime(starttime.timetuple())
     endtime_unix = time.mktime(endtime.timetuple())
 
-    ## Set API parameters
+    ## Set API parameters, the field profile picks the fields (purple_schema)
     parameters = {'average':average_period, 'start_timestamp':starttime_unix,
-                  'end_timestamp':endtime_unix, 
-                  'fields':'humidity, temperature, pressure, pressure_a, pressure_b,\
-                    pm1.0_atm, pm1.0_atm_a, pm1.0_atm_b, pm1.0_cf_1, pm1.0_cf_1_a,\
-                    pm1.0_cf_1_b, pm2.5_alt, pm2.5_alt_a, pm2.5_alt_b, pm2.5_atm,\
-                    pm2.5_atm_a, pm2.5_atm_b, pm2.5_cf_1, pm2.5_cf_1_a, pm2.5_cf_1_b,\
-                    pm10.0_atm, pm10.0_atm_a, pm10.0_atm_b, pm10.0_cf_1, pm10.0_cf_1_a,\
-                    pm10.0_cf_1_b, scattering_coefficient, scattering_coefficient_a,\
-                    scattering_coefficient_b, deciviews, deciviews_a, deciviews_b, \
-                    visual_range, visual_range_a, visual_range_b, rssi, uptime,\
-                    pa_latency, memory'}
+                  'end_timestamp':endtime_unix, 'fields':api_fields(field_profile)}
                       
 
 #    my_url = f'https://api.purpleair.com/v1/sensors/{sensor_index}/history/csv'
-    my_url = f'https://api.purpleair.com/v1/sensors/{sensor_index}/history'
+    my_url = f'{api_url}/sensors/{sensor_index}/history'
 
 
     ## Set the API header
     my_headers = {'X-API-Key':my_api_read_key}
     
     #r = requests.get(my_url, headers=my_headers)
-    r = requests.get(my_url, headers=my_headers, params=parameters)
+    requester = requests if session is None else session
+    with stage('api_request') as record:
+        r = requester.get(my_url, headers=my_headers, params=parameters)
+        if instrumentation.enabled():
+            record.update(sensor_index=sensor_index, status=r.status_code, bytes=len(r.content))
 
     ## Return the response 
     return r
 
-def get_current_purple_data(my_api_read_key, sensor_index):
+def get_current_purple_data(my_api_read_key, sensor_index, api_url=API_URL):
     ''' Pull current data from PurpleAir sensors
+            live_monitor.LiveMonitor polls many sensors at once
     '''
-    my_url = f'https://api.purpleair.com/v1/sensors/{sensor_index}'
+    my_url = f'{api_url}/sensors/{sensor_index}'
     
     parameters = {'fields': 'uptime, date_created, temperature, pm2.5_alt'}
     
@@ -65,26 +85,166 @@ def get_current_purple_data(my_api_read_key, sensor_index):
     return r
 
 
+def find_data_array(content):
+    ''' Byte span of the rows inside the "data" array of a history response body, None if absent
+    '''
+
+    start = DATA_KEY.search(content)
+    if start is None:
+        return None
+    if content[start.end():].lstrip()[:1] == b']':
+        return start.end(), start.end()
+
+    ## Rows only hold numbers and nulls, so the first ] followed by ] closes the array
+    end = ROWS_END.search(content, start.end())
+    if end is None:
+        return None
+
+    return start.end(), end.start()+1
+
+
+def parse_rows(rows, n_fields):
+    ''' Parse the text of the data rows into a rows x fields float block, null becomes NaN
+            Brackets become line breaks so the C CSV reader does the number parsing.
+            Returns None if the text isn't rows of plain numbers
+    '''
+
+    ## "[1,2],[3,4]" -> ",1,2\n,3,4\n", every line then starts with an empty column
+    text = b','+rows.translate(ROW_BREAKS, b'[ \t\r\n')
+    try:
+        block = pd.read_csv(io.BytesIO(text), header=None, usecols=range(1, n_fields+1), dtype=float,
+                            na_values=['null'], keep_default_na=False).to_numpy()
+    except ValueError:
+        return None
+
+    if len(block) != text.count(b'\n'):
+        return None
+
+    return block
+
+
+def typed_column(values, dtype):
+    ''' Cast a float column to its storage dtype, NaN becomes <NA> in the nullable integer types
+    '''
+
+    if dtype.startswith('Int'):
+        missing = np.isnan(values)
+        return pd.arrays.IntegerArray(np.where(missing, 0, values).astype(dtype.lower()), missing)
+
+    return values.astype(dtype)
+
+
+def parse_history_json(content):
+    ''' Fields and rows x fields float block of a history response body through the json module
+    '''
+
+    body = json.loads(content)
+    if 'data' not in body:
+        raise ValueError('No data array in the PurpleAir response')
+    fields = body['fields']
+
+    return fields, np.array(body['data'], dtype=float).reshape(-1, len(fields))
+
+
+def parse_history_fast(content):
+    ''' Fields and float block of a history response body, the rows parsed by the C CSV reader
+            Returns None if the body isn't rows of plain numbers
+    '''
+
+    span = find_data_array(content)
+    if span is None:
+        return None
+
+    ## Everything around the rows is small, fields and metadata come from the json module
+    try:
+        header = json.loads(content[:span[0]]+content[span[1]:])
+    except ValueError:
+        return None
+    fields = header['fields']
+
+    if span[0] == span[1]:
+        return fields, np.empty((0, len(fields)))
+
+    block = parse_rows(content[span[0]:span[1]], len(fields))
+    if block is None:
+        return None
+
+    return fields, block
+
+
+def parse_history(content):
+    ''' Parse a history response body once into typed columns sorted by time_stamp
+            The data rows go straight from the text into one float block instead of a list of
+            lists, are reordered with one argsort and cast to the storage dtypes (PURPLE_DTYPES).
+            Falls back to the json module for anything that isn't plain numbers
+    '''
+
+    parsed = parse_history_fast(content)
+    fields, block = parse_history_json(content) if parsed is None else parsed
+
+    ## The API returns rows out of order
+    block = block[np.argsort(block[:, fields.index('time_stamp')], kind='stable')]
+
+    columns = {field:typed_column(block[:, j], PURPLE_DTYPES.get(field, 'float64'))
+               for j, field in enumerate(fields)}
+
+    return pd.DataFrame(columns, copy=False)
+
+
 def save_output(data, sensor_index, data_date, out_path):
-    ''' Save PurpleAir JSON dictionary as a CSV
+    ''' Save a PurpleAir history response as a CSV
+            Returns the number of rows written
     '''
     
-    print('Saving output CSV file')
+    log.info('Saving output CSV file')
     
     ## Set up file path and name
     data_date_str = datetime.datetime.strftime(data_date, '%Y-%m-%d')
     file_path = f'{out_path}/{sensor_index}_{data_date_str}.csv'
     
-    ## Create Pandas dataframe from PurpleAir JSON dictionary
-    fields = data.json()['fields']
-    purple_df = pd.DataFrame.from_dict(data.json()['data'])
-    purple_df = purple_df.set_axis(fields, axis=1, inplace=False)
-    
-    ## Sort datafrane by time index since the data are returned out of order
-    purple_df = purple_df.sort_values(by=['time_stamp'])
+    ## Parse the response once, sorted by time since the data are returned out of order
+    purple_df = parse_history(data.content)
     
     purple_df.to_csv(file_path, index=False)
     
+    return len(purple_df)
+
+
+def save_output_days(purple_df, sensor_index, starttime, endtime, out_path):
+    ''' Split a multi-day PurpleAir dataframe into the same daily CSVs written by save_output
+            Day boundaries use the same local time convention as get_hist_purple_data
+            Returns a list of (day, rows, content hash, last time_stamp), empty days included
+    '''
+    
+    with stage('save_output_days', rows_in=len(purple_df)) as record:
+        day_summary = []
+        day = starttime
+        while day < endtime:
+            next_day = day+datetime.timedelta(days=1)
+        
+            ## Select rows falling inside this day
+            day_start = time.mktime(day.timetuple())
+            day_end = time.mktime(next_day.timetuple())
+            in_day = (purple_df['time_stamp'] >= day_start) & (purple_df['time_stamp'] < day_end)
+            day_df = purple_df[in_day]
+        
+            if len(day_df) != 0:
+                data_date_str = datetime.datetime.strftime(day, '%Y-%m-%d')
+                csv_text = day_df.to_csv(index=False)
+                with open(f'{out_path}/{sensor_index}_{data_date_str}.csv', 'w') as f:
+                    f.write(csv_text)
+            
+                content_hash = hashlib.sha256(csv_text.encode()).hexdigest()
+                day_summary.append((day, len(day_df), content_hash, int(day_df['time_stamp'].max())))
+            else:
+                day_summary.append((day, 0, '', None))
+            
+            day = next_day
+            
+        record['rows_out'] = sum(rows for _, rows, _, _ in day_summary)
+        
+    return day_summary
+    
 
 def download_multiple_days(api_read_key, sensor_index, start_date, end_date, out_path, sleep_time=600):
     ''' Function to loop through multiple days to download PurpleAir data
@@ -98,14 +258,15 @@ def download_multiple_days(api_read_key, sensor_index, start_date, end_date, out
     while starttime < end_dt:
         endtime = starttime+datetime.timedelta(days=1)
         
-        print(f'Getting data for {starttime} to {endtime}')
+        log.info(f'Getting data for {starttime} to {endtime}')
         
         ## Get data through API
         data = get_hist_purple_data(api_read_key, sensor_index, starttime, endtime)
         
-        ## Save output data JSON to CSV
-        if len(data.json()['data']) != 0:
-            save_output(data, sensor_index, starttime, out_path)
+        ## Save output data to CSV, parsing the response once
+        purple_df = parse_history(data.content)
+        if len(purple_df) != 0:
+            save_output_days(purple_df, sensor_index, starttime, endtime, out_path)
         
         time.sleep(sleep_time)
         
@@ -114,5 +275,6 @@ def download_multiple_days(api_read_key, sensor_index, start_date, end_date, out
 
 if __name__ == '__main__':
     
+    setup_logging()
     out_path = r'/path/to/output/files'
     download_multiple_days(my_api_read_key, sensor_id, '2022-11-01', '2022-12-01', out_path, sleep_time=210)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+
+class HourlyTable():
+    ''' Any number of hourly series (the DOEE reference, PurpleAir sensors, channels) on one grid
+            values is a dense hours x columns matrix (float32 by default), NaN where a column has no
+            reading, and valid is the matching mask. Adding a sensor adds a column.
+    '''
+    def __init__(self, grid, columns, values, valid):
+        self.grid    = grid
+        self.columns = list(columns)
+        self.values  = values
+        self.valid   = valid
+
+    def column(self, name):
+        ''' Values of one column
+        '''
+
+        return self.values[:, self.columns.index(name)]
+
+    def rows_with_data(self, columns=None, how='all'):
+        ''' Mask of hours where all (or any) of the columns, every column by default, have data
+        '''
+
+        idx = range(len(self.columns)) if columns is None else [self.columns.index(col) for col in columns]
+        valid = self.valid[:, list(idx)]
+
+        return valid.all(axis=1) if how == 'all' else valid.any(axis=1)
+
+    def to_frame(self):
+        ''' The table as a dataframe indexed by the grid
+        '''
+
+        return pd.DataFrame(self.values, index=self.grid, columns=self.columns)
+
+
+def hourly_table(series, time_name='datetime_utc', dtype=np.float32):
+    ''' Align several (times, values) pairs onto one hourly grid in a single pass
+            series is a dictionary of column name -> (times, values). Times are floored to the hour
+            and the grid runs from the earliest to the latest hour of any column. Each column is
+            scattered into a preallocated dtype matrix by its hour position, a later duplicate hour
+            wins. Missing times (NaT) are dropped.
+    '''
+
+    hours = {}
+    for name, (times, values) in series.items():
+        times = pd.DatetimeIndex(times).floor('h')
+        values = np.asarray(values, dtype=dtype)
+        keep = ~times.isna()
+        hours[name] = (times[keep], values[keep])
+
+    starts = [times.min() for times, _ in hours.values() if len(times) > 0]
+    ends = [times.max() for times, _ in hours.values() if len(times) > 0]
+    if len(starts) == 0:
+        grid = pd.DatetimeIndex([], name=time_name)
+    else:
+        grid = pd.date_range(min(starts), max(ends), freq='h', name=time_name)
+
+    values = np.full((len(grid), len(hours)), np.nan, dtype=dtype)
+    for i, (times, column) in enumerate(hours.values()):
+        if len(times) == 0:
+            continue
+        pos = ((times-grid[0])//pd.Timedelta(hours=1)).to_numpy()
+        values[pos, i] = column
+
+    return HourlyTable(grid, hours.keys(), values, ~np.isnan(values))
+
+
+def regression_from_sums(n, sx, sy, sxx, syy, sxy):
+    ''' Least squares fit of y on x from sums, works elementwise on arrays
+            Returns slope, intercept, R squared and RMSE of the residuals
+    '''
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx_c = sxx - sx*sx/n
+        syy_c = syy - sy*sy/n
+        sxy_c = sxy - sx*sy/n
+
+        slope = sxy_c/sxx_c
+        intercept = (sy - slope*sx)/n
+        r_squared = sxy_c**2/(sxx_c*syy_c)
+        rmse = np.sqrt(np.maximum(syy_c - slope*sxy_c, 0.)/n)
+
+    return slope, intercept, r_squared, rmse
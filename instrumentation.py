@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import cProfile
+import threading
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+## Instrumentation state, stage() does nothing unless enable() was called
+_STATE = {'enabled':False, 'jsonl_fn':None, 'profile_dir':None, 'trace_memory':False, 'context':{}}
+
+## Stage nesting depth, per thread since the downloader runs stages on a thread pool
+_THREAD = threading.local()
+
+## Stage records collected in this process
+RECORDS = []
+
+## Linux per process memory files, the peak RSS (VmHWM) can be reset by writing 5 to clear_refs
+PROC_STATUS = '/proc/self/status'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+## Records of the stages open in any thread and the lock guarding them and the peak RSS resets
+_OPEN = []
+_LOCK = threading.Lock()
+
+
+def setup_logging(level='INFO', fn=None, fmt=LOG_FORMAT):
+    ''' Send log messages at level and above to stderr, or to a file if fn is given
+    '''
+
+    handler = logging.StreamHandler() if fn is None else logging.FileHandler(fn)
+    handler.setFormatter(logging.Formatter(fmt))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+    return handler
+
+
+@contextlib.contextmanager
+def log_to_file(fn, level='INFO', fmt=LOG_FORMAT):
+    ''' Send every log message to fn, and only there, for the duration of the block
+    '''
+
+    root = logging.getLogger()
+    handlers, old_level = root.handlers[:], root.level
+
+    handler = logging.FileHandler(fn)
+    handler.setFormatter(logging.Formatter(fmt))
+    root.handlers = [handler]
+    root.setLevel(level)
+    try:
+        yield handler
+    finally:
+        root.handlers = handlers
+        root.setLevel(old_level)
+        handler.close()
+
+
+def enable(jsonl_fn=None, profile_dir=None, trace_memory=False, **context):
+    ''' Turn on stage records for this process
+            jsonl_fn appends one JSON line per stage, profile_dir saves a cProfile file per stage
+            and trace_memory adds the Python allocation peak of each stage (slows things down).
+            context values (sensor name, run id...) are added to every record
+    '''
+
+    _STATE.update(enabled=True, jsonl_fn=jsonl_fn, profile_dir=profile_dir, trace_memory=trace_memory,
+                  context=context)
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    ''' Turn stage records off again
+    '''
+
+    _STATE['enabled'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def enabled():
+    ''' Whether stage records are on, for callers that compute extra record fields
+    '''
+
+    return _STATE['enabled']
+
+
+def memory_status():
+    ''' Current and peak resident set size of this process in MB from /proc, (None, None) elsewhere
+    '''
+
+    try:
+        with open(PROC_STATUS) as f:
+            status = dict(line.split(':', 1) for line in f if line.startswith(('VmRSS', 'VmHWM')))
+    except OSError:
+        return None, None
+
+    return tuple(int(status[key].split()[0])/1024 if key in status else None for key in ['VmRSS', 'VmHWM'])
+
+
+def reset_peak_rss():
+    ''' Reset this process's peak RSS to the current RSS, False where that isn't possible
+    '''
+
+    try:
+        with open(PROC_CLEAR_REFS, 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+
+    return True
+
+
+def _fold_peak_rss():
+    ''' Fold the peak RSS since the last reset into every open stage then reset it, hold _LOCK
+            Every open stage, in any thread, sees the process peak while it was open
+    '''
+
+    _, peak = memory_status()
+    for record in _OPEN:
+        if peak is not None and record['stage_peak_rss_mb'] is not None:
+            record['stage_peak_rss_mb'] = max(record['stage_peak_rss_mb'], peak)
+
+    return reset_peak_rss()
+
+
+def stage(name, rows_in=None):
+    ''' Context manager timing one pipeline stage, yields a record dictionary
+            Set record['rows_out'] inside the block. When instrumentation is off this is a null
+            context yielding a throwaway dictionary, so the only cost is the call itself
+    '''
+
+    if not _STATE['enabled']:
+        return contextlib.nullcontext({})
+
+    return _record_stage(name, rows_in)
+
+
+@contextlib.contextmanager
+def _record_stage(name, rows_in):
+    ''' Wall time, CPU time, rows and memory of the block, emitted when it exits
+    '''
+
+    depth = getattr(_THREAD, 'depth', 0)
+    record = {'stage':name, **_STATE['context'], 'rows_in':rows_in, 'rows_out':None, 'depth':depth}
+
+    ## Only the outermost stage of a thread is profiled, cProfile can't nest
+    profiler = None
+    if _STATE['profile_dir'] is not None and depth == 0:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if _STATE['trace_memory']:
+        tracemalloc.reset_peak()
+
+    ## RSS at entry and exit, and the peak RSS while the stage was open where it can be reset
+    with _LOCK:
+        record['rss_start_mb'], _ = memory_status()
+        record['stage_peak_rss_mb'] = record['rss_start_mb'] if _fold_peak_rss() else None
+        _OPEN.append(record)
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    _THREAD.depth = depth+1
+    try:
+        yield record
+    finally:
+        _THREAD.depth = depth
+        record['wall_s'] = time.perf_counter()-wall
+        record['cpu_s'] = time.process_time()-cpu
+        with _LOCK:
+            _fold_peak_rss()
+            _OPEN[:] = [other for other in _OPEN if other is not record]
+        record['rss_end_mb'], _ = memory_status()
+        record['rss_delta_mb'] = None if None in (record['rss_start_mb'], record['rss_end_mb']) else \
+            record['rss_end_mb']-record['rss_start_mb']
+        if _STATE['trace_memory']:
+            record['py_peak_mb'] = tracemalloc.get_traced_memory()[1]/1024**2
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(_STATE['profile_dir'], f'{name}_{os.getpid()}_{len(RECORDS)}.prof'))
+
+        emit(record)
+
+
+def emit(record):
+    ''' Keep a stage record and append it to the JSON lines file
+    '''
+
+    record = {'time':time.strftime('%Y-%m-%d %H:%M:%S'), 'pid':os.getpid(), **record}
+    RECORDS.append(record)
+    log.debug('%s took %.3f s wall, %.3f s CPU', record['stage'], record['wall_s'], record['cpu_s'])
+
+    if _STATE['jsonl_fn'] is not None:
+        with open(_STATE['jsonl_fn'], 'a') as f:
+            f.write(json.dumps(record, default=str)+'\n')
+
+
+def instrumented(name=None, rows=None):
+    ''' Decorator version of stage, called with the function's result and arguments rows gives
+            the rows out, e.g. rows=lambda result, self, *args: len(self.df) for a method
+    '''
+
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _STATE['enabled']:
+                return func(*args, **kwargs)
+
+            with _record_stage(stage_name, None) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    record['rows_out'] = rows(result, *args, **kwargs)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def load_records(jsonl_fn):
+    ''' Read stage records back from a JSON lines file
+    '''
+
+    return pd.read_json(jsonl_fn, lines=True)
+
+
+def summary_table(records=None):
+    ''' Calls, total wall and CPU time, rows, peak RSS and largest RSS growth per stage, slowest first
+            records is a dataframe from load_records, or this process's records by default
+    '''
+
+    records = pd.DataFrame(RECORDS) if records is None else records
+    if len(records) == 0:
+        return pd.DataFrame()
+
+    summary = records.groupby('stage').agg(calls=('stage', 'size'), wall_s=('wall_s', 'sum'),
+                                           cpu_s=('cpu_s', 'sum'), rows_in=('rows_in', 'sum'),
+                                           rows_out=('rows_out', 'sum'))
+    for col in ['stage_peak_rss_mb', 'rss_delta_mb']:
+        if col in records:
+            summary[col] = records.groupby('stage')[col].max()
+
+    return summary.sort_values(by='wall_s', ascending=False)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import logging
+import argparse
+import aiohttp
+import numpy as np
+import pandas as pd
+
+from get_purply import API_URL
+from purple_downloader import RETRY_STATUS, parse_retry_after
+from purple_schema import profile_fields
+from correction_models import apply_models
+from correct_purple_pm25 import QCMask, ab_difference_qc, TEMPERATURE_MAX, HUMIDITY_MAX
+from calibration_registry import get_registry
+from instrumentation import stage, setup_logging
+
+
+log = logging.getLogger(__name__)
+
+## Fields requested from the current data endpoints (purple_schema)
+LIVE_FIELDS = profile_fields('live')
+
+## Most sensors the /sensors endpoint is asked for at once
+BATCH_SIZE = 100
+
+## Hours of readings kept and used by the NowCast
+NOWCAST_HOURS = 12
+
+## PM2.5 AQI breakpoints (2024): concentration low, high, index low, high
+AQI_BREAKPOINTS = np.array([[0.0, 9.0, 0, 50], [9.1, 35.4, 51, 100], [35.5, 55.4, 101, 150],
+                            [55.5, 125.4, 151, 200], [125.5, 225.4, 201, 300], [225.5, 325.4, 301, 500]])
+
+AQI_CATEGORIES = ['Good', 'Moderate', 'Unhealthy for Sensitive Groups', 'Unhealthy', 'Very Unhealthy',
+                  'Hazardous']
+
+
+def nowcast(hourly):
+    ''' EPA PM NowCast for every row of a sensors x hours array of hourly means, most recent first
+            NaN hours are skipped, rows without 2 of the 3 most recent hours get NaN
+    '''
+
+    valid = ~np.isnan(hourly)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c_max = np.where(valid, hourly, -np.inf).max(axis=1)
+        c_min = np.where(valid, hourly, np.inf).min(axis=1)
+        weight = np.clip(np.where(c_max > 0, c_min/c_max, 1.), 0.5, 1.)
+
+    powers = np.where(valid, weight[:, None]**np.arange(hourly.shape[1]), 0.)
+    with np.errstate(invalid='ignore'):
+        values = (powers*np.nan_to_num(hourly)).sum(axis=1)/powers.sum(axis=1)
+
+    return np.where(valid[:, :3].sum(axis=1) >= 2, values, np.nan)
+
+
+def aqi(pm25):
+    ''' PM2.5 AQI and category index (0 Good ... 5 Hazardous) of concentrations, NaN / -1 if missing
+            Concentrations are truncated to 0.1 µg/m³ and capped at the top of the scale
+    '''
+
+    conc = np.clip(np.floor(np.asarray(pm25, dtype=float)*10.)/10., 0., AQI_BREAKPOINTS[-1, 1])
+    category = np.clip(np.searchsorted(AQI_BREAKPOINTS[:, 1], conc), 0, len(AQI_BREAKPOINTS)-1)
+
+    c_low, c_high, i_low, i_high = AQI_BREAKPOINTS[category].T
+    index = np.round((i_high-i_low)/(c_high-c_low)*(conc-c_low)+i_low)
+
+    missing = np.isnan(conc)
+    return np.where(missing, np.nan, index), np.where(missing, -1, category)
+
+
+class RingBuffer():
+    ''' Recent corrected readings of every sensor in one sensors x capacity array
+            Each sensor writes over its own oldest reading, so memory is fixed however long the
+            monitor runs and all sensors are updated and averaged in single NumPy calls
+    '''
+    def __init__(self, n_sensors, capacity):
+        self.capacity = capacity
+        self.times = np.full((n_sensors, capacity), -1, dtype=np.int64)
+        self.values = np.full((n_sensors, capacity), np.nan)
+        self.head = np.zeros(n_sensors, dtype=np.int64)
+        self.last = np.full(n_sensors, -1, dtype=np.int64)
+
+
+    def append(self, rows, times, values):
+        ''' Add one reading per sensor row, readings already seen (same time) are skipped
+                Returns the rows that took a new reading
+        '''
+
+        new = times > self.last[rows]
+        rows, times, values = rows[new], times[new], values[new]
+
+        self.times[rows, self.head[rows]] = times
+        self.values[rows, self.head[rows]] = values
+        self.head[rows] = (self.head[rows]+1) % self.capacity
+        self.last[rows] = times
+
+        return rows
+
+
+    def hourly_means(self, now, hours=NOWCAST_HOURS, min_count=1):
+        ''' Sensors x hours array of clock hour means, the last completed hour first
+                The current hour is still filling and is left out. Hours with fewer than min_count
+                readings are NaN
+        '''
+
+        n_sensors = len(self.head)
+        hours_ago = (now//3600-1)-self.times//3600
+        use = (self.times >= 0) & (hours_ago >= 0) & (hours_ago < hours) & ~np.isnan(self.values)
+
+        bins = (np.arange(n_sensors)[:, None]*hours+hours_ago)[use]
+        sums = np.bincount(bins, self.values[use], minlength=n_sensors*hours).reshape(n_sensors, hours)
+        counts = np.bincount(bins, minlength=n_sensors*hours).reshape(n_sensors, hours)
+
+        with np.errstate(invalid='ignore'):
+            return np.where(counts >= min_count, sums/counts, np.nan)
+
+
+def live_qc(data):
+    ''' Met and A/B channel rules for single current readings, returns the rows to keep
+            The batch pipeline's percent difference threshold needs a history, here it is fixed
+    '''
+
+    pm25_a = data['pm2.5_cf_1_a'].to_numpy(dtype=float)
+    pm25_b = data['pm2.5_cf_1_b'].to_numpy(dtype=float)
+
+    qc = QCMask(len(data))
+    qc.apply('temperature', data['temperature'].to_numpy(dtype=float) >= TEMPERATURE_MAX)
+    qc.apply('humidity', data['humidity'].to_numpy(dtype=float) > HUMIDITY_MAX)
+    ab_difference_qc(qc, pm25_a, pm25_b)
+    qc.apply('missing', np.isnan(pm25_a) | np.isnan(pm25_b) | data['humidity'].isna().to_numpy())
+
+    return qc.keep
+
+
+def default_alert(sensor, old, new, row):
+    ''' Log NowCast AQI category changes
+    '''
+
+    log.warning(f"{sensor}: {AQI_CATEGORIES[old] if old >= 0 else 'no data'} -> {AQI_CATEGORIES[new]} "
+                f"(NowCast {row['nowcast']:.1f} µg/m³, AQI {row['aqi']:.0f})")
+
+
+class LiveMonitor():
+    ''' Poll current PurpleAir readings for many sensors, correct them and keep a rolling NowCast / AQI
+            sensors maps the name used in the calibration registry to the PurpleAir sensor index.
+            With a group_id the group members endpoint is used (one request for the whole network),
+            otherwise sensors are requested batch_size at a time from /sensors, or one request per
+            sensor with batch_size=None. Requests share one connection pool
+    '''
+    def __init__(self, api_read_key, sensors, group_id=None, registry_fn=None, api_url=API_URL,
+                 poll_interval=120., batch_size=BATCH_SIZE, max_connections=20, alert=default_alert):
+        self.api_read_key = api_read_key
+        self.names = [str(name) for name in sensors]
+        self.indices = [int(index) for index in sensors.values()]
+        self.rows = {index:row for row, index in enumerate(self.indices)}
+        self.group_id = group_id
+        self.registry_fn = registry_fn
+        self.api_url = api_url
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_connections = max_connections
+        self.alert = alert
+
+        ## Sensors report every 2 minutes, polling faster just repeats readings. The buffer holds
+        ## the NowCast's completed hours and the current partial one
+        self.per_hour = int(3600//max(poll_interval, 120.))
+        self.buffer = RingBuffer(len(self.indices), (NOWCAST_HOURS+1)*self.per_hour)
+        self.category = np.full(len(self.indices), -1)
+        self.status = pd.DataFrame(index=pd.Index(self.names, name='sensor'))
+
+
+    async def get_json(self, session, url, params):
+        ''' GET with the API key, waiting out rate limits and server errors
+        '''
+
+        headers = {'X-API-Key':self.api_read_key}
+        for attempt in range(4):
+            async with session.get(url, headers=headers, params=params) as r:
+                if r.status not in RETRY_STATUS or attempt == 3:
+                    r.raise_for_status()
+                    return await r.json()
+                wait = parse_retry_after(r.headers.get('Retry-After'), 2.**attempt)
+
+            log.warning(f'HTTP {r.status} from {url}, retrying in {wait:.0f} s')
+            await asyncio.sleep(wait)
+
+
+    async def fetch(self, session):
+        ''' Current readings of all sensors as a dataframe with a sensor_index column
+        '''
+
+        fields = ', '.join(LIVE_FIELDS)
+
+        if self.group_id is not None:
+            payloads = [await self.get_json(session, f'{self.api_url}/groups/{self.group_id}/members',
+                                            {'fields':fields})]
+        elif self.batch_size is not None:
+            batches = [self.indices[i:i+self.batch_size] for i in range(0, len(self.indices), self.batch_size)]
+            payloads = await asyncio.gather(*[
+                self.get_json(session, f'{self.api_url}/sensors',
+                              {'fields':fields, 'show_only':','.join(map(str, batch))})
+                for batch in batches])
+        else:
+            sensors = await asyncio.gather(*[
+                self.get_json(session, f'{self.api_url}/sensors/{index}', {'fields':fields})
+                for index in self.indices])
+            return pd.DataFrame([payload['sensor'] for payload in sensors])
+
+        return pd.concat([pd.DataFrame(payload['data'], columns=payload['fields']) for payload in payloads],
+                         ignore_index=True)
+
+
+    def correct(self, data):
+        ''' QC, EPA and DOEE correction of one poll's readings, vectorized over sensors
+        '''
+
+        data = data[data['sensor_index'].isin(self.rows)].copy()
+        data['sensor'] = [self.names[self.rows[index]] for index in data['sensor_index']]
+        data['pm2.5_ab_avg'] = (data['pm2.5_cf_1_a'].astype(float)+data['pm2.5_cf_1_b'].astype(float))/2.
+        data.loc[~live_qc(data), 'pm2.5_ab_avg'] = np.nan
+
+        apply_models([data], ['epa_2021'])
+
+        data['pm2.5_ab_epa_doee_corr'] = np.nan
+        if self.registry_fn is not None:
+            registry = get_registry(self.registry_fn)
+            times = pd.to_datetime(data['last_seen'], unit='s', utc=True)
+            for sensor, rows in data.groupby('sensor').groups.items():
+                try:
+                    slope, intercept = registry.get_factors(sensor, times[rows])
+                except KeyError:
+                    continue
+                data.loc[rows, 'pm2.5_ab_epa_doee_corr'] = (data.loc[rows, 'pm2.5_ab_epa_corr']-intercept)/slope
+
+        return data
+
+
+    def update(self, data, now=None):
+        ''' Add a poll's corrected readings to the ring buffer, refresh the NowCast / AQI status
+                and raise alerts for sensors whose AQI category changed. Returns the status
+        '''
+
+        now = int(time.time()) if now is None else now
+
+        with stage('live_update', rows_in=len(data)) as record:
+            data = self.correct(data)
+
+            ## DOEE corrected values where the sensor has factors, EPA corrected otherwise
+            values = data['pm2.5_ab_epa_doee_corr'].fillna(data['pm2.5_ab_epa_corr']).to_numpy()
+            rows = np.array([self.rows[index] for index in data['sensor_index']], dtype=np.int64)
+            self.buffer.append(rows, data['last_seen'].to_numpy(dtype=np.int64), values)
+
+            hourly = self.buffer.hourly_means(now, min_count=max(1, int(0.75*self.per_hour)))
+            pm_nowcast = nowcast(hourly)
+            aqi_value, category = aqi(pm_nowcast)
+
+            ## Sensors missing from this poll keep their last reading
+            latest = data.set_index('sensor')
+            for column, source in [('last_seen', 'last_seen'), ('pm25_epa', 'pm2.5_ab_epa_corr'),
+                                   ('pm25_doee', 'pm2.5_ab_epa_doee_corr')]:
+                self.status.loc[latest.index, column] = latest[source]
+            self.status['nowcast'] = pm_nowcast
+            self.status['aqi'] = aqi_value
+            self.status['category'] = [AQI_CATEGORIES[cat] if cat >= 0 else None for cat in category]
+            record['rows_out'] = len(data)
+
+        changed = np.flatnonzero((category != self.category) & (category >= 0))
+        for row in changed:
+            self.alert(self.names[row], self.category[row], category[row], self.status.iloc[row])
+        self.category = category
+
+        return self.status
+
+
+    async def poll_once(self, session):
+        ''' Fetch and process one round of readings
+        '''
+
+        with stage('live_fetch') as record:
+            data = await self.fetch(session)
+            record['rows_out'] = len(data)
+
+        return self.update(data)
+
+
+    async def run(self, n_polls=None):
+        ''' Poll every poll_interval seconds, forever or n_polls times
+                A failed poll is logged and the next one still runs
+        '''
+
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        timeout = aiohttp.ClientTimeout(total=max(30., self.poll_interval/2.))
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            n_done = 0
+            while n_polls is None or n_done < n_polls:
+                started = time.monotonic()
+                try:
+                    await self.poll_once(session)
+                    log.info(f'Polled {len(self.indices)} sensors in {time.monotonic()-started:.2f} s')
+                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as err:
+                    log.error(f'Poll failed ({type(err).__name__}: {err})')
+                n_done += 1
+
+                if n_polls is None or n_done < n_polls:
+                    await asyncio.sleep(max(0., self.poll_interval-(time.monotonic()-started)))
+
+        return self.status
+
+
+if __name__ == '__main__':
+
+    from run_correct_purple import SENSORS
+
+    parser = argparse.ArgumentParser(description='Live PurpleAir NowCast / AQI monitor')
+    parser.add_argument('api_read_key')
+    parser.add_argument('--registry', default=None, help='calibration registry CSV for the DOEE correction')
+    parser.add_argument('--group', type=int, default=None, help='PurpleAir group id holding the sensors')
+    parser.add_argument('--api-url', default=API_URL, help='API base URL, e.g. a local stub server')
+    parser.add_argument('--interval', type=float, default=120., help='seconds between polls')
+    parser.add_argument('--polls', type=int, default=None, help='stop after this many polls')
+    args = parser.parse_args()
+
+    setup_logging()
+    monitor = LiveMonitor(args.api_read_key, SENSORS, group_id=args.group, registry_fn=args.registry,
+                          api_url=args.api_url, poll_interval=args.interval)
+    status = asyncio.run(monitor.run(args.polls))
+    print(status.to_string())
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+
+from hourly_grid import hourly_table, regression_from_sums
+from correct_purple_pm25 import TIME_ZONES, AB_DIFF_MAX
+from run_correct_purple import SENSORS, get_files
+from instrumentation import stage, setup_logging
+
+
+log = logging.getLogger(__name__)
+
+## Rolling window of the network statistics
+WINDOW_HOURS = 30*24
+
+## Fewest shared hours for a pair (or a sensor's A/B channels) to be used
+MIN_COUNT = 72
+
+## Drift limits against the median of a sensor's neighbours
+CORR_MIN = 0.8
+BIAS_MAX = 3.
+
+## A/B channel limits, mean hourly |A-B| (µg/m³) and its trend (µg/m³ per day)
+AB_TREND_MAX = 0.1
+
+FLAGS = ['low_correlation', 'neighbour_bias', 'ab_divergence', 'ab_drift']
+
+HOUR = pd.Timedelta(hours=1)
+EPOCH = pd.Timestamp('1970-01-01')
+
+
+def hour_numbers(times):
+    ''' Hours since 1970 of naive UTC times
+    '''
+
+    return np.asarray((pd.DatetimeIndex(times)-EPOCH)//HOUR, dtype=np.int64)
+
+
+def pair_sums(values):
+    ''' Sums over hours of every sensor pair, from an hours x sensors array with NaN where missing
+            Entry [i, j] only uses hours where both i and j have data: n, sx = sum of i,
+            sxx = sum of i squared and sxy = sum of i times j. Sums of j are the transposes
+    '''
+
+    valid = ~np.isnan(values)
+    x = np.where(valid, values, 0.)
+    v = valid.astype(float)
+
+    return {'n':v.T @ v, 'sx':x.T @ v, 'sxx':(x*x).T @ v, 'sxy':x.T @ x}
+
+
+def trend_sums(t, values):
+    ''' Per sensor sums for the regression of values on hour t, NaN values are left out
+    '''
+
+    valid = ~np.isnan(values)
+    y = np.where(valid, values, 0.)
+    t = np.where(valid, t[:, None], 0.)
+
+    return {'n':valid.sum(axis=0).astype(float), 'sx':t.sum(axis=0), 'sy':y.sum(axis=0),
+            'sxx':(t*t).sum(axis=0), 'syy':(y*y).sum(axis=0), 'sxy':(t*y).sum(axis=0)}
+
+
+def default_alert(sensor, flag, row):
+    ''' Log a sensor drifting from its neighbours or its A/B channels diverging
+    '''
+
+    log.warning(f"{sensor}: {flag} (r {row['r_median']:.2f} and bias {row['bias_median']:+.1f} µg/m³ against "
+                f"{row['neighbours']:.0f} neighbours, A/B |difference| {row['ab_diff']:.1f} µg/m³ "
+                f"trending {row['ab_trend']:+.2f} µg/m³/day)")
+
+
+class NetworkConsistency():
+    ''' Rolling inter-sensor consistency and A/B channel checks for a whole network of sensors
+            Corrected hourly PM2.5 and A/B channel means are added as they arrive. Running sums over
+            the last window_hours give every pair's correlation, bias (sensor minus neighbour) and
+            slope, and each sensor's A/B divergence and its trend. An update costs
+            O(sensors² x new hours): new hours are added and the hours leaving the window, kept in a
+            ring buffer, are subtracted. The sums are rebuilt from the buffer once per window so
+            rounding can't build up. neighbours is an optional sensors x sensors boolean matrix of
+            the pairs to compare, every pair by default
+    '''
+    def __init__(self, sensors, window_hours=WINDOW_HOURS, min_count=MIN_COUNT, corr_min=CORR_MIN,
+                 bias_max=BIAS_MAX, ab_diff_max=AB_DIFF_MAX, ab_trend_max=AB_TREND_MAX, neighbours=None,
+                 alert=default_alert):
+        self.sensors = [str(sensor) for sensor in sensors]
+        self.window = window_hours
+        self.min_count = min_count
+        self.corr_min = corr_min
+        self.bias_max = bias_max
+        self.ab_diff_max = ab_diff_max
+        self.ab_trend_max = ab_trend_max
+        self.alert = alert
+
+        n_sensors = len(self.sensors)
+        self.neighbours = np.ones((n_sensors, n_sensors), dtype=bool) if neighbours is None else np.asarray(neighbours)
+        self.neighbours = self.neighbours & ~np.eye(n_sensors, dtype=bool)
+
+        ## Ring buffer of the window, slot = hour % window_hours
+        self.slot_hour = np.full(window_hours, -1, dtype=np.int64)
+        self.pm25 = np.full((window_hours, n_sensors), np.nan)
+        self.ab_diff = np.full((window_hours, n_sensors), np.nan)
+        self.last_hour = -1
+        self.since_rebuild = 0
+
+        self.flags = pd.DataFrame(False, index=pd.Index(self.sensors, name='sensor'), columns=FLAGS)
+        self.rebuild()
+
+
+    def rebuild(self):
+        ''' Recompute the running sums from the ring buffer
+                Trend hours are counted from the start of the window to keep the sums small
+        '''
+
+        used = self.slot_hour >= 0
+        self.origin = self.last_hour-self.window+1
+        self.pair = pair_sums(self.pm25[used])
+        self.trend = trend_sums((self.slot_hour[used]-self.origin).astype(float), self.ab_diff[used])
+        self.since_rebuild = 0
+
+
+    def add_sums(self, hours, pm25, ab_diff, sign):
+        ''' Add (sign 1) or remove (sign -1) hours from the running sums
+        '''
+
+        for name, sums in pair_sums(pm25).items():
+            self.pair[name] += sign*sums
+        for name, sums in trend_sums((hours-self.origin).astype(float), ab_diff).items():
+            self.trend[name] += sign*sums
+
+
+    def update(self, times, pm25, pm25_a, pm25_b):
+        ''' Add hourly data, hours x sensors arrays in self.sensors order with NaN where missing
+                times are naive UTC hours in increasing order. Hours at or before the last update are
+                skipped. Raises alerts for newly set flags and returns the sensor summary
+        '''
+
+        hours = hour_numbers(times)
+        new = hours > self.last_hour
+        hours = hours[new]
+        pm25 = np.asarray(pm25, dtype=float)[new]
+        ab_diff = np.abs(np.asarray(pm25_a, dtype=float)-np.asarray(pm25_b, dtype=float))[new]
+
+        with stage('network_update', rows_in=pm25.size) as record:
+            if len(hours) != 0:
+                ## Every hour since the last update, skipped hours also push old hours out of the window
+                first = hours[0] if self.last_hour < 0 else self.last_hour+1
+                span = np.arange(max(first, hours[-1]-self.window+1), hours[-1]+1)
+                span_pm25 = np.full((len(span), len(self.sensors)), np.nan)
+                span_ab = np.full((len(span), len(self.sensors)), np.nan)
+                keep = hours >= span[0]
+                span_pm25[hours[keep]-span[0]] = pm25[keep]
+                span_ab[hours[keep]-span[0]] = ab_diff[keep]
+
+                slots = span % self.window
+                old = slots[self.slot_hour[slots] >= 0]
+                incremental = self.last_hour >= 0 and self.since_rebuild+len(span) < self.window
+                if incremental:
+                    self.add_sums(self.slot_hour[old], self.pm25[old], self.ab_diff[old], -1)
+
+                self.slot_hour[slots] = span
+                self.pm25[slots] = span_pm25
+                self.ab_diff[slots] = span_ab
+                self.last_hour = span[-1]
+
+                if incremental:
+                    self.add_sums(span, span_pm25, span_ab, 1)
+                    self.since_rebuild += len(span)
+                else:
+                    self.rebuild()
+
+            summary = self.sensor_stats()
+            record['rows_out'] = len(summary)
+
+        self.raise_alerts(summary)
+
+        return summary
+
+
+    def update_frames(self, hour_dfs, value_col='pm2.5_ab_epa_corr', time_col='datetime_utc'):
+        ''' Add CorrectPurpleAir hourly outputs, a dictionary of sensor -> dataframe
+                Sensors not in the network are ignored and missing ones count as missing hours
+        '''
+
+        columns = {}
+        for col in [value_col, 'pm2.5_filt_a', 'pm2.5_filt_b']:
+            for sensor in self.sensors:
+                df = hour_dfs.get(sensor)
+                columns[(col, sensor)] = (pd.DatetimeIndex([]), []) if df is None else (df[time_col], df[col])
+
+        ## Columns are the value, then A, then B of every sensor
+        table = hourly_table(columns, time_col)
+        pm25, pm25_a, pm25_b = np.split(table.values, 3, axis=1)
+
+        return self.update(table.grid, pm25, pm25_a, pm25_b)
+
+
+    def pair_matrices(self):
+        ''' Sensors x sensors correlation, bias (sensor minus neighbour, µg/m³) and slope (sensor on
+                neighbour) from the running sums, and the mask of neighbouring pairs with enough hours
+        '''
+
+        sums = self.pair
+        slope, _, r_squared, _ = regression_from_sums(sums['n'], sums['sx'].T, sums['sx'], sums['sxx'].T,
+                                                      sums['sxx'], sums['sxy'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.sign(slope)*np.sqrt(r_squared)
+            bias = (sums['sx']-sums['sx'].T)/sums['n']
+
+        return corr, bias, slope, self.neighbours & (sums['n'] >= self.min_count)
+
+
+    def pair_stats(self):
+        ''' Correlation, bias and slope of every neighbouring pair with at least min_count shared hours
+        '''
+
+        corr, bias, slope, use = self.pair_matrices()
+        i, j = np.nonzero(use)
+
+        return pd.DataFrame({'sensor':np.asarray(self.sensors)[i], 'neighbour':np.asarray(self.sensors)[j],
+                             'n':self.pair['n'][i, j].astype(int), 'r':corr[i, j], 'bias':bias[i, j],
+                             'slope':slope[i, j]})
+
+
+    def sensor_stats(self):
+        ''' One row per sensor: hours and mean PM2.5 in the window, the median correlation and bias
+                against its neighbours, mean A/B |difference| and its trend, and the drift flags
+        '''
+
+        sums = self.pair
+        corr, bias, _, use = self.pair_matrices()
+
+        ## Medians so one drifting neighbour doesn't flag the sensors it is compared with
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            corr = np.where(use, corr, np.nan)
+            bias = np.where(use, bias, np.nan)
+
+            summary = pd.DataFrame({'hours':np.diag(sums['n']).astype(int),
+                                    'pm25_mean':np.diag(sums['sx'])/np.diag(sums['n']),
+                                    'neighbours':use.sum(axis=1),
+                                    'r_median':np.nanmedian(corr, axis=1),
+                                    'bias_median':np.nanmedian(bias, axis=1)},
+                                   index=pd.Index(self.sensors, name='sensor'))
+
+            trend = self.trend
+            ab_slope, _, _, _ = regression_from_sums(**trend)
+            ab_used = trend['n'] >= self.min_count
+            summary['ab_diff'] = np.where(ab_used, trend['sy']/trend['n'], np.nan)
+            summary['ab_trend'] = np.where(ab_used, ab_slope*24., np.nan)
+
+        summary['low_correlation'] = summary['r_median'] < self.corr_min
+        summary['neighbour_bias'] = summary['bias_median'].abs() > self.bias_max
+        summary['ab_divergence'] = summary['ab_diff'] > self.ab_diff_max
+        summary['ab_drift'] = summary['ab_trend'] > self.ab_trend_max
+
+        return summary
+
+
+    def raise_alerts(self, summary):
+        ''' Alert on flags that were not set at the last update
+        '''
+
+        flags = summary[FLAGS]
+        raised = (flags & ~self.flags).stack()
+        cleared = (~flags & self.flags).stack()
+        for sensor, flag in raised.index[raised.to_numpy()]:
+            self.alert(sensor, flag, summary.loc[sensor])
+        for sensor, flag in cleared.index[cleared.to_numpy()]:
+            log.info(f'{sensor}: {flag} cleared')
+
+        self.flags = flags
+
+
+def load_hour_frames(base_path, sensors, folder, start_date, end_date, tz='utc'):
+    ''' Read run_correct_purple's hourly outputs (base_path/<sensor>/<folder>/hour_<tz>)
+            Eastern times are converted to naive UTC, hours repeated or skipped by DST are dropped.
+            Returns a dictionary of sensor -> dataframe with a datetime_utc column
+    '''
+
+    hour_dfs = {}
+    for sensor in sensors:
+        in_path = os.path.join(base_path, sensor, folder, f'hour_{tz}')
+        files = get_files(in_path, start_date, end_date, SENSORS[sensor]) if os.path.isdir(in_path) else []
+        if len(files) == 0:
+            log.warning(f'No hourly files for {sensor} in {in_path}')
+            continue
+
+        hour_df = pd.concat([pd.read_csv(fn) for fn in files], ignore_index=True)
+        times = pd.to_datetime(hour_df[f'datetime_{tz}'])
+        if tz != 'utc':
+            times = times.dt.tz_localize(TIME_ZONES[f'datetime_{tz}'], ambiguous='NaT', nonexistent='NaT')
+            times = times.dt.tz_convert('UTC').dt.tz_localize(None)
+        hour_dfs[sensor] = hour_df.assign(datetime_utc=times).dropna(subset=['datetime_utc'])
+
+    return hour_dfs
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Rolling inter-sensor consistency and A/B checks of corrected PurpleAir data')
+    parser.add_argument('base_path', help='folder holding one sub folder per sensor')
+    parser.add_argument('--sensors', nargs='+', default=list(SENSORS), help='sensor names')
+    parser.add_argument('--start', default='2023-04-15', help='first day, YYYY-MM-DD')
+    parser.add_argument('--end', default='2024-02-29', help='last day, YYYY-MM-DD')
+    parser.add_argument('--folder', default='epa_doee_correction', help='run_correct_purple output folder name')
+    parser.add_argument('--tz', default='et', choices=['et', 'utc'])
+    parser.add_argument('--window', type=int, default=WINDOW_HOURS, help='rolling window in hours')
+    parser.add_argument('--value', default='pm2.5_ab_epa_corr', help='hourly PM2.5 column to compare')
+    args = parser.parse_args()
+
+    setup_logging()
+    hour_dfs = load_hour_frames(args.base_path, args.sensors, args.folder, args.start, args.end, args.tz)
+
+    ## Replay the period a day at a time, as the hourly runs would see it
+    network = NetworkConsistency(args.sensors, window_hours=args.window)
+    for day in pd.date_range(args.start, args.end, freq='D'):
+        day_dfs = {sensor:df[(df['datetime_utc'] >= day) & (df['datetime_utc'] < day+pd.Timedelta(days=1))]
+                   for sensor, df in hour_dfs.items()}
+        summary = network.update_frames(day_dfs, args.value)
+
+    print(summary.to_string())
+    print(network.pair_stats().to_string())
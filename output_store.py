@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import pandas as pd
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_times(df, time_var):
+    ''' Move time_var to the first column and format it as a string in one vectorized call
+    '''
+
+    df = df.reset_index() if time_var not in df.columns else df.copy()
+    df[time_var] = df[time_var].dt.strftime(DATE_FORMAT)
+
+    return df[[time_var] + [col for col in df.columns if col != time_var]]
+
+
+def read_header_and_last_line(fn, block_size=4096):
+    ''' Read the first and last lines of a text file without reading what's in between
+    '''
+
+    with open(fn, 'rb') as f:
+        header = f.readline().decode().rstrip('\r\n')
+
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        tail = b''
+        while pos > 0 and tail.rstrip(b'\r\n').count(b'\n') == 0:
+            pos = max(0, pos-block_size)
+            f.seek(pos)
+            tail = f.read(end-pos)
+
+    last_line = tail.rstrip(b'\r\n').split(b'\n')[-1].decode().rstrip('\r')
+
+    return header, last_line
+
+
+def line_key(line):
+    ''' Key of a CSV line, the first field
+    '''
+
+    return line.split(',', 1)[0]
+
+
+def upsert_csv(new_df, out_fn, time_var):
+    ''' Insert or update rows of a CSV keyed and sorted on its first column, time_var
+            Rows after the end of the file are appended without reading the rest of it.
+            Overlapping rows replace the old ones and the file is only rewritten if something changed.
+            Returns the number of new or changed rows written
+    '''
+
+    new_df = format_times(new_df, time_var)
+    new_df = new_df.drop_duplicates(subset=[time_var], keep='last').sort_values(by=[time_var])
+    if len(new_df) == 0:
+        return 0
+
+    new_lines = new_df.to_csv(index=False).splitlines()
+    header, new_lines = new_lines[0], new_lines[1:]
+
+    if not os.path.exists(out_fn):
+        with open(out_fn, 'w') as f:
+            f.write('\n'.join([header] + new_lines) + '\n')
+        return len(new_lines)
+
+    old_header, last_line = read_header_and_last_line(out_fn)
+
+    ## Columns changed, fall back on merging through pandas
+    if old_header != header:
+        old_df = pd.read_csv(out_fn, dtype={time_var:str}, float_precision='round_trip')
+        merged_df = pd.concat([old_df, new_df], ignore_index=True)
+        merged_df = merged_df.drop_duplicates(subset=[time_var], keep='last').sort_values(by=[time_var])
+        merged_df.to_csv(out_fn, index=False)
+        return len(new_lines)
+
+    ## Only new times, append
+    if last_line == old_header or line_key(new_lines[0]) > line_key(last_line):
+        with open(out_fn, 'a') as f:
+            f.write('\n'.join(new_lines) + '\n')
+        return len(new_lines)
+
+    ## Reprocessed times, replace the changed rows
+    with open(out_fn) as f:
+        old_lines = f.read().splitlines()[1:]
+
+    merged = {line_key(line):line for line in old_lines}
+    changed = [line for line in new_lines if merged.get(line_key(line)) != line]
+    if len(changed) == 0:
+        return 0
+
+    merged.update({line_key(line):line for line in changed})
+    with open(f'{out_fn}.tmp', 'w') as f:
+        f.write('\n'.join([header] + [merged[key] for key in sorted(merged)]) + '\n')
+    os.replace(f'{out_fn}.tmp', out_fn)
+
+    return len(changed)
+
+
+def write_if_changed(df, out_fn, index=True):
+    ''' Write a dataframe to CSV only if the file content would change
+            Returns True if the file was written
+    '''
+
+    text = df.to_csv(index=index, date_format=DATE_FORMAT)
+
+    if os.path.exists(out_fn):
+        with open(out_fn) as f:
+            if f.read() == text:
+                return False
+
+    with open(out_fn, 'w') as f:
+        f.write(text)
+
+    return True
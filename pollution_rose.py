@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+from wind_cube import WindCube, direction_sectors, plot_rose_table
+
+
+def wind_frame(tme, windd, winds):
+    ''' Put the get_windy_withit arrays in a dataframe sorted by (UTC) time
+    '''
+
+    wind_df = pd.DataFrame({'time':pd.DatetimeIndex(tme), 'windd':windd, 'winds':winds})
+
+    return wind_df.sort_values(by='time', ignore_index=True)
+
+
+def stack_sensors(pm_frames, pm_col='pm2.5_ab_epa_doee_corr', offset='30min'):
+    ''' Stack hourly means from several sensors into one long frame sorted by naive UTC time
+            pm_frames is a dictionary of sensor -> CorrectPurpleAir.avg_data_hour.
+            offset moves the hour start label to the middle of the averaging hour
+    '''
+
+    stacked = []
+    for sensor, avg_df in pm_frames.items():
+        times = avg_df.index
+        if times.tz is not None:
+            times = times.tz_convert('UTC').tz_localize(None)
+
+        stacked.append(pd.DataFrame({'sensor':sensor, 'time':times+pd.Timedelta(offset),
+                                     'pm25':avg_df[pm_col].to_numpy()}))
+
+    pm_df = pd.concat(stacked, ignore_index=True)
+    pm_df = pm_df[pm_df['pm25'].notna()]
+
+    return pm_df.sort_values(by='time', kind='stable', ignore_index=True)
+
+
+def join_wind(pm_df, wind_df, tolerance='30min'):
+    ''' Match every PM2.5 row (all sensors at once) to the nearest wind observation within tolerance
+            Rows without a wind observation close enough are dropped
+    '''
+
+    joined = pd.merge_asof(pm_df, wind_df, on='time', direction='nearest', tolerance=pd.Timedelta(tolerance))
+
+    return joined.dropna(subset=['windd', 'winds'])
+
+
+def pollution_rose_stats(joined, speed_bins=(0, 2, 4, 6), n_sectors=16, percentiles=(50, 90)):
+    ''' Mean, count and percentiles of PM2.5 per sensor, direction sector and speed bin
+            speed_bins are lower edges, the last bin is open ended
+    '''
+
+    joined = joined.assign(sector=direction_sectors(joined['windd'].to_numpy(), n_sectors),
+                           speed_bin=np.searchsorted(speed_bins, joined['winds'].to_numpy(), side='right')-1)
+    joined = joined[joined['speed_bin'] >= 0]
+
+    grouped = joined.groupby(['sensor', 'sector', 'speed_bin'])['pm25']
+    stats = grouped.agg(['count', 'mean'])
+    for pct in percentiles:
+        stats[f'p{pct}'] = grouped.quantile(pct/100.)
+
+    return stats.reset_index()
+
+
+def concentration_cube(joined, sensor, conc_bins=(0, 9, 35.5, 55.5), n_sectors=16):
+    ''' WindCube of one sensor's PM2.5 by direction sector x concentration bin x year x month x hour
+            conc_bins are lower edges in µg/m³, the last bin is open ended
+    '''
+
+    sensor_df = joined[joined['sensor'] == sensor]
+
+    return WindCube.from_records(sensor_df['time'], sensor_df['windd'].to_numpy(), sensor_df['pm25'].to_numpy(),
+                                 n_sectors, speed_edges=np.asarray(conc_bins, dtype=float))
+
+
+def plot_pollution_rose(joined, sensor, title, conc_bins=(0, 9, 35.5, 55.5), n_sectors=16, years=None, months=None,
+                        hours=None):
+    ''' Plot how often each PM2.5 range occurs with the wind from each direction
+            years, months and hours slice the rose like WindCube.select
+    '''
+
+    cube = concentration_cube(joined, sensor, conc_bins, n_sectors)
+    table, edges = cube.select(years=years, months=months, hours=hours)
+
+    return plot_rose_table(table, edges, title, units='PM2.5 (µg/m³)', cmap='plasma')
+
+
+if __name__ == '__main__':
+
+    import glob
+    import matplotlib.pyplot as plt
+    from create_windrose import get_windy_withit
+    from purple_storage import read_average_parquet
+
+    file_path = r'/Users/shaunhowe/Documents/research/eckington_aq/data/met/dca_asos/*.csv'
+    root = r'/path/to/parquet/store'
+    sensors = {'ECA_1':'156089', 'ECA_2':'156193', 'ECA_3':'156301'}
+
+    wind_df = wind_frame(*get_windy_withit(glob.glob(file_path)))
+    pm_frames = {sensor:read_average_parquet(root, sensor_id, 'hour', 'datetime_utc')
+                 for sensor, sensor_id in sensors.items()}
+
+    joined = join_wind(stack_sensors(pm_frames), wind_df)
+    print(pollution_rose_stats(joined))
+
+    plot_pollution_rose(joined, 'ECA_2', 'ECA 2 Pollution Rose')
+    plt.show()
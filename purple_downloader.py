@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import datetime
+import threading
+import email.utils
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+from get_purply import API_URL, get_hist_purple_data, parse_history, save_output_days
+from download_manifest import DownloadManifest
+from instrumentation import stage, setup_logging
+
+
+log = logging.getLogger(__name__)
+
+
+## Widest query span (days) the history endpoint accepts for each average period (minutes)
+MAX_WINDOW_DAYS = {0:2, 10:3, 30:7, 60:14, 360:90, 1440:365, 10080:1825, 44640:7300, 525600:36500}
+
+## Status codes worth retrying after backing off
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+    ''' Thread safe token bucket for spacing out PurpleAir API requests
+            rate is tokens per second, capacity is the largest burst allowed
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        ''' Block until a token is available then take it
+        '''
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                ## Refill, a pause can push the last update into the future
+                self.tokens = min(self.capacity, self.tokens + max(0., now-self.updated)*self.rate)
+                self.updated = max(now, self.updated)
+
+                if self.tokens >= 1 and now >= self.updated:
+                    self.tokens -= 1
+                    return
+
+                wait = max(self.updated-now, (1-self.tokens)/self.rate)
+
+            time.sleep(wait)
+
+
+    def pause(self, seconds):
+        ''' Empty the bucket and hold every worker for a number of seconds (e.g. from Retry-After)
+        '''
+
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic()+seconds)
+
+
+def parse_retry_after(value, default):
+    ''' Convert a Retry-After header (seconds or HTTP date) into seconds
+    '''
+
+    if value is None:
+        return default
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        retry_dt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0., retry_dt.timestamp()-time.time())
+
+
+def split_windows(start_dt, end_dt, max_days):
+    ''' Split a datetime range into consecutive windows of at most max_days
+    '''
+
+    step = datetime.timedelta(days=max_days)
+
+    windows = []
+    starttime = start_dt
+    while starttime < end_dt:
+        endtime = min(starttime+step, end_dt)
+        windows.append((starttime, endtime))
+        starttime = endtime
+
+    return windows
+
+
+def get_query_windows(start_date, end_date, average_period=0):
+    ''' Split a date range into the widest day aligned windows the API allows for average_period
+    '''
+
+    start_dt = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    end_dt = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+
+    return split_windows(start_dt, end_dt, MAX_WINDOW_DAYS[average_period])
+
+
+def make_session(pool_size):
+    ''' Create a requests session with a connection pool shared by all workers
+    '''
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def fetch_window(session, bucket, api_read_key, sensor_index, starttime, endtime, average_period=0,
+                 api_url=API_URL, max_retries=5, backoff=30., field_profile='archive'):
+    ''' Request one history window, backing off on rate limit and server errors
+    '''
+
+    for attempt in range(max_retries+1):
+        with stage('rate_limit_wait'):
+            bucket.acquire()
+        r = get_hist_purple_data(api_read_key, sensor_index, starttime, endtime, average_period,
+                                 session=session, api_url=api_url, field_profile=field_profile)
+
+        if r.status_code not in RETRY_STATUS or attempt == max_retries:
+            break
+
+        ## Hold all workers, not just this one, since the limit is per API key
+        wait = parse_retry_after(r.headers.get('Retry-After'), backoff*2**attempt)
+        log.warning(f'HTTP {r.status_code} for {sensor_index} {starttime}, retrying in {wait:.0f} s')
+        bucket.pause(wait)
+
+    r.raise_for_status()
+
+    return r
+
+
+def download_window(session, bucket, api_read_key, sensor_index, starttime, endtime, out_path,
+                    average_period=0, api_url=API_URL, max_retries=5, field_profile='archive'):
+    ''' Download one window and save it to the daily CSVs
+            Returns the per day summary from save_output_days
+    '''
+
+    r = fetch_window(session, bucket, api_read_key, sensor_index, starttime, endtime,
+                     average_period, api_url, max_retries, field_profile=field_profile)
+
+    ## Parse the body once into typed columns
+    with stage('parse_response', rows_in=len(r.content)) as record:
+        purple_df = parse_history(r.content)
+        record['rows_out'] = len(purple_df)
+
+    return save_output_days(purple_df, sensor_index, starttime, endtime, out_path)
+
+
+def download_jobs(api_read_key, jobs, out_path, average_period=0, max_workers=4, requests_per_minute=6.,
+                  burst=2, api_url=API_URL, max_retries=5, manifest=None, field_profile='archive'):
+    ''' Download a list of (sensor_index, starttime, endtime) windows concurrently
+            Returns a dictionary of window -> rows saved or the exception raised
+            When a DownloadManifest is given it is checkpointed after every window.
+            field_profile (purple_schema) picks the fields requested, 'correction' for a much smaller download
+    '''
+
+    bucket = TokenBucket(requests_per_minute/60., burst)
+    session = make_session(max_workers)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for sensor_index, starttime, endtime in jobs:
+            fut = pool.submit(download_window, session, bucket, api_read_key, sensor_index, starttime,
+                              endtime, out_path, average_period, api_url, max_retries, field_profile)
+            futures[fut] = (sensor_index, starttime, endtime)
+
+        for fut in as_completed(futures):
+            sensor_index, starttime, endtime = futures[fut]
+            try:
+                day_summary = fut.result()
+            except Exception as err:
+                results[futures[fut]] = err
+                log.error(f'FAILED {sensor_index} {starttime} to {endtime}: {err}')
+                if manifest is not None:
+                    manifest.record_failure(sensor_index, average_period, starttime, endtime)
+                    manifest.save()
+                continue
+
+            results[futures[fut]] = sum(day[1] for day in day_summary)
+            log.info(f'Saved {results[futures[fut]]} rows for {sensor_index} {starttime} to {endtime}')
+            if manifest is not None:
+                manifest.record_window(sensor_index, average_period, day_summary)
+                manifest.save()
+
+    session.close()
+
+    return results
+
+
+def download_sensors(api_read_key, sensor_indices, start_date, end_date, out_path, average_period=0,
+                     manifest=None, **kwargs):
+    ''' Download PurpleAir history for many sensors and date windows concurrently
+            With a manifest only the missing, failed or stale days are requested
+    '''
+
+    start_dt = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    end_dt = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    max_days = MAX_WINDOW_DAYS[average_period]
+
+    jobs = []
+    for sensor_index in sensor_indices:
+        if manifest is None:
+            windows = split_windows(start_dt, end_dt, max_days)
+        else:
+            windows = manifest.pending_windows(sensor_index, average_period, start_dt, end_dt, max_days)
+        jobs += [(sensor_index, starttime, endtime) for starttime, endtime in windows]
+
+    return download_jobs(api_read_key, jobs, out_path, average_period, manifest=manifest, **kwargs)
+
+
+def download_new_data(api_read_key, sensor_indices, out_path, manifest, average_period=0, **kwargs):
+    ''' Pull only the data added since the last run for each sensor in the manifest
+            Starts from the day holding the last downloaded time_stamp and runs through today
+    '''
+
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    end_dt = today+datetime.timedelta(days=1)
+    max_days = MAX_WINDOW_DAYS[average_period]
+
+    jobs = []
+    for sensor_index in sensor_indices:
+        last_time_stamp = manifest.last_time_stamp(sensor_index, average_period)
+        if last_time_stamp is None:
+            log.warning(f'No previous download for {sensor_index}, run download_sensors first')
+            continue
+
+        start_dt = datetime.datetime.combine(datetime.date.fromtimestamp(last_time_stamp), datetime.time())
+        windows = manifest.pending_windows(sensor_index, average_period, start_dt, end_dt, max_days)
+        jobs += [(sensor_index, starttime, endtime) for starttime, endtime in windows]
+
+    return download_jobs(api_read_key, jobs, out_path, average_period, manifest=manifest, **kwargs)
+
+
+if __name__ == '__main__':
+
+    setup_logging()
+    out_path = r'/path/to/output/files'
+    sensor_ids = ['144020', '156089', '156193', '156301', '175119']
+    manifest = DownloadManifest(f'{out_path}/download_manifest.csv')
+    download_sensors(my_api_read_key, sensor_ids, '2022-11-01', '2022-12-01', out_path, manifest=manifest)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+## PurpleAir field -> (in memory / storage dtype, pipeline stages that use it)
+##     archive      everything downloaded by the history query and kept in the raw CSVs / Parquet
+##     correction   CorrectPurpleAir (QC, A/B mean, EPA correction)
+##     live         live_monitor current readings
+##     diagnostics  sensor health, never used by the correction
+## Diagnostics use nullable ints since they can be missing. time_stamp stays int64, it is
+## the Parquet store's key and Unix seconds overflow int32 in 2038
+FIELDS = {'time_stamp':('int64', ('archive', 'correction')),
+          'humidity':('float32', ('archive', 'correction', 'live')),
+          'temperature':('float32', ('archive', 'correction', 'live')),
+          'pressure':('float32', ('archive',)),
+          'pressure_a':('float32', ('archive',)),
+          'pressure_b':('float32', ('archive',)),
+          'rssi':('Int16', ('archive', 'diagnostics')),
+          'uptime':('Int32', ('archive', 'diagnostics')),
+          'pa_latency':('Int32', ('archive', 'diagnostics')),
+          'memory':('Int32', ('archive', 'diagnostics'))}
+for _field in ['pm1.0_atm', 'pm1.0_cf_1', 'pm2.5_alt', 'pm2.5_atm', 'pm2.5_cf_1', 'pm10.0_atm', 'pm10.0_cf_1',
+               'scattering_coefficient', 'deciviews', 'visual_range']:
+    for _suffix in ['', '_a', '_b']:
+        FIELDS[f'{_field}{_suffix}'] = ('float32', ('archive',))
+for _field in ['pm2.5_cf_1_a', 'pm2.5_cf_1_b']:
+    FIELDS[_field] = ('float32', ('archive', 'correction', 'live'))
+
+## Only returned by the current data endpoints
+FIELDS['last_seen'] = ('int64', ('live',))
+
+## Field -> dtype of everything the history query downloads
+PURPLE_DTYPES = {field:dtype for field, (dtype, stages) in FIELDS.items() if 'archive' in stages}
+
+
+def profile_fields(profile):
+    ''' Fields a pipeline stage needs, in schema order
+    '''
+
+    fields = [field for field, (_, stages) in FIELDS.items() if profile in stages]
+    if len(fields) == 0:
+        raise KeyError(f'Unknown field profile {profile}')
+
+    return fields
+
+
+## Columns CorrectPurpleAir needs from the raw data
+CORRECTION_COLUMNS = profile_fields('correction')
+
+
+def api_fields(profile):
+    ''' The API fields parameter for a profile, time_stamp is always returned by the history query
+    '''
+
+    return ', '.join(field for field in profile_fields(profile) if field != 'time_stamp')
+
+
+def read_dtypes(columns=None):
+    ''' pd.read_csv dtypes for raw PurpleAir columns, all known fields by default
+    '''
+
+    columns = PURPLE_DTYPES if columns is None else columns
+
+    return {col:FIELDS[col][0] for col in columns if col in FIELDS}
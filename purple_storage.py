@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import glob
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from purple_schema import PURPLE_DTYPES, read_dtypes
+
+
+log = logging.getLogger(__name__)
+
+## Raw file names written by get_purply.save_output
+RAW_FILE_PATTERN = re.compile(r'^(?P<sensor>\d+)_(?P<date>\d{4}-\d{2}-\d{2})\.csv$')
+
+
+def apply_dtypes(purple_df):
+    ''' Cast PurpleAir columns to their storage dtypes, unknown columns are left alone
+    '''
+
+    dtypes = {col:dtype for col, dtype in PURPLE_DTYPES.items() if col in purple_df.columns}
+
+    return purple_df.astype(dtypes)
+
+
+def sensor_dir(root, sensor_index, resolution='raw'):
+    ''' Directory holding the year/month partitions for one sensor
+    '''
+
+    return os.path.join(root, resolution, f'sensor_index={sensor_index}')
+
+
+def write_partitions(df, out_dir, key, times_utc):
+    ''' Write a dataframe into year=YYYY/month=MM Parquet partitions
+            Rows already stored for a partition are merged and deduplicated on key
+    '''
+
+    months = times_utc.dt.year.to_numpy()*100 + times_utc.dt.month.to_numpy()
+
+    for year_month, month_df in df.groupby(months):
+        part_dir = os.path.join(out_dir, f'year={year_month//100}', f'month={year_month%100:02d}')
+        part_fn = os.path.join(part_dir, 'data.parquet')
+        os.makedirs(part_dir, exist_ok=True)
+
+        if os.path.exists(part_fn):
+            old_df = pq.read_table(part_fn).to_pandas()
+            month_df = pd.concat([old_df, month_df], ignore_index=True)
+            month_df = month_df.drop_duplicates(subset=[key], keep='last')
+
+        month_df = month_df.sort_values(by=[key])
+
+        ## Write to a temporary file first so an interrupted write never corrupts a partition
+        table = pa.Table.from_pandas(month_df, preserve_index=False)
+        pq.write_table(table, f'{part_fn}.tmp', row_group_size=8192)
+        os.replace(f'{part_fn}.tmp', part_fn)
+
+
+def write_purple_parquet(purple_df, root, sensor_index):
+    ''' Write raw PurpleAir data into the partitioned Parquet store
+    '''
+
+    purple_df = apply_dtypes(purple_df)
+    times_utc = pd.to_datetime(purple_df['time_stamp'], unit='s', utc=True)
+
+    write_partitions(purple_df, sensor_dir(root, sensor_index), 'time_stamp', times_utc)
+
+
+def write_average_parquet(avg_df, root, sensor_index, resolution):
+    ''' Write hourly or daily averaged data (datetime index) into the Parquet store
+    '''
+
+    time_var = avg_df.index.name
+    avg_df = avg_df.reset_index()
+    times_utc = avg_df[time_var].dt.tz_convert('UTC') if avg_df[time_var].dt.tz is not None \
+        else avg_df[time_var]
+
+    write_partitions(avg_df, sensor_dir(root, sensor_index, resolution), time_var, times_utc)
+
+
+def time_filter(field, field_type, start, end):
+    ''' Build a predicate on a time field, the year and month bounds let whole partitions be skipped
+            Naive start and end values are taken as UTC
+    '''
+
+    predicate = None
+    for value, is_start in [(start, True), (end, False)]:
+        if value is None:
+            continue
+
+        value = pd.Timestamp(value)
+        value = value.tz_localize('UTC') if value.tz is None else value.tz_convert('UTC')
+
+        ## time_stamp is stored as Unix seconds, averaged data as timestamps
+        bound = int(value.timestamp()) if pa.types.is_integer(field_type) else pa.scalar(value, type=field_type)
+        ## Partitions are UTC months
+        year, month = ds.field('year'), ds.field('month')
+        if is_start:
+            partitions = (year > value.year) | ((year == value.year) & (month >= value.month))
+            expr = (ds.field(field) >= bound) & partitions
+        else:
+            partitions = (year < value.year) | ((year == value.year) & (month <= value.month))
+            expr = (ds.field(field) < bound) & partitions
+
+        predicate = expr if predicate is None else predicate & expr
+
+    return predicate
+
+
+def read_parquet_store(path, field, start=None, end=None, columns=None):
+    ''' Read a sensor directory with column projection and time range pushdown
+    '''
+
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name not in ('year', 'month')]
+
+    predicate = time_filter(field, dataset.schema.field(field).type, start, end)
+    table = dataset.to_table(columns=columns, filter=predicate)
+    purple_df = table.to_pandas()
+
+    return purple_df.sort_values(by=[field], ignore_index=True)
+
+
+def read_purple_parquet(root, sensor_index, start=None, end=None, columns=None):
+    ''' Read raw PurpleAir data for a sensor between start (inclusive) and end (exclusive)
+            start and end can be anything pd.Timestamp accepts, naive values are UTC
+    '''
+
+    return read_parquet_store(sensor_dir(root, sensor_index), 'time_stamp', start, end, columns)
+
+
+def read_average_parquet(root, sensor_index, resolution, time_var, start=None, end=None, columns=None):
+    ''' Read averaged data for a sensor, returned with time_var as the index
+    '''
+
+    if columns is not None and time_var not in columns:
+        columns = [time_var] + list(columns)
+
+    avg_df = read_parquet_store(sensor_dir(root, sensor_index, resolution), time_var, start, end, columns)
+
+    return avg_df.set_index(time_var)
+
+
+def convert_csv_archive(in_path, root, sensor_index=None):
+    ''' One-off conversion of the daily {sensor_index}_{YYYY-MM-DD}.csv archive into Parquet
+            Files are converted a sensor month at a time to keep memory small
+    '''
+
+    files = {}
+    for file in sorted(glob.glob(os.path.join(in_path, '*.csv'))):
+        match = RAW_FILE_PATTERN.match(os.path.basename(file))
+        if match is None or (sensor_index is not None and match['sensor'] != str(sensor_index)):
+            continue
+        files.setdefault((match['sensor'], match['date'][:7]), []).append(file)
+
+    for (sensor, month), month_files in sorted(files.items()):
+        log.info(f'Converting {sensor} {month} ({len(month_files)} files)')
+        month_df = pd.concat([pd.read_csv(file, dtype=read_dtypes()) for file in month_files], ignore_index=True)
+        write_purple_parquet(month_df, root, sensor)
+
+
+if __name__ == '__main__':
+
+    from instrumentation import setup_logging
+    setup_logging()
+    in_path = r'/path/to/csv/files'
+    root = r'/path/to/parquet/store'
+
+    convert_csv_archive(in_path, root)
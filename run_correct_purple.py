@@ -7,163 +7,268 @@ Created on Sun Mar 03 09:11:14 2023
 """
 
 import os
-import glob
+import sys
+import logging
+import argparse
 import pandas as pd
 import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from correct_purple_pm25 import CorrectPurpleAir
+from correct_purple_pm25 import CorrectPurpleAir, TEMPERATURE_MAX, HUMIDITY_MAX, PCT_DIFF_SD
+from purple_storage import write_average_parquet
+from output_store import upsert_csv, write_if_changed
+from file_catalog import get_catalog
+from calibration_registry import get_registry
+from stage_cache import StageCache, MAX_BYTES, fingerprint, files_fingerprint
+import instrumentation
+from instrumentation import stage, log_to_file, setup_logging, load_records, summary_table
 
-def get_sensor_info(sensor_name):
+## Sensor registry, sensor name -> PurpleAir sensor index
+SENSORS = {'4_st':'144020', 'ECA_1':'156089', 'ECA_2':'156193', 'ECA_3':'156301', 'V_st':'175119'}
+
+## Output folders that apply the completeness threshold
+COMPLETE_FOLDERS = {'corrected_data_robust':0.9, 'epa_doee_correction':0.9}
+
+## Bump a stage's version when its code changes so old cached results are not reused
+STAGE_VERSIONS = {'sums':2, 'means':1}
+
+log = logging.getLogger(__name__)
+
+
+def get_sensor_info(sensor_name, registry=None):
     ''' Function to get sensor id based on sensor name
+            registry is a dictionary of sensor name -> sensor index, SENSORS by default
     '''
     
+    registry = SENSORS if registry is None else registry
+    
     #### Determine sensor ID from sensor name
-    if sensor == '4_st':
-        sensor_id = '144020'
-    elif sensor == 'ECA_1':
-        sensor_id = '156089'
-    elif sensor == 'ECA_2':
-        sensor_id = '156193'
-    elif sensor == 'ECA_3':
-        sensor_id = '156301'
-    elif sensor == 'V_st':
-        sensor_id = '175119'
-    else:
-        print('NO SENSOR ID')
-        exit()
+    if sensor_name not in registry:
+        log.error(f'NO SENSOR ID for {sensor_name}')
+        raise KeyError(f'Unknown sensor {sensor_name}')
         
-    return sensor_id
+    return registry[sensor_name]
 
-def get_files(in_path, start_date, end_date):
+def get_files(in_path, start_date, end_date, sensor_id=None, catalog_fn=None):
     ''' Find PurpleAir CSV files based on start and end date 
+            Uses a cached catalog of the directory instead of globbing every day.
+            sensor_id can be left out when the directory only holds one sensor.
+            catalog_fn keeps the catalog on disk between runs, it must be outside in_path
     '''
-    start = datetime.datetime.strptime(start_date, '%Y-%m-%d')
-    end   = datetime.datetime.strptime(end_date, '%Y-%m-%d')
-    
-    files_between = []
-    while start <= end:
-        fday = start.strftime('%Y-%m-%d')
-        file_path = os.path.join(in_path, f'*{fday}*')
-        glob_files = glob.glob(file_path)
-        if len(glob_files) == 1:
-            files_between.append(glob_files[0])
-            
-        start += datetime.timedelta(1)
+    catalog = get_catalog(in_path, catalog_fn)
+    
+    if sensor_id is None:
+        if len(catalog.sensors()) > 1:
+            raise ValueError(f'{in_path} holds several sensors {catalog.sensors()}, pass sensor_id')
+        sensor_id = catalog.sensors()[0] if len(catalog.sensors()) == 1 else None
         
-    return files_between
+    return catalog.get_files(sensor_id, start_date, end_date)
     
     
-def run_purple_air_correction(input_files, tz):
+def run_purple_air_correction(input_files, tz, complete=None, cache=None, models=('epa_2021',)):
     ''' Function to run PurpleAir PM2.6 corrections
+            With a StageCache the QC'd 15 minute sums are reused while the files and QC parameters
+            are unchanged, and the corrected means while tz, completeness and models are too
     '''
     
     #### Correct PurpleAir data
     pa = CorrectPurpleAir(input_files)
-
-    pa.load_data()
-    pa.remove_pm25_outliers()
-    pa.calculate_mean(f'datetime_{tz}', completeness=complete)
-    pa.apply_epa_correction_model(pa.avg_data_hour)
-    pa.apply_epa_correction_model(pa.avg_data_day)
+    time_var = f'datetime_{tz}'
+    
+    def run_sums():
+        pa.load_data()
+        pa.remove_pm25_outliers()
+        pa.calculate_sums()
+        log.info('QC rows rejected\n' + pa.qc.summary().to_string())
+        return {'sums':pa.sums_df}, {'interval':pa.interval, 'qc':pa.qc.counts}
+    
+    def run_means():
+        frames, meta = run_sums() if cache is None else cache.stage('sums', sums_key, run_sums)
+        pa.sums_df = frames['sums']
+        pa.set_means(pa.sums_df, pa.sums_names(), time_var, complete, ('hour', 'day'), meta['interval'])
+        pa.apply_correction_models(list(models))
+        return {'hour':pa.avg_data_hour, 'day':pa.avg_data_day}, None
+    
+    if cache is None:
+        run_means()
+        return pa
+    
+    sums_key = fingerprint(STAGE_VERSIONS['sums'], files_fingerprint(input_files), pa.mean_columns,
+                           TEMPERATURE_MAX, HUMIDITY_MAX, PCT_DIFF_SD)
+    means_key = fingerprint(STAGE_VERSIONS['means'], sums_key, tz, complete, list(models))
+    
+    frames, _ = cache.stage('means', means_key, run_means)
+    pa.avg_data = frames
+    pa.avg_data_hour, pa.avg_data_day = frames['hour'], frames['day']
     
     return pa
 
 
 def run_doee_correction(pa, in_csv, sensor_id):
-    '''
+    ''' Function to apply the DOEE correction factors valid at each time
+            in_csv is a calibration registry (or plain correction) CSV, loaded once per process
     '''
     
-    ## Read in correction factors
-    correction_df = pd.read_csv(in_csv)
-    subset_df     = correction_df[correction_df['sensor_id']==sensor_id]
+    ## Look up correction factors
+    registry = get_registry(in_csv)
     
-    slope         = subset_df['slope'].to_list()[0]
-    intercept     = subset_df['intercept'].to_list()[0]
-
     ## Apply DOEE correction
-    pa.apply_doee_correction_model(pa.avg_data_hour, intercept, slope)
-    pa.apply_doee_correction_model(pa.avg_data_day, intercept, slope)
+    n_rows = len(pa.avg_data_hour)+len(pa.avg_data_day)
+    with stage('run_doee_correction', rows_in=n_rows) as record:
+        for data_dict in [pa.avg_data_hour, pa.avg_data_day]:
+            slope, intercept = registry.get_factors(sensor_id, data_dict.index)
+            pa.apply_doee_correction_model(data_dict, intercept, slope)
+        record['rows_out'] = n_rows
     
     return pa
 
-def save_hour_csv(purple_data, out_hour_fn):
+def save_hour_csv(purple_data, out_hour_fn, sensor_id):
     ''' Function to save out hourly PM2.5 data
+            Day files whose content hasn't changed are not rewritten
     '''
     
     #### Save hourly average data
-    for day, day_df in purple_data.avg_data_hour.groupby(pd.Grouper(freq='D')):
-        print(day.date())
-        out_fn = os.path.join(out_hour_fn, f'{sensor_id}_{day.date()}.csv')
-        day_df.to_csv(out_fn, index=True, date_format='%Y-%m-%d %H:%M:%S')
+    with stage('save_hour_csv', rows_in=len(purple_data.avg_data_hour)) as record:
+        n_written = 0
+        for day, day_df in purple_data.avg_data_hour.groupby(pd.Grouper(freq='D')):
+            out_fn = os.path.join(out_hour_fn, f'{sensor_id}_{day.date()}.csv')
+            if write_if_changed(day_df, out_fn):
+                log.info(f'{day.date()} written')
+                n_written += len(day_df)
+        record['rows_out'] = n_written
 
-def save_day_csv(purple_data, out_day_fn):
+def save_day_csv(purple_data, out_day_fn, tz):
     ''' Function to save out daily PM2.5 data
+            New days are appended and reprocessed days replace the old rows
     '''
-    if os.path.exists(out_day_fn) == True:
-        in_df = pd.read_csv(out_day_fn)
     
-    purple_data.avg_data_day = purple_data.avg_data_day.reset_index()
+    with stage('save_day_csv', rows_in=len(purple_data.avg_data_day)) as record:
+        n_rows = upsert_csv(purple_data.avg_data_day, out_day_fn, f'datetime_{tz}')
+        record['rows_out'] = n_rows
+    log.info(f'{n_rows} new or changed daily means written to {out_day_fn}')
 
-    ## Fix datetimes to match with what's in CSV
-    date_day_str = []
-    for i in range(len(purple_data.avg_data_day)):
-        date_day_str.append(purple_data.avg_data_day[f'datetime_{tz}'].iloc[i].strftime('%Y-%m-%d %H:%M:%S'))
 
-    purple_data.avg_data_day.drop(columns=[f'datetime_{tz}'])
-    purple_data.avg_data_day[f'datetime_{tz}'] = date_day_str
-
-    ## Append to daily averaged file if the file exists
-    if os.path.exists(out_day_fn) == True:
-        in_df = pd.read_csv(out_day_fn)
-    
-        ## Combine old and new dataframes
-        new_day_df = in_df.append(purple_data.avg_data_day)
-
-        ## write daily acerages out to CSV
-        new_day_df.to_csv(out_day_fn, index=False, date_format='%Y-%m-%d %H:%M:%S')
+def save_parquet(purple_data, root, sensor_id):
+    ''' Function to save hourly and daily PM2.5 data into the Parquet store
+    '''
     
-    ## Create new file if the daily average file doesn't exist
-    else:
-        ## write daily acerages out to CSV
-        purple_data.avg_data_day.to_csv(out_day_fn, index=False, date_format='%Y-%m-%d %H:%M:%S')
+    write_average_parquet(purple_data.avg_data_hour, root, sensor_id, 'hour')
+    write_average_parquet(purple_data.avg_data_day, root, sensor_id, 'day')
 
 
-if __name__ == '__main__':
+def run_sensor(sensor, start_date, end_date, base_path, folder, tz, correction_fn, cache_dir=None,
+               cache_bytes=None, log_level='INFO', instrument=None, registry=None):
+    ''' Function to run load, EPA correction, DOEE correction and save for one sensor
+            Output is written to a log file next to the sensor's output. instrument is a dictionary
+            of instrumentation.enable arguments, stage timings are only recorded when it is given
+    '''
+    
+    sensor_id = get_sensor_info(sensor, registry)
+    complete = COMPLETE_FOLDERS.get(folder)
     
-    sensor = 'V_st'
-    folder = 'epa_doee_correction'
-    tz = 'et' #utc or et
+    in_path = os.path.join(base_path, sensor, 'raw_data')
+    catalog_fn = os.path.join(base_path, sensor, 'raw_data_catalog.json')
+    out_path = os.path.join(base_path, sensor, folder)
+    out_hour_fn = os.path.join(out_path, f'hour_{tz}')
+    out_day_fn = os.path.join(out_path, f'{sensor_id}_daily_mean_{tz}.csv')
+    os.makedirs(out_hour_fn, exist_ok=True)
     
-    sensor_id = get_sensor_info(sensor)
+    if instrument is not None:
+        instrumentation.enable(**instrument, sensor=sensor)
+    
+    log_fn = os.path.join(out_path, f'run_correct_purple_{tz}.log')
+    with log_to_file(log_fn, log_level), stage('run_sensor'):
+        log.info(f'#### {sensor} ({sensor_id}) {start_date} to {end_date}')
+        
+        try:
+            with stage('get_files') as record:
+                input_files = get_files(in_path, start_date, end_date, sensor_id, catalog_fn)
+                record['rows_out'] = len(input_files)
+            if len(input_files) == 0:
+                raise FileNotFoundError(f'No input files for {sensor} in {in_path}')
+            
+            cache = None if cache_dir is None else StageCache(cache_dir, cache_bytes or MAX_BYTES)
+            purple_air_dat = run_purple_air_correction(input_files, tz, complete, cache)
+            purple_air_dat = run_doee_correction(purple_air_dat, correction_fn, sensor)
+            
+            n_hour, n_day = len(purple_air_dat.avg_data_hour), len(purple_air_dat.avg_data_day)
+            save_hour_csv(purple_air_dat, out_hour_fn, sensor_id)
+            save_day_csv(purple_air_dat, out_day_fn, tz)
+        except Exception:
+            log.exception(f'{sensor} failed')
+            raise
+            
+    return n_hour, n_day
 
 
-    #### Set folder and completeness threshold
-    if folder == 'corrected_data_robust' or folder == 'epa_doee_correction':
-        complete = 0.9
-    else:
-        complete = None
-     
-    base_path = /path/to/data
-    in_path = rf'{base_path}/{sensor}/raw_data'
-    out_hour_fn = rf'{base_path}/{sensor}/{folder}/hour_{tz}'
-    out_day_fn = rf'{base_path}/{sensor}/{folder}/{sensor_id}_daily_mean_{tz}.csv'
+def run_sensors(sensors, start_date, end_date, base_path, folder, tz, correction_fn, max_workers=None,
+                cache_dir=None, cache_bytes=None, log_level='INFO', instrument=None, registry=None):
+    ''' Function to run the correction for several sensors in parallel on a process pool
+            registry is a dictionary of sensor name -> sensor index, SENSORS by default.
+            Returns a dictionary of results and a dictionary of failures
+    '''
     
-    correction_fn = r'/path/to/correction/file'
+    registry = SENSORS if registry is None else registry
+    unknown = [sensor for sensor in sensors if sensor not in registry]
+    if len(unknown) != 0:
+        raise ValueError(f'Unknown sensors: {unknown}')
+    
+    results = {}
+    failures = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(run_sensor, sensor, start_date, end_date, base_path, folder, tz,
+                               correction_fn, cache_dir, cache_bytes, log_level, instrument, registry):sensor
+                   for sensor in sensors}
+        
+        for fut in as_completed(futures):
+            sensor = futures[fut]
+            try:
+                results[sensor] = fut.result()
+                log.info(f'{sensor}: {results[sensor][0]} hourly and {results[sensor][1]} daily means saved')
+            except Exception as err:
+                failures[sensor] = err
+                log.error(f'{sensor}: FAILED ({type(err).__name__}: {err})')
     
+    #### Failure summary
+    log.info(f'{len(results)} of {len(sensors)} sensors corrected')
+    for sensor, err in failures.items():
+        log.error(f'    {sensor} failed, see its run_correct_purple_{tz}.log: {err}')
+        
+    return results, failures
+
 
-    #### Read in hourly input files
-    input_files = get_files(in_path, '2023-04-15', '2024-02-29')
+if __name__ == '__main__':
     
+    parser = argparse.ArgumentParser(description='Correct PurpleAir PM2.5 for several sensors in parallel')
+    parser.add_argument('base_path', help='folder holding one sub folder per sensor')
+    parser.add_argument('correction_fn', help='CSV of DOEE correction factors')
+    parser.add_argument('--sensors', nargs='+', default=list(SENSORS), help='sensor names to correct')
+    parser.add_argument('--start', default='2023-04-15', help='first day, YYYY-MM-DD')
+    parser.add_argument('--end', default='2024-02-29', help='last day, YYYY-MM-DD')
+    parser.add_argument('--folder', default='epa_doee_correction', help='output folder name')
+    parser.add_argument('--tz', default='et', choices=['et', 'utc'])
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    parser.add_argument('--cache', default=None, help='stage cache folder, reruns reuse unchanged stages')
+    parser.add_argument('--cache-size', type=float, default=2., help='stage cache size cap in GB')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--metrics', default=None, help='append per stage timings to this JSON lines file')
+    parser.add_argument('--profile', default=None, help='save a cProfile file per sensor in this folder')
+    parser.add_argument('--trace-memory', action='store_true', help='add tracemalloc peaks to the metrics')
+    args = parser.parse_args()
     
-    #### Function to correct PurpleAir data using epa correction
-    purple_air_dat = run_purple_air_correction(input_files, tz)
+    setup_logging(args.log_level, fmt='%(message)s')
+    instrument = None
+    if args.metrics is not None or args.profile is not None:
+        instrument = {'jsonl_fn':args.metrics, 'profile_dir':args.profile, 'trace_memory':args.trace_memory,
+                      'run':datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
     
-    #### Function to read in DC DOEE correction factors and apply to data
-    purple_air_dat = run_doee_correction(purple_air_dat, correction_fn, sensor)
+    results, failures = run_sensors(args.sensors, args.start, args.end, args.base_path, args.folder,
+                                    args.tz, args.correction_fn, max_workers=args.workers,
+                                    cache_dir=args.cache, cache_bytes=int(args.cache_size*1024**3),
+                                    log_level=args.log_level, instrument=instrument)
     
-    #### Function to save out hourly data
-    save_hour_csv(purple_air_dat, out_hour_fn)
+    if args.metrics is not None and os.path.exists(args.metrics):
+        records = load_records(args.metrics)
+        log.info('\n' + summary_table(records[records['run'] == instrument['run']]).to_string())
     
-    #### Function to save out daily data
-    save_day_csv(purple_air_dat, out_day_fn)
-
+    sys.exit(1 if len(failures) != 0 else 0)
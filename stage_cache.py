@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import pandas as pd
+
+
+log = logging.getLogger(__name__)
+
+## Default cache size cap, 2 GB
+MAX_BYTES = 2*1024**3
+
+
+def fingerprint(*parts):
+    ''' Short hash of any JSON serialisable stage inputs and parameters
+    '''
+
+    text = json.dumps(parts, sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode()).hexdigest()[:24]
+
+
+def files_fingerprint(files, content=False):
+    ''' Fingerprint of a list of input files from their size and mtime, or their bytes if content
+    '''
+
+    parts = []
+    for fn in sorted(files):
+        if content:
+            sha = hashlib.sha256()
+            with open(fn, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            parts.append((fn, sha.hexdigest()))
+        else:
+            stat = os.stat(fn)
+            parts.append((fn, stat.st_size, stat.st_mtime_ns))
+
+    return fingerprint(parts)
+
+
+class StageCache():
+    ''' On disk cache of pipeline stage results keyed by a fingerprint of their inputs
+            Each entry is a folder of Parquet frames and a meta.json. Hits touch meta.json so
+            its mtime gives the LRU order, the oldest entries are removed past max_bytes
+    '''
+    def __init__(self, cache_dir, max_bytes=MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def entry_dir(self, stage, key):
+        ''' Folder holding one cached stage result
+        '''
+
+        return os.path.join(self.cache_dir, f'{stage}-{key}')
+
+
+    def get(self, stage, key):
+        ''' Cached frames and metadata for a stage, or None on a miss
+        '''
+
+        entry = self.entry_dir(stage, key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            frames = {name:pd.read_parquet(os.path.join(entry, f'{name}.parquet')) for name in meta['frames']}
+            os.utime(os.path.join(entry, 'meta.json'))
+        except (OSError, ValueError):
+            ## Missing, half evicted or unreadable entries are misses
+            return None
+
+        return frames, meta['meta']
+
+
+    def put(self, stage, key, frames, meta=None):
+        ''' Store a dictionary of name -> dataframe and JSON metadata for a stage
+        '''
+
+        entry = self.entry_dir(stage, key)
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp_entry, exist_ok=True)
+
+        for name, frame in frames.items():
+            frame.to_parquet(os.path.join(tmp_entry, f'{name}.parquet'))
+        with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+            json.dump({'frames':list(frames), 'meta':meta}, f, default=str)
+
+        ## get missed, so whatever is there is corrupt or half written and the fresh result replaces it
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError as err:
+            ## Another process may have stored the same entry in between, theirs is kept
+            log.warning(f'Could not store cached {stage} ({key}): {err}')
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self.evict()
+
+
+    def stage(self, stage, key, run):
+        ''' Return the cached result of a stage or call run() for (frames, meta) and store it
+        '''
+
+        cached = self.get(stage, key)
+        if cached is not None:
+            log.info(f'Using cached {stage} ({key})')
+            return cached
+
+        frames, meta = run()
+        self.put(stage, key, frames, meta)
+
+        return frames, meta
+
+
+    def evict(self):
+        ''' Remove least recently used entries until the cache is under max_bytes
+        '''
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                files = list(os.scandir(entry.path))
+                size = sum(f.stat().st_size for f in files)
+                used = os.stat(os.path.join(entry.path, 'meta.json')).st_mtime_ns
+            except OSError:
+                continue
+            entries.append((used, size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for used, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import datetime
+import numpy as np
+import pandas as pd
+
+from purple_schema import profile_fields
+from get_purply import save_output_days
+
+
+## Fields the history endpoint returns after time_stamp, in the order the CSVs have them
+PURPLE_FIELDS = [field for field in profile_fields('archive') if field != 'time_stamp']
+
+## DOEE export columns and the units row under the header
+DOEE_COLUMNS = {'NEARROAD PM25LC-1022 001h':'ug/m3', 'NEARROAD BARPRESS 001h':'mmHg',
+                'NEARROAD AT_BAM25 001h':'C', 'NEARROAD RELHUM 001h':'%', 'NEARROAD WSP 001h':'m/s',
+                'NEARROAD WDR 001h':'deg'}
+
+## Default start, the range crosses the March DST change after a week
+START_DATE = '2023-03-05'
+
+
+class FakeResponse():
+    ''' Stand in for a requests response from the history endpoint, for save_output
+            The body is serialised like the API's, missing values as null
+    '''
+    def __init__(self, purple_df, sensor_index=0):
+        data = purple_df.astype(object).where(purple_df.notna(), None).to_numpy().tolist()
+        payload = {'api_version':'V1.0.11-0.0.49', 'time_stamp':int(time.time()), 'sensor_index':sensor_index,
+                   'fields':list(purple_df.columns), 'data':data}
+        self.status_code = 200
+        self.content = json.dumps(payload).encode()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def hour_of_day(time_stamp, tz='US/Eastern'):
+    ''' Local hour of day (fractional) of Unix timestamps, for diurnal cycles
+    '''
+
+    local = pd.to_datetime(time_stamp, unit='s', utc=True).tz_convert(tz)
+
+    return (local.hour+local.minute/60.).to_numpy()
+
+
+def slow_noise(rng, time_stamp, period=86400., scale=1.):
+    ''' Smooth random variation, random values every period seconds linearly interpolated
+    '''
+
+    knots = np.arange(time_stamp.min()-period, time_stamp.max()+2*period, period)
+
+    return np.interp(time_stamp, knots, rng.normal(0., scale, len(knots)))
+
+
+def ambient_pm25(rng, time_stamp):
+    ''' True PM2.5 (µg/m³), lognormal with a slow synoptic part and morning and evening peaks
+    '''
+
+    hour = hour_of_day(time_stamp)
+    diurnal = 0.25*np.exp(-(hour-8.)**2/4.)+0.3*np.exp(-(hour-21.)**2/6.)
+    log_pm = np.log(8.)+diurnal+slow_noise(rng, time_stamp, 2*86400., 0.5)+slow_noise(rng, time_stamp, 3600., 0.15)
+
+    return np.exp(log_pm)
+
+
+def purple_history(time_stamp, pm_true, seed=0, gap_fraction=0.02, disagree_fraction=0.01, bad_met_fraction=0.001):
+    ''' Synthetic 2-minute PurpleAir history for one sensor
+            Gaps are dropped blocks of rows, disagreement is one channel reading several times too
+            high for a few hours, and bad met rows carry the sensor's 2000 F / 150 % glitches
+    '''
+
+    rng = np.random.default_rng(seed)
+    n_rows = len(time_stamp)
+    hour = hour_of_day(time_stamp)
+
+    temperature = 60.+15.*np.cos((hour-15.)*np.pi/12.)+slow_noise(rng, time_stamp, 3*86400., 8.)
+    humidity = np.clip(60.-20.*np.cos((hour-15.)*np.pi/12.)+slow_noise(rng, time_stamp, 2*86400., 10.), 5., 99.)
+
+    ## Plantower channels over read with humidity, each with its own gain,
+    growth = 1.+0.25*(humidity/100.)**4
+    ## with a few percent of multiplicative noise and particle counting noise that dominates at low PM
+    pm25_a = np.abs(pm_true*growth*rng.normal(1.5, 0.05)*rng.lognormal(0., 0.05, n_rows)+rng.laplace(0., 0.8, n_rows))
+    pm25_b = np.abs(pm_true*growth*rng.normal(1.5, 0.05)*rng.lognormal(0., 0.05, n_rows)+rng.laplace(0., 0.8, n_rows))
+
+    ## Channel disagreement events, a few hours each
+    n_events = rng.poisson(disagree_fraction*n_rows/120.)
+    for start in rng.integers(0, n_rows, n_events):
+        pm25_b[start:start+120] *= rng.uniform(2., 5.)
+
+    fields = {'humidity':humidity, 'temperature':temperature}
+    fields['pressure'] = 1013.+slow_noise(rng, time_stamp, 86400., 5.)
+    fields['pressure_a'] = fields['pressure']+0.2
+    fields['pressure_b'] = fields['pressure']-0.2
+    for suffix, pm25 in [('_a', pm25_a), ('_b', pm25_b), ('', (pm25_a+pm25_b)/2.)]:
+        fields[f'pm1.0_cf_1{suffix}'] = 0.7*pm25
+        fields[f'pm2.5_cf_1{suffix}'] = pm25
+        fields[f'pm10.0_cf_1{suffix}'] = 1.2*pm25
+        fields[f'pm1.0_atm{suffix}'] = 0.7*np.minimum(pm25, 0.8*pm25+5.)
+        fields[f'pm2.5_atm{suffix}'] = np.minimum(pm25, 0.8*pm25+5.)
+        fields[f'pm10.0_atm{suffix}'] = 1.2*np.minimum(pm25, 0.8*pm25+5.)
+        fields[f'pm2.5_alt{suffix}'] = 0.8*pm25
+        fields[f'scattering_coefficient{suffix}'] = 3.*pm25
+        fields[f'deciviews{suffix}'] = 10.*np.log10(1.+pm25)
+        fields[f'visual_range{suffix}'] = 3912./(10.+3.*pm25)
+    fields['rssi'] = rng.integers(-80, -40, n_rows)
+    fields['uptime'] = (time_stamp-time_stamp.min())//60
+    fields['pa_latency'] = rng.integers(200, 900, n_rows)
+    fields['memory'] = rng.integers(15000, 20000, n_rows)
+
+    purple_df = pd.DataFrame({'time_stamp':time_stamp})
+    for field in PURPLE_FIELDS:
+        values = fields[field]
+        purple_df[field] = np.round(values, 3) if values.dtype.kind == 'f' else values
+
+    ## Met glitches
+    bad = rng.random(n_rows) < bad_met_fraction
+    purple_df.loc[bad, 'temperature'] = 2000.
+    purple_df.loc[rng.random(n_rows) < bad_met_fraction, 'humidity'] = 150.
+
+    ## Outages, blocks of 30 minutes to 6 hours
+    keep = np.ones(n_rows, dtype=bool)
+    n_gaps = rng.poisson(gap_fraction*n_rows/90.)
+    for start, length in zip(rng.integers(0, n_rows, n_gaps), rng.integers(15, 180, n_gaps)):
+        keep[start:start+length] = False
+
+    return purple_df[keep].reset_index(drop=True)
+
+
+def sensor_times(start_date, days, interval=120):
+    ''' Sample times (Unix seconds) every interval seconds over days of machine local time
+            The same day convention as get_hist_purple_data and save_output_days
+    '''
+
+    start = pd.Timestamp(start_date).to_pydatetime()
+    end = start+datetime.timedelta(days=days)
+
+    return np.arange(time.mktime(start.timetuple()), time.mktime(end.timetuple()), interval).astype(np.int64)
+
+
+def write_purple_archive(base_path, sensor_ids, start_date=START_DATE, days=1, seed=0, **kwargs):
+    ''' Write daily history CSVs for several sensors in the layout run_correct_purple reads
+            base_path/<sensor_id>/raw_data/<sensor_id>_<date>.csv. Sensors share the same true
+            PM2.5 so colocation fits are meaningful. Written a month at a time to bound memory.
+            Returns the hourly true PM2.5 series (UTC) for the DOEE generator
+    '''
+
+    rng = np.random.default_rng(seed)
+    true_hourly = []
+
+    start = pd.Timestamp(start_date)
+    end = start+pd.DateOffset(days=days)
+    while start < end:
+        chunk_end = min(start+pd.DateOffset(days=30), end)
+        time_stamp = sensor_times(start, (chunk_end-start).days)
+        pm_true = ambient_pm25(rng, time_stamp)
+
+        true_hourly.append(pd.Series(pm_true, index=pd.to_datetime(time_stamp, unit='s')).resample('h').mean())
+
+        for i, sensor_id in enumerate(sensor_ids):
+            out_path = os.path.join(base_path, str(sensor_id), 'raw_data')
+            os.makedirs(out_path, exist_ok=True)
+
+            purple_df = purple_history(time_stamp, pm_true, seed=seed*1000+i*37+len(true_hourly), **kwargs)
+            save_output_days(purple_df, sensor_id, start.to_pydatetime(), chunk_end.to_pydatetime(), out_path)
+
+        start = chunk_end
+
+    return pd.concat(true_hourly)
+
+
+def write_doee_export(fn, true_hourly, seed=0, outlier=True):
+    ''' Write a DOEE near road hourly export, header, units row and m/d/yy times included
+            Midnight times are written as a date only, like the real exports
+    '''
+
+    rng = np.random.default_rng(seed)
+    times = true_hourly.index
+    n_rows = len(times)
+
+    pm25 = true_hourly.to_numpy()*rng.lognormal(0., 0.08, n_rows)
+    if outlier and n_rows > 0:
+        pm25[rng.integers(0, n_rows)] = 100000.
+
+    dates = times.month.astype(str)+'/'+times.day.astype(str)+'/'+times.strftime('%y')
+    dtime = np.where(times.hour == 0, dates, dates+' '+times.hour.astype(str)+':00')
+
+    doee_df = pd.DataFrame({'':dtime, 'NEARROAD PM25LC-1022 001h':np.round(pm25, 1),
+                            'NEARROAD BARPRESS 001h':np.round(760.+rng.normal(0, 4, n_rows), 1),
+                            'NEARROAD AT_BAM25 001h':np.round(15.+rng.normal(0, 8, n_rows), 1),
+                            'NEARROAD RELHUM 001h':np.round(np.clip(60.+rng.normal(0, 15, n_rows), 5, 100)),
+                            'NEARROAD WSP 001h':np.round(rng.gamma(2., 1.5, n_rows), 1),
+                            'NEARROAD WDR 001h':np.round(rng.uniform(0, 360, n_rows))})
+
+    units = pd.DataFrame([[''] + list(DOEE_COLUMNS.values())], columns=doee_df.columns)
+    pd.concat([units, doee_df], ignore_index=True).to_csv(fn, index=False)
+
+
+def write_isd_wind(out_path, years, seed=0, missing_fraction=0.02, station='72405013743'):
+    ''' Write hourly ISD/ASOS wind files, one per year named like the DCA files (dca_asos_<year>.csv)
+            Directions favour the northwest and south, missing values use the 999 / 9999 codes
+            Returns the file names
+    '''
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_path, exist_ok=True)
+
+    file_list = []
+    for year in years:
+        times = pd.date_range(f'{year}-01-01', f'{year+1}-01-01', freq='h', inclusive='left')
+        n_rows = len(times)
+
+        windd = np.where(rng.random(n_rows) < 0.6, rng.normal(315., 30., n_rows), rng.normal(180., 40., n_rows))
+        windd = np.round(windd % 360./10.)*10
+        winds = np.round(rng.gamma(2., 20., n_rows))
+
+        missing = rng.random(n_rows) < missing_fraction
+        windd_txt = np.where(missing, '999', pd.Series(windd.astype(int)).astype(str).str.zfill(3))
+        winds_txt = np.where(missing, '9999', pd.Series(winds.astype(int)).astype(str).str.zfill(4))
+        wnd = pd.Series(windd_txt)+',1,N,'+pd.Series(winds_txt)+',1'
+
+        fn = os.path.join(out_path, f'dca_asos_{year}.csv')
+        pd.DataFrame({'STATION':station, 'DATE':times.strftime('%Y-%m-%dT%H:%M:%S'), 'WND':wnd}).to_csv(fn, index=False)
+        file_list.append(fn)
+
+    return file_list
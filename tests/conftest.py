@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+## Modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubServer():
+    ''' Local HTTP server standing in for the PurpleAir API
+            respond(path, query) returns (status, headers, body), a dict or list body is sent as JSON.
+            Every request's path and query are kept in calls
+    '''
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+        self.lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key:values[0] for key, values in parse_qs(url.query).items()}
+                with stub.lock:
+                    stub.calls.append((url.path, query))
+                status, headers, body = stub.respond(url.path, query)
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def paths(self):
+        with self.lock:
+            return [path for path, _ in self.calls]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    ''' Start a StubServer, the test sets stub_server.respond
+    '''
+
+    server = StubServer(lambda path, query: (404, {}, {'error':'NotFoundError'}))
+    yield server
+    server.close()
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from calibration_registry import CalibrationRegistry, to_utc_ns
+
+
+def factors(registry, sensor_id, times):
+    slope, intercept = registry.get_factors(sensor_id, pd.to_datetime(times, utc=True, format='ISO8601'))
+    return slope.tolist(), intercept.tolist()
+
+
+def test_load_plain_correction_csv(tmp_path):
+    fn = tmp_path/'doee_corrections.csv'
+    pd.DataFrame({'sensor_id':['V_st', 'ECA_1'], 'slope':[1.1, 0.9], 'intercept':[0.2, -0.5]}).to_csv(fn, index=False)
+
+    registry = CalibrationRegistry.load(fn)
+
+    ## No validity columns means always valid
+    assert factors(registry, 'V_st', ['2015-01-01', '2030-06-01']) == ([1.1, 1.1], [0.2, 0.2])
+    assert factors(registry, 'ECA_1', ['2023-01-01']) == ([0.9], [-0.5])
+
+
+def test_overlapping_versions_highest_wins():
+    registry = CalibrationRegistry()
+    registry.add('V_st', 1.0, 0., '2023-01-01', '2023-12-01')
+    registry.add('V_st', 2.0, 0., '2023-06-01', '2023-07-01')
+    registry.add('V_st', 3.0, 0., '2023-03-01', '2023-04-01')
+
+    slope, _ = factors(registry, 'V_st', ['2023-02-01', '2023-03-15', '2023-06-15', '2023-07-01', '2023-11-30'])
+
+    ## End times are exclusive, the version 1 interval shows again after each later version ends
+    assert slope == [1.0, 3.0, 2.0, 1.0, 1.0]
+
+
+def test_open_ended_intervals():
+    registry = CalibrationRegistry()
+    registry.add('V_st', 1.0, 0.1, None, '2023-01-01')
+    registry.add('V_st', 2.0, 0.2, '2024-01-01', None)
+
+    slope, intercept = factors(registry, 'V_st', ['1990-01-01', '2023-06-01', '2024-01-01', '2099-01-01'])
+
+    assert slope[0] == 1.0 and slope[2:] == [2.0, 2.0]
+    assert np.isnan(slope[1]) and np.isnan(intercept[1])
+
+
+def test_mixed_timestamp_formats(tmp_path):
+    registry = CalibrationRegistry()
+    registry.add('V_st', 1.1, 0.2, '2023-11-01', None)
+    registry.add('V_st', 1.3, 0.2, '2024-01-01 06:00', None)
+    registry.add('V_st', 1.5, 0.2, '2024-03-01 00:00-04:00', None)
+
+    slope, _ = factors(registry, 'V_st', ['2023-12-01', '2024-01-01 05:59', '2024-01-01 06:00',
+                                          '2024-03-01 03:59', '2024-03-01 04:00'])
+    assert slope == [1.1, 1.1, 1.3, 1.3, 1.5]
+
+    ## A saved and hand edited CSV goes through the same parsing
+    registry.save(tmp_path/'registry.csv')
+    loaded = CalibrationRegistry.load(tmp_path/'registry.csv')
+    assert factors(loaded, 'V_st', ['2024-03-01 04:00'])[0] == [1.5]
+
+    assert to_utc_ns(['2023-11-01 00:00-04:00'])[0] == to_utc_ns(['2023-11-01 04:00'])[0]
+
+
+def test_lookup_before_first_version():
+    registry = CalibrationRegistry()
+    registry.add('V_st', 1.1, 0.2, '2023-11-01', None)
+
+    slope, intercept = factors(registry, 'V_st', ['2023-10-31 23:59', '2023-11-01'])
+
+    assert np.isnan(slope[0]) and np.isnan(intercept[0])
+    assert slope[1] == 1.1
@@ -0,0 +1,149 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from colocation_analysis import (AnalyzeColocation, hourly_table, combine_sensor_columns, combine_dataframes,
+                                 fix_doee_time, parse_doee_times)
+from synthetic_data import write_doee_export
+
+
+HOURS = pd.date_range('2023-06-01', periods=72, freq='h')
+
+
+def purple_frame(seed, drop, col='pm25_ab_avg'):
+    rng = np.random.default_rng(seed)
+    times = HOURS[~np.isin(np.arange(len(HOURS)), drop)]
+    return pd.DataFrame({'datetime_utc':times, col:rng.uniform(2., 40., len(times))})
+
+
+def doee_frame():
+    times = HOURS[5:60]
+    return pd.DataFrame({'dtime':times, 'PM25':np.linspace(3., 30., len(times)), 'Temp_001h':70.})
+
+
+def merged_reference(doee_df, df_list, value_col):
+    ''' The chained outer merges combine_dataframes used to do, for any number of sensors
+    '''
+
+    doee_df = doee_df.rename(columns={'dtime':'datetime_utc'})
+    df_merged = df_list[0][['datetime_utc', value_col]].rename(columns={value_col:f'{value_col}_1'})
+    for i, df in enumerate(df_list[1:]):
+        df_merged = df_merged.merge(df[['datetime_utc', value_col]], on='datetime_utc', how='outer')
+        df_merged = df_merged.rename(columns={value_col:f'{value_col}_{i+2}'})
+
+    return doee_df.merge(df_merged, on='datetime_utc', how='outer')
+
+
+def test_hourly_table_scatter():
+    times = pd.DatetimeIndex(['2023-06-01 00:10', '2023-06-01 02:00', None, '2023-06-01 02:30'])
+    table = hourly_table({'a':(times, [1., 2., 3., 4.]), 'b':(HOURS[1:2], [5.])})
+
+    ## Floored to the hour, NaT dropped and a later duplicate hour wins
+    assert table.grid.tolist() == list(HOURS[:3])
+    assert table.values.dtype == np.float32
+    np.testing.assert_array_equal(table.column('a'), [1., np.nan, 4.])
+    np.testing.assert_array_equal(table.column('b'), [np.nan, 5., np.nan])
+    assert table.rows_with_data().tolist() == [False, False, False]
+    assert table.rows_with_data(how='any').tolist() == [True, True, True]
+    assert table.rows_with_data(['a']).tolist() == [True, False, True]
+
+
+def test_hourly_table_empty():
+    table = hourly_table({'a':(pd.DatetimeIndex([]), [])})
+
+    assert len(table.grid) == 0 and table.values.shape == (0, 1)
+
+
+def test_hourly_table_matches_outer_merge():
+    df_list = [purple_frame(i, drop) for i, drop in enumerate([[0, 1], [30], [], range(60, 72)])]
+
+    table = hourly_table({f's{i}':(df['datetime_utc'], df['pm25_ab_avg']) for i, df in enumerate(df_list)})
+
+    expected = merged_reference(doee_frame(), df_list, 'pm25_ab_avg').set_index('datetime_utc').sort_index()
+    expected = expected.reindex(table.grid)
+    np.testing.assert_allclose(table.values, expected.filter(like='pm25').to_numpy(), rtol=1e-6)
+
+
+@pytest.mark.parametrize('n_sensors', [1, 4, 6])
+def test_combine_sensor_columns_matches_merges(n_sensors):
+    doee_df = doee_frame()
+    df_list = [purple_frame(i, [i, 40+i]) for i in range(n_sensors)]
+
+    combined = combine_sensor_columns(doee_df, df_list, 'pm25_ab_avg')
+    expected = merged_reference(doee_df, df_list, 'pm25_ab_avg').sort_values(by='datetime_utc', ignore_index=True)
+
+    assert list(combined.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(combined, expected, check_dtype=False, check_names=False, rtol=1e-6)
+
+
+def test_combine_dataframes_four_sensors():
+    df_list = [purple_frame(i, []) for i in range(4)]
+
+    combined = combine_dataframes(doee_frame(), df_list)
+
+    assert [col for col in combined.columns if col.startswith('pm25')] == [f'pm25_ab_avg_{i}' for i in range(1, 5)]
+    assert len(combined) == len(HOURS)
+
+
+def test_regression_uses_full_precision():
+    rng = np.random.default_rng(3)
+    doee_df = pd.DataFrame({'dtime':HOURS, 'PM25':rng.uniform(2., 40., len(HOURS))})
+    purple_df = pd.DataFrame({'datetime_utc':HOURS, 'pm25_ab_corrected':doee_df['PM25']*1.3+0.123456789})
+
+    doee_pa = AnalyzeColocation(None, None)
+    doee_pa.doee_df, doee_pa.purple_df = doee_df, purple_df
+    doee_pa.combine_pm_data()
+    doee_pa.get_linear_model()
+
+    assert doee_pa.slope == pytest.approx(1.3, abs=1e-12)
+    assert doee_pa.inter == pytest.approx(0.123456789, abs=1e-10)
+
+
+def test_parse_doee_times_matches_fix_doee_time(tmp_path):
+    ## Single and double digit days and hours and date only midnights
+    true_hourly = pd.Series(10., index=pd.date_range('2023-01-08', '2023-01-11 23:00', freq='h'))
+    write_doee_export(tmp_path/'doee.csv', true_hourly)
+    dtime = pd.read_csv(tmp_path/'doee.csv')['Unnamed: 0'].iloc[1:]
+
+    parsed = parse_doee_times(dtime)
+
+    pd.testing.assert_series_equal(parsed, dtime.apply(fix_doee_time), check_dtype=False)
+    assert parsed.tolist() == list(true_hourly.index)
+    assert (dtime.str.len() < 8).sum() == 4
+
+
+def test_parse_doee_times_long_dates():
+    ## fix_doee_time took 8 character dates for a date and hour
+    dtime = pd.Series(['12/30/22', '12/30/22 1:00', '12/31/22 23:00'])
+
+    assert parse_doee_times(dtime).tolist() == list(pd.DatetimeIndex(['2022-12-30', '2022-12-30 01:00',
+                                                                      '2022-12-31 23:00']))
+
+
+def test_doee_cache_follows_file_content(tmp_path, monkeypatch):
+    doee_fn, cache_dir = tmp_path/'doee.csv', str(tmp_path/'cache')
+    true_hourly = pd.Series(np.linspace(3., 30., 48), index=pd.date_range('2023-06-01', periods=48, freq='h'))
+
+    def load(cache_dir):
+        doee_pa = AnalyzeColocation(str(doee_fn), None, cache_dir)
+        doee_pa.load_doee_data()
+        return doee_pa.doee_df
+
+    write_doee_export(doee_fn, true_hourly, seed=1)
+    first = load(cache_dir)
+    pd.testing.assert_frame_equal(first, load(None), check_index_type=False)
+    assert len(os.listdir(cache_dir)) == 1
+
+    ## Same file, the CSV isn't read again
+    with monkeypatch.context() as m:
+        m.setattr(pd, 'read_csv', lambda *args, **kwargs: pytest.fail('cache miss'))
+        pd.testing.assert_frame_equal(load(cache_dir), first)
+
+    ## New content is a new key
+    write_doee_export(doee_fn, true_hourly, seed=2)
+    second = load(cache_dir)
+    pd.testing.assert_frame_equal(second, load(None), check_index_type=False)
+    assert not np.allclose(second['PM25'], first['PM25'])
+    assert len(os.listdir(cache_dir)) == 2
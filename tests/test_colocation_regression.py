@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+
+from colocation_regression import fit_colocation, best_lags, lagged_cumsums
+
+
+N_HOURS = 24*20
+GRID = pd.date_range('2023-06-01', periods=N_HOURS, freq='h', name='datetime_utc')
+MAX_LAG = 6
+
+
+def colocated(seed=0, shift=2):
+    ''' Reference and two sensors tracking it shifted by shift hours, with NaN gaps
+    '''
+
+    rng = np.random.default_rng(seed)
+    ref = 12.+6.*np.sin(np.arange(N_HOURS)/9.)+rng.normal(0., 2., N_HOURS)
+    purple = np.vstack([np.roll(ref, shift)*slope+inter+rng.normal(0., 1., N_HOURS)
+                        for slope, inter in [(1.4, 2.), (0.8, -1.)]])
+
+    ref[rng.random(N_HOURS) < 0.1] = np.nan
+    ref[100:130] = np.nan
+    purple[rng.random(purple.shape) < 0.1] = np.nan
+    purple[1, 300:340] = np.nan
+
+    return ref, purple
+
+
+def linregress_window(ref, purple, lag, start, end):
+    ''' scipy fit of purple at hour i+lag on the reference at hour i, for i in [start, end)
+    '''
+
+    i = np.arange(start, end)
+    inside = (i+lag >= 0) & (i+lag < len(ref))
+    x, y = ref[i[inside]], purple[i[inside]+lag]
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x, y = x[valid], y[valid]
+
+    fit = stats.linregress(x, y)
+    rmse = np.sqrt(np.mean((y-fit.intercept-fit.slope*x)**2))
+
+    return len(x), fit.slope, fit.intercept, fit.rvalue**2, rmse
+
+
+@pytest.mark.parametrize('window_hours', [None, 5*24])
+def test_matches_linregress(window_hours):
+    ref, purple = colocated()
+    lags = [-MAX_LAG, 0, 1, MAX_LAG]
+
+    results = fit_colocation(GRID, ref, purple, ['ECA_1', 'ECA_2'], lags=lags, window_hours=window_hours,
+                             step_hours=24, min_count=24)
+
+    assert set(results['lag']) == set(lags)
+    for row in results.itertuples():
+        start = GRID.get_loc(row.window_start)
+        end = start+(N_HOURS if window_hours is None else window_hours)
+        expected = linregress_window(ref, purple[int(row.sensor[-1])-1], row.lag, start, end)
+
+        assert row.n == expected[0]
+        np.testing.assert_allclose([row.slope, row.intercept, row.r_squared, row.rmse], expected[1:],
+                                   rtol=1e-8, atol=1e-8)
+
+
+def test_windows_and_min_count():
+    ref, purple = colocated()
+
+    results = fit_colocation(GRID, ref, purple, ['ECA_1', 'ECA_2'], lags=[0], window_hours=48, step_hours=24,
+                             min_count=30)
+
+    ## Windows end every step and the ones inside the gaps have too few hours
+    ends = results.loc[results['sensor'] == 'ECA_1', 'window_end']
+    assert (results['window_end']-results['window_start'] == pd.Timedelta(hours=48)).all()
+    assert (results['n'] >= 30).all()
+    assert len(ends) < N_HOURS//24-1
+
+
+def test_best_lags_finds_shift():
+    ref, purple = colocated(shift=3)
+
+    results = fit_colocation(GRID, ref, purple, ['ECA_1', 'ECA_2'], lags=range(-MAX_LAG, MAX_LAG+1))
+    best = best_lags(results)
+
+    assert best['sensor'].tolist() == ['ECA_1', 'ECA_2']
+    assert best['lag'].tolist() == [3, 3]
+    np.testing.assert_allclose(best['slope'], [1.4, 0.8], rtol=0.05)
+
+
+def test_lagged_cumsums_out_of_range():
+    ref = np.array([1., 2., np.nan, 4.])
+    purple = np.array([10., 20., 30., np.nan])
+
+    sums = lagged_cumsums(ref, purple, [0, 1, 3])
+
+    ## Lag 3 only pairs hour 0 with hour 3, which is missing
+    assert sums['n'][:, -1].tolist() == [2., 2., 0.]
+    assert sums['sxy'][:, -1].tolist() == [1.*10.+2.*20., 1.*20.+2.*30., 0.]
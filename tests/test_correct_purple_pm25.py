@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from correct_purple_pm25 import CorrectPurpleAir, QCCounts
+from live_monitor import live_qc
+from synthetic_data import write_purple_archive
+
+
+@pytest.fixture(scope='module')
+def raw_files(tmp_path_factory):
+    ''' Two days of synthetic raw CSVs for one sensor
+    '''
+
+    base_path = tmp_path_factory.mktemp('raw')
+    write_purple_archive(str(base_path), ['900001'], start_date='2023-03-10', days=2, seed=4)
+
+    return sorted(str(fn) for fn in (base_path/'900001'/'raw_data').glob('*.csv'))
+
+
+def test_stream_mean_matches_in_memory(raw_files):
+    pa = CorrectPurpleAir(raw_files)
+    pa.load_data()
+    pa.remove_pm25_outliers()
+    pa.calculate_mean('datetime_utc', completeness=0.75)
+
+    stream = CorrectPurpleAir(raw_files)
+    stream.stream_mean('datetime_utc', completeness=0.75, chunk_size=500)
+
+    ## Only the counts are kept when streaming
+    assert isinstance(stream.qc, QCCounts)
+    assert stream.qc.summary().to_dict() == pa.qc.summary().to_dict()
+    pd.testing.assert_frame_equal(stream.avg_data_hour, pa.avg_data_hour, check_like=True, rtol=1e-6)
+
+
+
+def test_stream_and_batch_select_the_same_columns(raw_files):
+    mean_columns = ['humidity', 'pm2.5_ab_avg', 'pm2.5_cf_1_b', 'not_a_field']
+
+    pa = CorrectPurpleAir(raw_files, mean_columns)
+    pa.load_data()
+    pa.remove_pm25_outliers()
+    pa.calculate_mean('datetime_utc', completeness=0.75)
+
+    stream = CorrectPurpleAir(raw_files, mean_columns)
+    stream.stream_mean('datetime_utc', completeness=0.75, chunk_size=500)
+
+    assert stream.sums_names() == pa.sums_names() == mean_columns[:3]
+    assert list(stream.sums_df.columns) == list(pa.sums_df.columns)
+    assert list(stream.avg_data_day.columns) == list(pa.avg_data_day.columns) == mean_columns[:3]
+    pd.testing.assert_frame_equal(stream.avg_data_hour, pa.avg_data_hour, rtol=1e-6)
+
+def test_stream_mean_everything_rejected(raw_files, tmp_path):
+    dead_files = []
+    for fn in raw_files:
+        raw_data = pd.read_csv(fn)
+        raw_data['pm2.5_cf_1_b'] = np.nan
+        dead_files.append(str(tmp_path/fn.split('/')[-1]))
+        raw_data.to_csv(dead_files[-1], index=False)
+
+    pa = CorrectPurpleAir(dead_files)
+    pa.stream_mean('datetime_utc', completeness=0.75, chunk_size=500)
+
+    assert len(pa.sums_df) == 0
+    assert len(pa.avg_data_hour) == 0 and len(pa.avg_data_day) == 0
+    assert pa.qc.summary()['kept'] == 0
+    assert pa.qc.n_rows == sum(len(pd.read_csv(fn)) for fn in dead_files)
+
+
+## A/B pairs: agree, large but < 70 %, > 70 % but < 5 µg/m³, both exceeded
+AB_PAIRS = [(10., 10.), (30., 20.), (4., 0.5), (20., 2.)]
+
+
+def test_day_and_live_ab_rule_agree():
+    pm25_a, pm25_b = (np.array(channel) for channel in zip(*AB_PAIRS))
+
+    pa = CorrectPurpleAir([])
+    day_data = pd.DataFrame({'pm2.5_filt_a':pm25_a, 'pm2.5_filt_b':pm25_b},
+                            index=pd.date_range('2023-03-10', periods=len(AB_PAIRS), freq='D'))
+    pa.avg_data = {'day':day_data}
+    pa.remove_day_outliers()
+
+    live = pd.DataFrame({'pm2.5_cf_1_a':pm25_a, 'pm2.5_cf_1_b':pm25_b, 'temperature':70., 'humidity':50.})
+
+    assert pa.qc_day.keep.tolist() == live_qc(live).tolist() == [True, True, True, False]
+    assert pa.qc_day.summary().to_dict() == {'ab_difference':1, 'kept':3}
+    assert len(pa.avg_data_day) == 3
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from correction_models import barkjohn_2021, epa_smoke_2023, humidity_growth, apply_models, compare_models
+
+
+@pytest.mark.parametrize('breakpoint', [30., 50., 210., 260.])
+@pytest.mark.parametrize('rh', [0., 45., 90.])
+def test_smoke_continuous_at_breakpoints(breakpoint, rh):
+    below, at, above = epa_smoke_2023(np.array([breakpoint-1e-6, breakpoint, breakpoint+1e-6]), rh)
+
+    assert abs(at-below) < 1e-4 and abs(above-at) < 1e-4
+
+
+## Worked from the published piecewise equations (Barkjohn et al 2023) with RH 50
+SMOKE_CASES = [(20., 0.524*20.-0.0862*50.+5.75),
+               (40., (0.786*0.5+0.524*0.5)*40.-0.0862*50.+5.75),
+               (100., 0.786*100.-0.0862*50.+5.75),
+               (235., (0.69*0.5+0.786*0.5)*235.-0.0862*50.*0.5+2.966*0.5+5.75*0.5+8.84e-4*235.**2*0.5),
+               (300., 2.966+0.69*300.+8.84e-4*300.**2)]
+
+
+def test_smoke_known_values():
+    pm25 = np.array([pm for pm, _ in SMOKE_CASES])
+
+    np.testing.assert_allclose(epa_smoke_2023(pm25, 50.), [expected for _, expected in SMOKE_CASES])
+    assert epa_smoke_2023(np.array([100.]), 50.)[0] == pytest.approx(80.04)
+
+    ## Same as Barkjohn 2021 below 30 µg/m³
+    np.testing.assert_allclose(epa_smoke_2023(pm25[:1], 50.), barkjohn_2021(pm25[:1], 50.))
+
+
+def test_humidity_growth_dry_is_unchanged():
+    np.testing.assert_allclose(humidity_growth(np.array([10., 25.]), np.array([0., -5.])), [10., 25.])
+
+
+def test_humidity_growth_known_value():
+    ## kappa 0.4 at RH 50: growth = 1 + (0.4/1.65)/(1/0.5 - 1)
+    assert humidity_growth(10., 50.) == pytest.approx(10./(1.+0.4/1.65))
+
+
+def test_humidity_growth_near_saturation():
+    rh = np.array([98., 99., 99.9, 100., 120.])
+    corrected = humidity_growth(np.full(len(rh), 10.), rh)
+
+    assert np.isfinite(corrected).all()
+    assert (corrected > 0.).all() and (np.diff(corrected) <= 0.).all()
+    ## Capped at rh_max
+    assert corrected[1] == corrected[-1]
+
+
+def test_apply_and_compare_models():
+    frames = [pd.DataFrame({'pm2.5_ab_avg':[20., 300.], 'humidity':[50., 50.]}),
+              pd.DataFrame({'pm2.5_ab_avg':[100.], 'humidity':[50.]})]
+
+    apply_models(frames, ['epa_2021', 'epa_smoke_2023'])
+
+    assert frames[1]['pm2.5_ab_epa_smoke_corr'].iloc[0] == pytest.approx(80.04)
+    np.testing.assert_allclose(frames[0]['pm2.5_ab_epa_corr'], barkjohn_2021(np.array([20., 300.]), 50.))
+    assert list(compare_models(frames[0]).columns) == ['epa_2021', 'epa_smoke_2023', 'humidity_growth']
@@ -0,0 +1,26 @@
+import datetime
+
+from download_manifest import DownloadManifest
+
+
+DAY = datetime.datetime(2023, 1, 1)
+
+
+def test_failed_refetch_keeps_ok_row(tmp_path):
+    manifest = DownloadManifest(str(tmp_path/'manifest.csv'))
+    manifest.record_window('11', 0, [(DAY, 100, 'abc', 1672617540)], fetched_at=0.)
+
+    manifest.record_failure('11', 0, DAY, DAY+datetime.timedelta(days=2))
+    manifest.save()
+
+    ## Reload to check the kept values survive the CSV round trip
+    manifest = DownloadManifest(str(tmp_path/'manifest.csv'))
+    entry = manifest.entries[('11', 0, '2023-01-01')]
+    assert entry['status'] == 'failed'
+    assert (entry['rows'], entry['content_hash'], entry['last_time_stamp']) == (100, 'abc', 1672617540)
+    assert manifest.last_time_stamp('11', 0) == 1672617540
+
+    ## The day without an earlier row is a plain failure, both are fetched again
+    assert manifest.entries[('11', 0, '2023-01-02')]['rows'] == 0
+    assert manifest.pending_windows('11', 0, DAY, DAY+datetime.timedelta(days=2), 2) == \
+        [(DAY, DAY+datetime.timedelta(days=2))]
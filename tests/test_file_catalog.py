@@ -0,0 +1,90 @@
+import os
+
+import pytest
+
+import file_catalog
+from file_catalog import FileCatalog, get_catalog
+from run_correct_purple import get_files
+
+
+DATES = ['2023-04-14', '2023-04-15', '2023-04-17', '2023-05-01']
+
+
+@pytest.fixture
+def raw_dir(tmp_path, monkeypatch):
+    ''' A raw data folder with two sensors and a stray file, and an empty in process cache
+    '''
+
+    monkeypatch.setattr(file_catalog, '_CATALOGS', {})
+    raw = tmp_path/'raw_data'
+    raw.mkdir()
+    for date in DATES:
+        (raw/f'156089_{date}.csv').write_text('time_stamp\n')
+    (raw/'175119_2023-04-15.csv').write_text('time_stamp\n')
+    (raw/'notes.txt').write_text('')
+
+    return raw
+
+
+def names(files):
+    return [os.path.basename(fn) for fn in files]
+
+
+def test_range_at_file_boundaries(raw_dir):
+    catalog = FileCatalog.scan(str(raw_dir))
+
+    assert catalog.sensors() == ['156089', '175119']
+    ## Both ends inclusive, on and between file dates
+    assert names(catalog.get_files('156089', '2023-04-15', '2023-04-17')) == ['156089_2023-04-15.csv',
+                                                                          '156089_2023-04-17.csv']
+    assert names(catalog.get_files('156089', '2023-04-16', '2023-04-16')) == []
+    assert names(catalog.get_files('156089', '2023-04-16', '2023-04-30')) == ['156089_2023-04-17.csv']
+    assert names(catalog.get_files('156089', '2023-01-01', '2023-12-31')) == [f'156089_{date}.csv' for date in DATES]
+    assert names(catalog.get_files('156089', '2023-05-02', '2023-06-01')) == []
+    assert catalog.get_files('999999', '2023-01-01', '2023-12-31') == []
+
+
+def test_rebuild_when_directory_changes(raw_dir):
+    catalog = get_catalog(str(raw_dir))
+    assert get_catalog(str(raw_dir)) is catalog
+
+    (raw_dir/'156089_2023-04-16.csv').write_text('time_stamp\n')
+    os.utime(raw_dir, ns=(0, catalog.mtime+10**9))
+
+    rebuilt = get_catalog(str(raw_dir))
+    assert rebuilt is not catalog
+    assert names(rebuilt.get_files('156089', '2023-04-16', '2023-04-16')) == ['156089_2023-04-16.csv']
+
+
+def test_catalog_file_is_reused_across_runs(raw_dir, tmp_path, monkeypatch):
+    catalog_fn = str(tmp_path/'raw_data_catalog.json')
+    get_files(str(raw_dir), '2023-04-15', '2023-04-17', '156089', catalog_fn)
+    assert os.path.exists(catalog_fn)
+
+    ## A new process starts with an empty in process cache and shouldn't rescan
+    monkeypatch.setattr(file_catalog, '_CATALOGS', {})
+    scans = []
+    scan = FileCatalog.scan
+    monkeypatch.setattr(FileCatalog, 'scan', classmethod(lambda cls, in_path: scans.append(in_path) or
+                                                         scan(in_path)))
+
+    files = get_files(str(raw_dir), '2023-04-15', '2023-04-17', '156089', catalog_fn)
+    assert names(files) == ['156089_2023-04-15.csv', '156089_2023-04-17.csv']
+    assert scans == []
+
+    ## Until the directory changes
+    monkeypatch.setattr(file_catalog, '_CATALOGS', {})
+    os.utime(raw_dir, ns=(0, os.stat(raw_dir).st_mtime_ns+10**9))
+    get_files(str(raw_dir), '2023-04-15', '2023-04-17', '156089', catalog_fn)
+    assert len(scans) == 1
+    assert FileCatalog.load(catalog_fn).mtime == os.stat(raw_dir).st_mtime_ns
+
+
+def test_unreadable_catalog_file_is_rebuilt(raw_dir, tmp_path):
+    catalog_fn = tmp_path/'raw_data_catalog.json'
+    catalog_fn.write_text('{"in_path":')
+
+    catalog = get_catalog(str(raw_dir), str(catalog_fn))
+
+    assert catalog.sensors() == ['156089', '175119']
+    assert FileCatalog.load(str(catalog_fn)).sensors() == ['156089', '175119']
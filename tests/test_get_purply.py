@@ -0,0 +1,110 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import get_purply
+from get_purply import parse_history, find_data_array
+
+
+FIELDS = ['time_stamp', 'pm2.5_cf_1_a', 'humidity', 'rssi']
+ROWS = [[1672534800, 12.5, 40.0, -60],
+        [1672531200, None, 41.0, None],
+        [1672538400, 3.25e1, None, -58]]
+
+
+def reference(content):
+    ''' The same frame from json.loads, sorted by time_stamp and cast like the storage dtypes
+    '''
+
+    body = json.loads(content)
+    frame = pd.DataFrame(body['data'], columns=body['fields'], dtype=float)
+
+    return frame.sort_values(by='time_stamp', kind='stable', ignore_index=True)
+
+
+def assert_matches_json(content):
+    parsed = parse_history(content)
+    expected = reference(content)
+
+    assert list(parsed.columns) == list(expected.columns)
+    np.testing.assert_array_equal(parsed.astype('float64').to_numpy(na_value=np.nan), expected.to_numpy())
+
+    return parsed
+
+
+def body(fields=FIELDS, rows=ROWS, data_first=False, indent=None):
+    parts = {'api_version':'V1.0.11', 'sensor_index':101, 'fields':fields, 'data':rows}
+    if data_first:
+        parts = {'data':rows, 'sensor_index':101, 'fields':fields}
+
+    return json.dumps(parts, indent=indent).encode()
+
+
+def test_nulls():
+    parsed = assert_matches_json(body())
+
+    assert parsed['rssi'].isna().tolist() == [True, False, False]
+    assert np.isnan(parsed['pm2.5_cf_1_a'][0])
+
+
+def test_data_before_fields():
+    assert_matches_json(body(data_first=True))
+
+
+def test_empty_data():
+    parsed = assert_matches_json(body(rows=[]))
+
+    assert len(parsed) == 0
+    assert list(parsed.columns) == FIELDS
+
+
+def test_single_field():
+    assert_matches_json(body(fields=['time_stamp'], rows=[[3], [1], [2]]))
+
+
+@pytest.mark.parametrize('indent', [2, '\t'])
+def test_pretty_printed(indent):
+    assert_matches_json(body(indent=indent))
+
+
+def test_extra_whitespace():
+    content = b'{ "fields" : [ "time_stamp" , "humidity" ] ,\r\n "data" : [ [ 2 , 5.5 ] ,\n\t[ 1 ,null ] ] \n}'
+
+    assert_matches_json(content)
+
+
+@pytest.mark.parametrize('cell', ['true', '"12.5"'])
+def test_non_numeric_cells(cell):
+    assert_matches_json(body().replace(b'40.0', cell.encode()))
+
+
+def test_non_numeric_cells_take_json_fallback(monkeypatch):
+    calls = []
+    parse_json = get_purply.parse_history_json
+    monkeypatch.setattr(get_purply, 'parse_history_json', lambda content: calls.append(content) or parse_json(content))
+
+    assert_matches_json(body().replace(b'40.0', b'true'))
+    assert len(calls) == 1
+
+
+def test_text_cell_raises():
+    ## A ]] inside a string must not end the rows early and mis-parse
+    with pytest.raises(ValueError):
+        parse_history(body().replace(b'40.0', b'"a]]"'))
+
+
+def test_column_dtypes():
+    parsed = parse_history(body(fields=FIELDS+['unknown_field'], rows=[row+[1.5] for row in ROWS]))
+
+    assert parsed.dtypes.astype(str).to_dict() == {'time_stamp':'int64', 'pm2.5_cf_1_a':'float32',
+                                                   'humidity':'float32', 'rssi':'Int16',
+                                                   'unknown_field':'float64'}
+    assert parsed['time_stamp'].tolist() == sorted(row[0] for row in ROWS)
+
+
+def test_missing_data_array():
+    assert find_data_array(b'{"fields":["time_stamp"]}') is None
+    with pytest.raises(ValueError):
+        parse_history(b'{"fields":["time_stamp"], "error":"NotFoundError"}')
@@ -0,0 +1,77 @@
+import threading
+
+import numpy as np
+import pytest
+
+import instrumentation
+from instrumentation import stage, memory_status, reset_peak_rss
+
+
+@pytest.fixture
+def records():
+    instrumentation.RECORDS.clear()
+    instrumentation.enable()
+    yield instrumentation.RECORDS
+    instrumentation.disable()
+    instrumentation.RECORDS.clear()
+
+
+def test_disabled_stage_yields_a_fresh_dict():
+    with stage('a') as first:
+        first['rows_out'] = 1
+    with stage('b') as second:
+        pass
+
+    assert second == {} and first is not second
+    assert instrumentation.enabled() is False
+
+
+def test_peak_rss_is_per_stage(records):
+    if memory_status()[1] is None or not reset_peak_rss():
+        pytest.skip('peak RSS reset needs Linux /proc/self/clear_refs')
+
+    with stage('big'):
+        block = np.ones(200*1024**2//8)
+        del block
+    with stage('small'):
+        block = np.ones(1024)
+
+    peaks = {record['stage']:record['stage_peak_rss_mb'] for record in records}
+    assert peaks['big'] > peaks['small']+100
+    assert all(record['rss_delta_mb'] is not None for record in records)
+
+
+def test_parent_stage_keeps_child_peak(records):
+    if memory_status()[1] is None or not reset_peak_rss():
+        pytest.skip('peak RSS reset needs Linux /proc/self/clear_refs')
+
+    with stage('parent'):
+        with stage('child'):
+            block = np.ones(200*1024**2//8)
+            del block
+        with stage('later_child'):
+            pass
+
+    peaks = {record['stage']:record['stage_peak_rss_mb'] for record in records}
+    assert peaks['parent'] >= peaks['child'] > peaks['later_child']+100
+
+
+def test_depth_is_per_thread(records):
+    started, release = threading.Event(), threading.Event()
+
+    def worker():
+        with stage('worker'):
+            started.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=worker)
+    with stage('outer'):
+        thread.start()
+        started.wait(5)
+        with stage('inner'):
+            pass
+        release.set()
+        thread.join()
+
+    depths = {record['stage']:record['depth'] for record in records}
+    assert depths == {'inner':1, 'worker':0, 'outer':0}
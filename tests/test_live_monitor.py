@@ -0,0 +1,118 @@
+import asyncio
+
+import numpy as np
+import pytest
+import aiohttp
+
+from live_monitor import LiveMonitor, RingBuffer, nowcast, aqi, LIVE_FIELDS, AQI_CATEGORIES
+
+
+FIELDS = ['sensor_index']+LIVE_FIELDS
+SENSORS = {'s1':101, 's2':102, 's3':103}
+
+
+def reading(index):
+    values = {'sensor_index':index, 'humidity':50., 'temperature':70., 'pm2.5_cf_1_a':10.+index%10,
+              'pm2.5_cf_1_b':10.5+index%10, 'last_seen':1700000000}
+    return [values[field] for field in FIELDS]
+
+
+def fetch(monitor):
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            return await monitor.fetch(session)
+    return asyncio.run(run())
+
+
+def test_fetch_group(stub_server):
+    stub_server.respond = lambda path, query: (200, {}, {'fields':FIELDS, 'data':[reading(i) for i in SENSORS.values()]})
+
+    data = fetch(LiveMonitor('key', SENSORS, group_id=7, api_url=stub_server.url, alert=None))
+
+    assert stub_server.paths() == ['/groups/7/members']
+    assert sorted(data['sensor_index']) == sorted(SENSORS.values())
+    assert set(LIVE_FIELDS) <= set(data.columns)
+
+
+def test_fetch_batched_show_only(stub_server):
+    def respond(path, query):
+        indices = [int(index) for index in query['show_only'].split(',')]
+        return 200, {}, {'fields':FIELDS, 'data':[reading(i) for i in indices]}
+    stub_server.respond = respond
+
+    data = fetch(LiveMonitor('key', SENSORS, batch_size=2, api_url=stub_server.url, alert=None))
+
+    batches = sorted(query['show_only'] for _, query in stub_server.calls)
+    assert stub_server.paths() == ['/sensors', '/sensors']
+    assert batches == ['101,102', '103']
+    assert sorted(data['sensor_index']) == sorted(SENSORS.values())
+
+
+def test_fetch_per_sensor_with_retry(stub_server):
+    def respond(path, query):
+        if len(stub_server.calls) == 1:
+            return 429, {'Retry-After':'0'}, {'error':'RateLimitExceededError'}
+        index = int(path.split('/')[-1])
+        return 200, {}, {'sensor':dict(zip(FIELDS, reading(index)))}
+    stub_server.respond = respond
+
+    data = fetch(LiveMonitor('key', SENSORS, batch_size=None, api_url=stub_server.url, alert=None))
+
+    ## One sensor was rate limited once and retried
+    assert len(stub_server.calls) == 4
+    assert set(stub_server.paths()) == {'/sensors/101', '/sensors/102', '/sensors/103'}
+    assert sorted(data['sensor_index']) == sorted(SENSORS.values())
+
+
+## NowCast worked by hand from the EPA definition: weight = min/max of the 12 hours, at least 0.5,
+## most recent hour first, 2 of the 3 most recent hours needed
+NOWCAST_CASES = [([10.]*12, 10.),
+                 ([40., 20., 10.]+[np.nan]*9, (40.+0.5*20.+0.25*10.)/1.75),
+                 ([10.]+[8.]*11, (10.+8.*sum(0.8**k for k in range(1, 12)))/sum(0.8**k for k in range(12))),
+                 ([np.nan, 10., 12.]+[np.nan]*9, (10.+12.*10./12.)/(1.+10./12.)),
+                 ([np.nan, np.nan, 12.]+[10.]*9, np.nan),
+                 ([0.]*12, 0.)]
+
+
+@pytest.mark.parametrize('hourly, expected', NOWCAST_CASES)
+def test_nowcast(hourly, expected):
+    np.testing.assert_allclose(nowcast(np.array([hourly])), [expected])
+
+
+def test_nowcast_rows_are_independent():
+    hourly = np.array([case for case, _ in NOWCAST_CASES])
+    np.testing.assert_allclose(nowcast(hourly), [expected for _, expected in NOWCAST_CASES])
+
+
+## PM2.5 AQI at the 2024 breakpoints, concentrations truncated to 0.1 µg/m³
+AQI_CASES = [(0., 0, 'Good'), (9.0, 50, 'Good'), (9.05, 50, 'Good'), (9.1, 51, 'Moderate'), (12.0, 56, 'Moderate'),
+             (35.4, 100, 'Moderate'), (35.5, 101, 'Unhealthy for Sensitive Groups'),
+             (55.4, 150, 'Unhealthy for Sensitive Groups'), (55.5, 151, 'Unhealthy'), (125.4, 200, 'Unhealthy'),
+             (125.5, 201, 'Very Unhealthy'), (150.0, 225, 'Very Unhealthy'), (225.4, 300, 'Very Unhealthy'),
+             (225.5, 301, 'Hazardous'), (325.4, 500, 'Hazardous'), (600., 500, 'Hazardous')]
+
+
+def test_aqi_breakpoints():
+    index, category = aqi([conc for conc, _, _ in AQI_CASES])
+
+    assert index.tolist() == [expected for _, expected, _ in AQI_CASES]
+    assert [AQI_CATEGORIES[cat] for cat in category] == [name for _, _, name in AQI_CASES]
+
+
+def test_aqi_missing():
+    index, category = aqi([np.nan])
+
+    assert np.isnan(index[0]) and category[0] == -1
+
+
+def test_hourly_means_skip_current_hour():
+    buffer = RingBuffer(1, 100)
+    now = 1700000000//3600*3600+1800
+    times = np.arange(now-3*3600, now, 600)
+    for time_stamp in times:
+        buffer.append(np.array([0]), np.array([time_stamp]), np.array([float(time_stamp//3600)]))
+
+    hourly = buffer.hourly_means(now, hours=3)
+
+    ## The first column is the last completed hour, the partial current hour is left out
+    np.testing.assert_allclose(hourly[0], [now//3600-1, now//3600-2, now//3600-3])
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from hourly_grid import regression_from_sums
+from network_consistency import NetworkConsistency, pair_sums, trend_sums, hour_numbers
+
+
+SENSORS = ['s1', 's2', 's3', 's4', 's5']
+START = pd.Timestamp('2023-06-01')
+
+
+def network_data(n_hours, seed=0, bias=None):
+    ''' Hourly PM2.5 and A/B channels sharing one signal, NaN gaps sprinkled in
+    '''
+
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(START, periods=n_hours, freq='h')
+    signal = 10.+5.*np.sin(np.arange(n_hours)/6.)
+    pm25 = signal[:, None]+rng.normal(0., 0.3, (n_hours, len(SENSORS)))
+    if bias is not None:
+        pm25[:, SENSORS.index(bias[0])] += bias[1]
+    pm25[rng.random(pm25.shape) < 0.05] = np.nan
+    pm25_a = pm25+rng.normal(0., 0.2, pm25.shape)
+    pm25_b = pm25-rng.normal(0., 0.2, pm25.shape)
+
+    return times, pm25, pm25_a, pm25_b
+
+
+def hour_frames(times, pm25, pm25_a, pm25_b):
+    return {sensor:pd.DataFrame({'datetime_utc':times, 'pm2.5_ab_epa_corr':pm25[:, i],
+                                 'pm2.5_filt_a':pm25_a[:, i], 'pm2.5_filt_b':pm25_b[:, i]})
+            for i, sensor in enumerate(SENSORS)}
+
+
+def test_incremental_sums_match_recompute():
+    window = 48
+    times, pm25, pm25_a, pm25_b = network_data(200)
+    ab_diff = np.abs(pm25_a-pm25_b)
+    hours = hour_numbers(times)
+
+    network = NetworkConsistency(SENSORS, window_hours=window, alert=lambda *args: None)
+    ## Uneven batches and a skipped stretch of hours, so both the incremental and rebuild paths run
+    bounds = [0, 1, 11, 30, 31, 70, 90, 140, 151, 200]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == 90:
+            continue
+        network.update(times[start:end], pm25[start:end], pm25_a[start:end], pm25_b[start:end])
+
+        last = hours[end-1]
+        in_window = (hours > last-window) & (hours <= last) & ~((hours >= hours[90]) & (hours < hours[140]))
+        direct = pair_sums(pm25[in_window])
+        for name, sums in direct.items():
+            np.testing.assert_allclose(network.pair[name], sums, rtol=1e-9, atol=1e-6)
+
+        direct_trend = trend_sums((hours[in_window]-last).astype(float), ab_diff[in_window])
+        for name in ['n', 'sy', 'syy']:
+            np.testing.assert_allclose(network.trend[name], direct_trend[name], rtol=1e-9, atol=1e-6)
+        np.testing.assert_allclose(regression_from_sums(**network.trend)[0],
+                                   regression_from_sums(**direct_trend)[0], rtol=1e-6, atol=1e-9)
+
+
+def test_flag_fires():
+    alerts = []
+    network = NetworkConsistency(SENSORS, window_hours=72, min_count=24,
+                                 alert=lambda sensor, flag, row: alerts.append((sensor, flag)))
+
+    summary = network.update_frames(hour_frames(*network_data(72, bias=('s3', 10.))))
+
+    assert alerts == [('s3', 'neighbour_bias')]
+    assert summary['neighbour_bias'].tolist() == [False, False, True, False, False]
+    assert summary.loc['s3', 'bias_median'] > 9.
+    assert not summary['low_correlation'].any()
+
+    ## A flag already set is not raised again
+    times, pm25, pm25_a, pm25_b = network_data(73, bias=('s3', 10.))
+    summary = network.update_frames(hour_frames(times[72:], pm25[72:], pm25_a[72:], pm25_b[72:]))
+    assert summary.loc['s3', 'neighbour_bias']
+    assert alerts == [('s3', 'neighbour_bias')]
+
+
+def test_flag_clears():
+    alerts = []
+    network = NetworkConsistency(SENSORS, window_hours=72, min_count=24,
+                                 alert=lambda sensor, flag, row: alerts.append((sensor, flag)))
+    network.update_frames(hour_frames(*network_data(72, bias=('s3', 10.))))
+    assert network.flags.loc['s3', 'neighbour_bias']
+
+    ## A window of good data pushes the biased hours out
+    times, pm25, pm25_a, pm25_b = network_data(72, seed=1)
+    summary = network.update_frames(hour_frames(times+pd.Timedelta(hours=72), pm25, pm25_a, pm25_b))
+
+    assert not summary['neighbour_bias'].any()
+    assert not network.flags.to_numpy().any()
+    assert alerts == [('s3', 'neighbour_bias')]
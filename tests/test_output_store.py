@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from output_store import upsert_csv, write_if_changed, read_header_and_last_line
+
+
+TIME_VAR = 'datetime_et'
+
+
+def daily(start, periods, value=1., extra=None):
+    ''' Daily means indexed by datetime_et like CorrectPurpleAir.avg_data_day
+    '''
+
+    index = pd.date_range(start, periods=periods, freq='D', name=TIME_VAR)
+    df = pd.DataFrame({'pm2.5_ab_avg':np.arange(periods)+value, 'count':np.full(periods, 720)}, index=index)
+    if extra is not None:
+        df[extra] = 0.5
+
+    return df
+
+
+def read(fn):
+    return pd.read_csv(fn)
+
+
+def age(fn):
+    ''' Push the file's mtime into the past so a rewrite is always visible, returns it
+    '''
+
+    os.utime(fn, ns=(0, 10**18))
+    return os.stat(fn).st_mtime_ns
+
+
+def test_append(tmp_path):
+    fn = tmp_path/'daily.csv'
+    assert upsert_csv(daily('2023-04-15', 3), fn, TIME_VAR) == 3
+
+    assert upsert_csv(daily('2023-04-18', 2, value=10.), fn, TIME_VAR) == 2
+
+    out = read(fn)
+    assert out[TIME_VAR].tolist() == [f'2023-04-{day} 00:00:00' for day in range(15, 20)]
+    assert out['pm2.5_ab_avg'].tolist() == [1., 2., 3., 10., 11.]
+    assert list(out.columns) == [TIME_VAR, 'pm2.5_ab_avg', 'count']
+
+
+def test_overlap_replaces_without_duplicates(tmp_path):
+    fn = tmp_path/'daily.csv'
+    upsert_csv(daily('2023-04-15', 5), fn, TIME_VAR)
+
+    ## Reprocess the last two days with new values and add one more day
+    n_rows = upsert_csv(daily('2023-04-18', 3, value=20.), fn, TIME_VAR)
+
+    out = read(fn)
+    assert n_rows == 3
+    assert not out[TIME_VAR].duplicated().any()
+    assert out[TIME_VAR].tolist() == [f'2023-04-{day} 00:00:00' for day in range(15, 21)]
+    assert out['pm2.5_ab_avg'].tolist() == [1., 2., 3., 20., 21., 22.]
+
+    ## Only the rows that changed count
+    assert upsert_csv(daily('2023-04-15', 2).iloc[[1]].assign(**{'pm2.5_ab_avg':5.}), fn, TIME_VAR) == 1
+    assert read(fn)['pm2.5_ab_avg'].tolist() == [1., 5., 3., 20., 21., 22.]
+
+
+def test_header_change_falls_back_to_merge(tmp_path):
+    fn = tmp_path/'daily.csv'
+    upsert_csv(daily('2023-04-15', 3), fn, TIME_VAR)
+
+    n_rows = upsert_csv(daily('2023-04-17', 2, value=7., extra='pm2.5_ab_epa_corr'), fn, TIME_VAR)
+
+    out = read(fn)
+    assert n_rows == 2
+    assert out[TIME_VAR].tolist() == [f'2023-04-{day} 00:00:00' for day in range(15, 19)]
+    assert out['pm2.5_ab_avg'].tolist() == [1., 2., 7., 8.]
+    assert out['pm2.5_ab_epa_corr'].isna().tolist() == [True, True, False, False]
+    assert read_header_and_last_line(fn)[0] == f'{TIME_VAR},pm2.5_ab_avg,count,pm2.5_ab_epa_corr'
+
+
+def test_nothing_changed_leaves_file(tmp_path):
+    fn = tmp_path/'daily.csv'
+    upsert_csv(daily('2023-04-15', 5), fn, TIME_VAR)
+    mtime = age(fn)
+
+    assert upsert_csv(daily('2023-04-15', 5).iloc[1:4], fn, TIME_VAR) == 0
+    assert upsert_csv(daily('2023-04-15', 5), fn, TIME_VAR) == 0
+    assert upsert_csv(daily('2023-04-15', 0), fn, TIME_VAR) == 0
+
+    assert os.stat(fn).st_mtime_ns == mtime
+    assert len(read(fn)) == 5
+
+
+def test_write_if_changed(tmp_path):
+    fn = tmp_path/'hour.csv'
+    hour_df = daily('2023-04-15', 3)
+
+    assert write_if_changed(hour_df, fn)
+    mtime = age(fn)
+
+    assert not write_if_changed(hour_df, fn)
+    assert os.stat(fn).st_mtime_ns == mtime
+
+    assert write_if_changed(hour_df.assign(count=719), fn)
+    assert os.stat(fn).st_mtime_ns != mtime
+    assert read(fn)['count'].tolist() == [719]*3
@@ -0,0 +1,119 @@
+import os
+import time
+import datetime
+import email.utils
+
+import pytest
+import requests
+
+import purple_downloader
+from purple_downloader import (TokenBucket, parse_retry_after, split_windows, fetch_window, download_jobs,
+                               download_sensors, MAX_WINDOW_DAYS)
+
+
+def history_body(query, sensor_index):
+    ''' Hourly rows over the queried range, newest first like the API
+    '''
+
+    start, end = int(float(query['start_timestamp'])), int(float(query['end_timestamp']))
+    data = [[t, 1.5, 2.5] for t in range(start, end, 3600)][::-1]
+
+    return {'sensor_index':sensor_index, 'fields':['time_stamp', 'pm2.5_cf_1_a', 'pm2.5_cf_1_b'], 'data':data}
+
+
+def sensor_of(path):
+    return path.split('/')[2]
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('7', 30.) == 7.
+    assert parse_retry_after(None, 30.) == 30.
+    assert parse_retry_after('soon', 30.) == 30.
+
+    later = email.utils.formatdate(time.time()+20, usegmt=True)
+    assert 15. < parse_retry_after(later, 30.) <= 20.
+
+
+def test_fetch_window_backs_off_on_429(stub_server):
+    def respond(path, query):
+        if len(stub_server.calls) == 1:
+            return 429, {'Retry-After':'1'}, {'error':'RateLimitExceededError'}
+        return 200, {}, history_body(query, 1)
+    stub_server.respond = respond
+
+    bucket = TokenBucket(100., 5)
+    started = time.monotonic()
+    with requests.Session() as session:
+        r = fetch_window(session, bucket, 'key', 1, datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 2),
+                         api_url=stub_server.url, backoff=30.)
+
+    ## Retry-After wins over the 30 s backoff and holds the bucket
+    assert r.status_code == 200
+    assert len(stub_server.calls) == 2
+    assert 0.9 < time.monotonic()-started < 10.
+
+
+def test_fetch_window_gives_up_after_max_retries(stub_server):
+    stub_server.respond = lambda path, query: (503, {'Retry-After':'0'}, {'error':'ServiceUnavailable'})
+
+    with requests.Session() as session, pytest.raises(requests.HTTPError):
+        fetch_window(session, TokenBucket(100., 5), 'key', 1, datetime.datetime(2023, 1, 1),
+                     datetime.datetime(2023, 1, 2), api_url=stub_server.url, max_retries=2)
+
+    assert len(stub_server.calls) == 3
+
+
+def test_split_windows():
+    windows = split_windows(datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 6), 2)
+
+    assert windows == [(datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 3)),
+                       (datetime.datetime(2023, 1, 3), datetime.datetime(2023, 1, 5)),
+                       (datetime.datetime(2023, 1, 5), datetime.datetime(2023, 1, 6))]
+
+
+def test_download_sensors_splits_at_max_window(stub_server, tmp_path):
+    stub_server.respond = lambda path, query: (200, {}, history_body(query, int(sensor_of(path))))
+
+    results = download_sensors('key', ['11', '12'], '2023-01-01', '2023-01-06', str(tmp_path),
+                               requests_per_minute=6000., burst=10, api_url=stub_server.url)
+
+    ## 5 days of raw data at 2 days per query is 3 windows a sensor
+    assert MAX_WINDOW_DAYS[0] == 2
+    assert len(results) == 6
+    for sensor_index in ['11', '12']:
+        queries = sorted((float(query['start_timestamp']), float(query['end_timestamp']))
+                         for path, query in stub_server.calls if sensor_of(path) == sensor_index)
+        spans = [(end-start)/86400. for start, end in queries]
+        assert len(queries) == 3
+        assert max(spans) <= MAX_WINDOW_DAYS[0]
+        assert all(queries[i][1] == queries[i+1][0] for i in range(2))
+
+    assert sum(results.values()) == 2*5*24
+    assert len(os.listdir(tmp_path)) == 2*5
+
+
+def test_failed_window_does_not_stop_other_sensors(stub_server, tmp_path):
+    def respond(path, query):
+        if sensor_of(path) == '13':
+            return 404, {}, {'error':'NotFoundError'}
+        return 200, {}, history_body(query, int(sensor_of(path)))
+    stub_server.respond = respond
+
+    jobs = [(sensor_index, datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 3)) for sensor_index in ['11', '13']]
+    results = download_jobs('key', jobs, str(tmp_path), requests_per_minute=6000., burst=10,
+                            api_url=stub_server.url, max_retries=0)
+
+    assert isinstance(results[jobs[1]], requests.HTTPError)
+    assert results[jobs[0]] == 2*24
+    assert sorted(os.listdir(tmp_path)) == ['11_2023-01-01.csv', '11_2023-01-02.csv']
+
+
+def test_failed_window_is_recorded_in_manifest(stub_server, tmp_path):
+    stub_server.respond = lambda path, query: (500, {}, {'error':'InternalError'})
+
+    manifest = purple_downloader.DownloadManifest(str(tmp_path/'manifest.csv'))
+    results = download_sensors('key', ['14'], '2023-01-01', '2023-01-02', str(tmp_path), manifest=manifest,
+                               requests_per_minute=6000., burst=10, api_url=stub_server.url, max_retries=0)
+
+    assert all(isinstance(result, requests.HTTPError) for result in results.values())
+    assert len(manifest.pending_windows('14', 0, datetime.datetime(2023, 1, 1), datetime.datetime(2023, 1, 2), 2)) == 1
@@ -0,0 +1,106 @@
+import glob
+import os
+
+import pandas as pd
+import pyarrow.dataset as ds
+import pytest
+
+from correct_purple_pm25 import CorrectPurpleAir
+from purple_schema import read_dtypes
+from purple_storage import (convert_csv_archive, read_purple_parquet, sensor_dir, time_filter, write_average_parquet,
+                            read_average_parquet)
+from synthetic_data import write_purple_archive
+
+
+SENSOR = '900001'
+
+
+@pytest.fixture(scope='module')
+def archive(tmp_path_factory):
+    ''' Raw CSVs running over a month boundary and their Parquet conversion
+    '''
+
+    base_path = tmp_path_factory.mktemp('archive')
+    write_purple_archive(str(base_path), [SENSOR], start_date='2023-03-30', days=4, seed=2)
+    raw_path = str(base_path/SENSOR/'raw_data')
+    root = str(base_path/'store')
+    convert_csv_archive(raw_path, root)
+
+    return raw_path, root
+
+
+def csv_frame(raw_path):
+    files = sorted(glob.glob(os.path.join(raw_path, '*.csv')))
+    purple_df = pd.concat([pd.read_csv(fn, dtype=read_dtypes()) for fn in files], ignore_index=True)
+
+    return purple_df.sort_values(by='time_stamp', ignore_index=True)
+
+
+def partitions(root, predicate=None):
+    dataset = ds.dataset(sensor_dir(root, SENSOR), format='parquet', partitioning='hive')
+    fragments = dataset.get_fragments(filter=predicate)
+
+    return sorted(os.path.relpath(fragment.path, sensor_dir(root, SENSOR)) for fragment in fragments)
+
+
+def test_round_trip_matches_load_data(archive):
+    raw_path, root = archive
+
+    assert partitions(root) == ['year=2023/month=03/data.parquet', 'year=2023/month=04/data.parquet']
+    pd.testing.assert_frame_equal(read_purple_parquet(root, SENSOR), csv_frame(raw_path))
+
+    from_csv = CorrectPurpleAir(sorted(glob.glob(os.path.join(raw_path, '*.csv'))))
+    from_csv.load_data()
+    from_parquet = CorrectPurpleAir([])
+    from_parquet.load_parquet(root, SENSOR)
+
+    expected = from_csv.raw_data.sort_values(by='time_stamp', ignore_index=True)
+    pd.testing.assert_frame_equal(from_parquet.raw_data[list(expected.columns)], expected)
+    assert from_parquet.qc.summary().to_dict() == from_csv.qc.summary().to_dict()
+
+
+def test_time_filter_prunes_partitions(archive):
+    raw_path, root = archive
+    time_stamp = ds.dataset(sensor_dir(root, SENSOR), format='parquet', partitioning='hive').schema.field('time_stamp').type
+
+    assert partitions(root, time_filter('time_stamp', time_stamp, '2023-04-01', None)) == \
+        ['year=2023/month=04/data.parquet']
+    assert partitions(root, time_filter('time_stamp', time_stamp, None, '2023-03-31 12:00')) == \
+        ['year=2023/month=03/data.parquet']
+    assert partitions(root, time_filter('time_stamp', time_stamp, '2024-01-01', None)) == []
+
+    ## Start inclusive, end exclusive, naive times are UTC
+    purple_df = read_purple_parquet(root, SENSOR, '2023-03-31 12:00', '2023-04-01 06:00', columns=['time_stamp'])
+    expected = csv_frame(raw_path)['time_stamp']
+    start, end = pd.Timestamp('2023-03-31 12:00', tz='UTC').timestamp(), pd.Timestamp('2023-04-01 06:00', tz='UTC').timestamp()
+    assert purple_df['time_stamp'].tolist() == expected[(expected >= start) & (expected < end)].tolist()
+    assert list(purple_df.columns) == ['time_stamp']
+
+
+def test_convert_into_existing_partition(tmp_path):
+    write_purple_archive(str(tmp_path), [SENSOR], start_date='2023-04-10', days=3, seed=5)
+    raw_path, root = str(tmp_path/SENSOR/'raw_data'), str(tmp_path/'store')
+
+    ## First a single day, then the full archive over it
+    first_day = os.path.join(raw_path, f'{SENSOR}_2023-04-11.csv')
+    os.makedirs(os.path.join(tmp_path, 'first'))
+    os.link(first_day, os.path.join(tmp_path, 'first', os.path.basename(first_day)))
+    convert_csv_archive(str(tmp_path/'first'), root)
+    convert_csv_archive(raw_path, root)
+
+    stored = read_purple_parquet(root, SENSOR)
+    assert partitions(root) == ['year=2023/month=04/data.parquet']
+    assert not stored['time_stamp'].duplicated().any()
+    pd.testing.assert_frame_equal(stored, csv_frame(raw_path))
+
+
+def test_average_round_trip(tmp_path):
+    index = pd.date_range('2023-03-31 22:00', periods=4, freq='h', tz='US/Eastern', name='datetime_et')
+    avg_df = pd.DataFrame({'pm2.5_ab_avg':[1., 2., 3., 4.]}, index=index)
+
+    write_average_parquet(avg_df, str(tmp_path), SENSOR, 'hour')
+    write_average_parquet(avg_df.iloc[2:]*2., str(tmp_path), SENSOR, 'hour')
+
+    stored = read_average_parquet(str(tmp_path), SENSOR, 'hour', 'datetime_et')
+    assert stored['pm2.5_ab_avg'].tolist() == [1., 2., 6., 8.]
+    assert stored.index.equals(index) and str(stored.index.tz) == 'US/Eastern'
@@ -0,0 +1,54 @@
+import os
+
+import pandas as pd
+import pytest
+
+from run_correct_purple import get_sensor_info, run_sensor, run_sensors
+from synthetic_data import write_purple_archive
+
+
+REGISTRY = {'900001':'900001', '900002':'900002'}
+
+
+@pytest.fixture
+def base_path(tmp_path):
+    ''' Two days of raw data for two synthetic sensors, calibration only for the first
+    '''
+
+    write_purple_archive(str(tmp_path), list(REGISTRY), start_date='2023-04-15', days=2, seed=3)
+    pd.DataFrame({'sensor_id':['900001'], 'slope':[1.2], 'intercept':[0.5]}).to_csv(tmp_path/'correction.csv',
+                                                                                  index=False)
+
+    return tmp_path
+
+
+def test_unknown_sensor_raises():
+    with pytest.raises(KeyError):
+        get_sensor_info('no_such_sensor')
+    with pytest.raises(KeyError):
+        run_sensor('no_such_sensor', '2023-04-15', '2023-04-16', '/nonexistent', 'out', 'et', 'correction.csv')
+
+    assert get_sensor_info('ECA_1') == '156089'
+    assert get_sensor_info('900001', REGISTRY) == '900001'
+
+
+def test_failure_does_not_stop_other_sensors(base_path):
+    results, failures = run_sensors(list(REGISTRY), '2023-04-15', '2023-04-16', str(base_path), 'out', 'et',
+                                    str(base_path/'correction.csv'), max_workers=2, registry=REGISTRY)
+
+    assert list(results) == ['900001']
+    assert list(failures) == ['900002']
+    assert isinstance(failures['900002'], KeyError)
+    assert 'No calibration for sensor 900002' in str(failures['900002'])
+
+    n_hour, n_day = results['900001']
+    assert n_day > 0 and n_hour > 0
+    day_df = pd.read_csv(base_path/'900001'/'out'/'900001_daily_mean_et.csv')
+    assert len(day_df) == n_day and 'pm2.5_ab_epa_doee_corr' in day_df.columns
+    assert not os.path.exists(base_path/'900002'/'out'/'900002_daily_mean_et.csv')
+
+
+def test_unknown_sensor_rejected_before_pool(base_path):
+    with pytest.raises(ValueError):
+        run_sensors(['900001', '900003'], '2023-04-15', '2023-04-16', str(base_path), 'out', 'et',
+                    str(base_path/'correction.csv'), registry=REGISTRY)
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from stage_cache import StageCache, fingerprint, files_fingerprint
+
+
+def hour_frame():
+    index = pd.date_range('2023-11-05', periods=4, freq='h', tz='US/Eastern', name='datetime_et')
+    return pd.DataFrame({'pm2.5_ab_avg':np.arange(4.), 'count':np.arange(4)}, index=index)
+
+
+def test_round_trip(tmp_path):
+    cache = StageCache(str(tmp_path))
+    calls = []
+
+    def run():
+        calls.append(1)
+        return {'hour':hour_frame()}, {'rows':4}
+
+    assert cache.get('means', 'abc') is None
+    frames, meta = cache.stage('means', 'abc', run)
+    cached, cached_meta = cache.stage('means', 'abc', run)
+
+    ## The second call is a hit and keeps the tz aware index and its name
+    assert len(calls) == 1
+    assert cached_meta == meta == {'rows':4}
+    pd.testing.assert_frame_equal(cached['hour'], hour_frame(), check_freq=False)
+    assert cached['hour'].index.name == 'datetime_et'
+    assert str(cached['hour'].index.tz) == 'US/Eastern'
+
+
+def test_key_changes_with_input(tmp_path):
+    fn = tmp_path/'156089_2023-11-05.csv'
+    fn.write_text('time_stamp,pm\n1,2\n')
+    key = fingerprint('sums', files_fingerprint([str(fn)]), 70.)
+
+    assert fingerprint('sums', files_fingerprint([str(fn)]), 70.) == key
+    assert fingerprint('sums', files_fingerprint([str(fn)]), 71.) != key
+
+    fn.write_text('time_stamp,pm\n1,3\n')
+    os.utime(fn, ns=(0, 10**18))
+    assert fingerprint('sums', files_fingerprint([str(fn)]), 70.) != key
+    assert files_fingerprint([str(fn)], content=True) != files_fingerprint([str(fn)], content=False)
+
+
+def test_recovers_from_corrupt_entry(tmp_path):
+    cache = StageCache(str(tmp_path))
+
+    ## Half written entry, meta.json without its frame
+    entry = cache.entry_dir('means', 'abc')
+    os.makedirs(entry)
+    with open(os.path.join(entry, 'meta.json'), 'w') as f:
+        f.write('{"frames":["hour"], "meta":null}')
+    assert cache.get('means', 'abc') is None
+
+    cache.stage('means', 'abc', lambda: ({'hour':hour_frame()}, None))
+
+    frames, _ = cache.get('means', 'abc')
+    pd.testing.assert_frame_equal(frames['hour'], hour_frame(), check_freq=False)
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = StageCache(str(tmp_path), max_bytes=10**9)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.put('means', key, {'hour':hour_frame()})
+        os.utime(os.path.join(cache.entry_dir('means', key), 'meta.json'), ns=(0, 10**18+i))
+    cache.get('means', 'a')
+
+    size = sum(f.stat().st_size for f in os.scandir(cache.entry_dir('means', 'a')))
+    cache.max_bytes = 2*size
+    cache.evict()
+
+    assert sorted(os.listdir(tmp_path)) == ['means-a', 'means-c']
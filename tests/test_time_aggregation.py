@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from time_aggregation import base_sums, aggregate, aggregate_sums
+
+
+def test_base_sums_counts_non_nan():
+    time_stamp = np.array([0, 60, 900, 960, 1800])
+    sums_df = base_sums(time_stamp, {'pm':np.array([1., np.nan, 2., 4., 8.])})
+
+    assert sums_df.index.tolist() == [0, 900, 1800]
+    assert sums_df['pm_sum'].tolist() == [1., 6., 8.]
+    assert sums_df['pm_count'].tolist() == [1., 2., 1.]
+
+
+def test_base_sums_empty():
+    sums_df = base_sums(np.array([], dtype=np.int64), {'pm':np.array([])})
+
+    assert len(sums_df) == 0
+    assert list(sums_df.columns) == ['pm_sum', 'pm_count']
+
+
+@pytest.mark.parametrize('tz', ['UTC', 'US/Eastern'])
+def test_aggregate_empty_passes_through(tz):
+    resolutions = ('hour', 'day', '15min', '8hour', 'month')
+    aggregated = aggregate(np.array([], dtype=np.int64), {'pm':np.array([])}, tz, resolutions, interval=120.)
+
+    assert list(aggregated) == list(resolutions)
+    for means, counts, expected in aggregated.values():
+        assert len(means) == len(counts) == len(expected) == 0
+        assert list(means.columns) == ['pm']
+        assert str(means.index.tz) == tz
+
+
+def test_aggregate_empty_chunks_combine():
+    empty = base_sums(np.array([], dtype=np.int64), {'pm':np.array([])})
+    full = base_sums(np.arange(0, 7200, 120), {'pm':np.ones(60)})
+
+    sums_df = empty.add(full, fill_value=0).sort_index()
+    means, counts, expected = aggregate_sums(sums_df, ['pm'], resolutions=('hour',))['hour']
+
+    assert counts['pm'].tolist() == [30., 30.]
+    assert expected.tolist() == [30., 30.]
+    assert means['pm'].tolist() == [1., 1.]
+
+
+def two_minute_data(first_day, last_day, tz='US/Eastern'):
+    ''' 2-minute samples covering local days first_day through last_day, value = hour of the UTC day
+    '''
+
+    start = pd.Timestamp(first_day, tz=tz).value//10**9
+    end = (pd.Timestamp(last_day, tz=tz)+pd.DateOffset(days=1)).value//10**9
+    time_stamp = np.arange(start, end, 120)
+
+    return time_stamp, {'pm':(time_stamp//3600 % 24).astype(float)}
+
+
+@pytest.mark.parametrize('day, expected', [('2023-11-05', 750.), ('2023-03-12', 690.), ('2023-07-01', 720.)])
+def test_dst_day_lengths(day, expected):
+    time_stamp, columns = two_minute_data('2023-11-04' if day.startswith('2023-11') else day, day)
+    means, counts, full = aggregate(time_stamp, columns, 'US/Eastern', resolutions=('day',), interval=120.)['day']
+
+    label = pd.Timestamp(day, tz='US/Eastern')
+    i = means.index.get_loc(label)
+    assert full[i] == expected
+    assert counts['pm'].iloc[i] == expected
+    assert str(means.index.tz) == 'US/Eastern'
+
+
+def test_fall_back_hour_labels():
+    time_stamp, columns = two_minute_data('2023-11-05', '2023-11-05')
+    means, counts, full = aggregate(time_stamp, columns, 'US/Eastern', resolutions=('hour',), interval=120.)['hour']
+
+    ## 01:00 happens twice, first in EDT then in EST, each a full 30 sample hour
+    labels = [label.isoformat() for label in means.index[:4]]
+    assert labels == ['2023-11-05T00:00:00-04:00', '2023-11-05T01:00:00-04:00',
+                      '2023-11-05T01:00:00-05:00', '2023-11-05T02:00:00-05:00']
+    assert means['pm'].iloc[:4].tolist() == [4., 5., 6., 7.]
+    assert counts['pm'].iloc[:4].tolist() == [30.]*4
+    assert len(means) == 25 and (full == 30.).all()
+
+
+def test_spring_forward_hour_labels():
+    time_stamp, columns = two_minute_data('2023-03-12', '2023-03-12')
+    means, _, _ = aggregate(time_stamp, columns, 'US/Eastern', resolutions=('hour',), interval=120.)['hour']
+
+    ## 02:00 does not exist, 01:00 EST is followed by 03:00 EDT
+    labels = [label.isoformat() for label in means.index[:3]]
+    assert labels == ['2023-03-12T00:00:00-05:00', '2023-03-12T01:00:00-05:00', '2023-03-12T03:00:00-04:00']
+    assert means['pm'].iloc[:3].tolist() == [5., 6., 7.]
+    assert len(means) == 23
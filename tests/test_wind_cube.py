@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from wind_cube import WindCube, direction_sectors
+from create_windrose import SEASON_MONTHS
+from pollution_rose import concentration_cube
+
+
+def records(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    tme = pd.Timestamp('2020-01-01')+pd.to_timedelta(rng.integers(0, 3*365*24, n), unit='h')
+    return tme, rng.uniform(0., 360., n), rng.uniform(0., 12., n)
+
+
+def direct_table(windd, winds, bins, n_sectors=16):
+    ''' Sector x speed bin counts straight from the records
+    '''
+
+    sector = direction_sectors(windd, n_sectors)
+    speed_bin = np.searchsorted(bins, winds, side='right')-1
+    keep = speed_bin >= 0
+
+    table = np.zeros((n_sectors, len(bins)), dtype=int)
+    np.add.at(table, (sector[keep], speed_bin[keep]), 1)
+
+    return table
+
+
+def test_select_matches_direct_binning():
+    tme, windd, winds = records()
+    cube = WindCube.from_records(tme, windd, winds)
+    bins = np.arange(1, 5, .5)
+
+    fall = np.isin(tme.month, SEASON_MONTHS['fall']) & (tme.year >= 2021)
+    table, edges = cube.select(years=[2021, 2022], months=SEASON_MONTHS['fall'], bins=bins)
+
+    np.testing.assert_array_equal(edges, bins)
+    np.testing.assert_array_equal(table, direct_table(windd[fall], winds[fall], bins))
+
+    afternoon = (tme.hour >= 12) & (tme.hour < 18)
+    table, _ = cube.select(hours=range(12, 18), bins=bins)
+    np.testing.assert_array_equal(table, direct_table(windd[afternoon], winds[afternoon], bins))
+
+
+def test_save_load_round_trip(tmp_path):
+    cube = WindCube.from_records(*records())
+    cube.save(tmp_path/'cube.npz')
+
+    loaded = WindCube.load(tmp_path/'cube.npz')
+
+    np.testing.assert_array_equal(loaded.counts, cube.counts)
+    np.testing.assert_array_equal(loaded.years, cube.years)
+
+
+def test_concentration_cube_matches_direct_binning():
+    tme, windd, pm25 = records()
+    pm25 = pm25*10.-5.
+    joined = pd.DataFrame({'sensor':'ECA_1', 'time':tme, 'windd':windd, 'pm25':pm25})
+    conc_bins = (0, 9, 35.5, 55.5)
+
+    table, edges = concentration_cube(joined, 'ECA_1', conc_bins).select()
+
+    ## Negative concentrations fall below the first edge and are left out
+    np.testing.assert_array_equal(edges, conc_bins)
+    np.testing.assert_array_equal(table, direct_table(windd, pm25, conc_bins))
+    assert table.sum() == (pm25 >= 0).sum()
+
+
+def test_empty_records():
+    cube = WindCube.from_records(pd.DatetimeIndex([]), np.array([]), np.array([]))
+
+    table, _ = cube.select(bins=[0, 2])
+
+    assert table.shape == (16, 2) and table.sum() == 0
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+
+## Width of the base buckets every resolution is built from, divides all of the fixed
+## resolutions and whole hour UTC offsets
+BASE_SECONDS = 900
+
+## Fixed width resolutions in seconds, day and month follow local calendar boundaries
+FIXED_RESOLUTIONS = {'15min':900, 'hour':3600}
+CALENDAR_RESOLUTIONS = {'day':'D', 'month':'MS'}
+
+## Rolling windows built from hourly sums, in hours
+ROLLING_RESOLUTIONS = {'8hour':8}
+
+
+def base_sums(time_stamp, columns, base_seconds=BASE_SECONDS):
+    ''' Sum and count of non-NaN values per base bucket, one bincount pass per column
+            time_stamp is Unix seconds, columns a dictionary of name -> array.
+            Returns a dataframe indexed by bucket start (Unix seconds) with {name}_sum and
+            {name}_count columns, chunks of data can be combined with DataFrame.add. No rows give
+            an empty dataframe with the same columns
+    '''
+
+    time_stamp = np.asarray(time_stamp, dtype=np.int64)
+
+    ## Nothing passed QC, an empty table with the same columns
+    if len(time_stamp) == 0:
+        empty = np.empty(0)
+        sums = {f'{name}_{kind}':empty for name in columns for kind in ['sum', 'count']}
+        return pd.DataFrame(sums, index=np.empty(0, dtype=np.int64))
+
+    start = time_stamp.min()//base_seconds*base_seconds
+    bucket = (time_stamp-start)//base_seconds
+    n_buckets = bucket.max()+1
+
+    sums = {}
+    for name, values in columns.items():
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        sums[f'{name}_sum'] = np.bincount(bucket, weights=np.where(valid, values, 0.), minlength=n_buckets)
+        sums[f'{name}_count'] = np.bincount(bucket, weights=valid, minlength=n_buckets)
+
+    sums_df = pd.DataFrame(sums, index=start+np.arange(n_buckets)*base_seconds)
+
+    ## Only keep buckets with data so chunks stay small
+    return sums_df[np.bincount(bucket, minlength=n_buckets) != 0]
+
+
+def resolution_edges(resolution, first, last, tz):
+    ''' Bucket edges (Unix seconds) from the bucket holding first through the end of the one holding last
+            Built once per date range so the rows never need a local time column. Day and month
+            edges are local midnights so DST days are 23 or 25 hours long
+    '''
+
+    if resolution in FIXED_RESOLUTIONS:
+        width = FIXED_RESOLUTIONS[resolution]
+        return np.arange(first//width*width, last//width*width+2*width, width)
+
+    ## Local wall clock range, one day or month past the last time gives the closing edge
+    local_first = pd.Timestamp(first, unit='s', tz='UTC').tz_convert(tz).tz_localize(None).normalize()
+    local_last = pd.Timestamp(last, unit='s', tz='UTC').tz_convert(tz).tz_localize(None)
+    if resolution == 'day':
+        local_end = local_last+pd.DateOffset(days=1)
+    else:
+        local_first = local_first.replace(day=1)
+        local_end = local_last+pd.DateOffset(months=1)
+
+    edges = pd.date_range(local_first, local_end, freq=CALENDAR_RESOLUTIONS[resolution])
+    edges = edges.tz_localize(tz, nonexistent='shift_forward')
+
+    return edges.asi8//10**9
+
+
+def sampling_interval(time_stamp):
+    ''' Typical seconds between samples, the median spacing of the unique times
+    '''
+
+    steps = np.diff(np.unique(np.asarray(time_stamp, dtype=np.int64)))
+
+    return float(np.median(steps)) if len(steps) != 0 else np.nan
+
+
+def resample_sums(sums_df, names, resolution, tz):
+    ''' Regroup base bucket sums and counts into one fixed or calendar resolution
+            Returns the local bucket labels, sums, counts and the length of each bucket in seconds
+    '''
+
+    base_start = sums_df.index.to_numpy()
+
+    ## No buckets in, no buckets out
+    if len(base_start) == 0:
+        empty = np.empty(0)
+        return pd.DatetimeIndex([], tz=tz), {name:empty for name in names}, {name:empty for name in names}, empty
+
+    edges = resolution_edges(resolution, base_start.min(), base_start.max(), tz)
+    starts, seconds = edges[:-1], np.diff(edges)
+    group = np.searchsorted(starts, base_start, side='right')-1
+
+    sums = {name:np.bincount(group, weights=sums_df[f'{name}_sum'].to_numpy(), minlength=len(starts))
+            for name in names}
+    counts = {name:np.bincount(group, weights=sums_df[f'{name}_count'].to_numpy(), minlength=len(starts))
+              for name in names}
+
+    ## Only the output buckets get local timestamps
+    labels = pd.to_datetime(starts, unit='s', utc=True).tz_convert(tz)
+
+    return labels, sums, counts, seconds
+
+
+def aggregate_sums(sums_df, names, tz='UTC', resolutions=('hour', 'day'), interval=120.):
+    ''' Means, counts and expected counts per resolution from base bucket sums
+            Works on the small base table, so extra resolutions cost no pass over the raw data.
+            Returns a dictionary of resolution -> (means, counts, expected) where means and counts
+            are dataframes indexed by local bucket start and expected is the number of samples a
+            full bucket holds at the sampling interval (seconds)
+    '''
+
+    aggregated = {}
+    for resolution in resolutions:
+        if resolution in ROLLING_RESOLUTIONS:
+            ## Rolling windows from the hourly sums, labelled by the first hour of the window
+            hours = ROLLING_RESOLUTIONS[resolution]
+            labels, sums, counts, seconds = resample_sums(sums_df, names, 'hour', tz)
+            sums = {name:rolling_sum(values, hours) for name, values in sums.items()}
+            counts = {name:rolling_sum(values, hours) for name, values in counts.items()}
+            seconds = rolling_sum(seconds, hours)
+        else:
+            labels, sums, counts, seconds = resample_sums(sums_df, names, resolution, tz)
+
+        aggregated[resolution] = bucket_frames(sums, counts, labels, seconds/interval)
+
+    return aggregated
+
+
+def rolling_sum(values, window):
+    ''' Forward looking rolling sum from a cumulative sum, NaN where the window runs off the end
+    '''
+
+    cum = np.concatenate([[0.], np.cumsum(values)])
+    out = np.full(len(values), np.nan)
+    out[:len(values)-window+1] = cum[window:]-cum[:len(values)-window+1]
+
+    return out
+
+
+def bucket_frames(sums, counts, labels, expected):
+    ''' Turn per bucket sum and count arrays into means and counts dataframes
+    '''
+
+    counts = pd.DataFrame(counts, index=labels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = pd.DataFrame(sums, index=labels)/counts.where(counts != 0)
+
+    return means, counts, np.asarray(expected, dtype=float)
+
+
+def aggregate(time_stamp, columns, tz='UTC', resolutions=('hour', 'day'), interval=None):
+    ''' Sum, count and mean of the columns at several resolutions from one pass over the rows
+            interval defaults to the median sampling interval of time_stamp
+    '''
+
+    if interval is None:
+        interval = sampling_interval(time_stamp)
+
+    sums_df = base_sums(time_stamp, columns)
+
+    return aggregate_sums(sums_df, list(columns), tz, resolutions, interval)
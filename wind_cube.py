@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+
+## Fine speed bins (m/s) the cube is built with, coarser rose bins are summed from these
+SPEED_EDGES = np.arange(0., 30.5, 0.5)
+
+
+def direction_sectors(windd, n_sectors=16):
+    ''' Sector index of each direction, sector 0 is centred on north like WindroseAxes
+    '''
+
+    width = 360./n_sectors
+
+    return (((np.asarray(windd)+width/2.) % 360.)//width).astype(int)
+
+
+class WindCube():
+    ''' Wind observation counts by direction sector x speed bin x year x month x hour of day
+            Built once from the met archive, any time slice and coarser speed bins are sums over it
+    '''
+    def __init__(self, counts, years, speed_edges=SPEED_EDGES):
+        self.counts = counts
+        self.years = np.asarray(years)
+        self.speed_edges = np.asarray(speed_edges)
+        self.n_sectors = counts.shape[0]
+
+
+    @classmethod
+    def from_records(cls, tme, windd, winds, n_sectors=16, speed_edges=SPEED_EDGES):
+        ''' Build the cube from the output of get_windy_withit in one bincount pass
+                Speeds past the last edge go in the last bin, speeds below the first edge are left out
+        '''
+
+        tme = pd.DatetimeIndex(tme)
+        years = np.arange(tme.year.min(), tme.year.max()+1) if len(tme) else np.array([], dtype=int)
+
+        sector = direction_sectors(windd, n_sectors)
+        speed = np.minimum(np.searchsorted(speed_edges, winds, side='right')-1, len(speed_edges)-1)
+        keep = speed >= 0
+        tme, sector, speed = tme[keep], sector[keep], speed[keep]
+        shape = (n_sectors, len(speed_edges), len(years), 12, 24)
+
+        year = np.searchsorted(years, tme.year.to_numpy())
+        flat = np.ravel_multi_index((sector, speed, year, tme.month.to_numpy()-1, tme.hour.to_numpy()), shape)
+        counts = np.bincount(flat, minlength=np.prod(shape)).reshape(shape)
+
+        return cls(counts, years, speed_edges)
+
+
+    @classmethod
+    def from_files(cls, file_list, sigma_thresh=2, n_sectors=16, speed_edges=SPEED_EDGES):
+        ''' Parse ISD/ASOS files with get_windy_withit and build the cube
+        '''
+
+        ## create_windrose plots from the cube, import here to keep the modules acyclic
+        from create_windrose import get_windy_withit
+
+        tme, windd, winds = get_windy_withit(file_list, sigma_thresh=sigma_thresh)
+
+        return cls.from_records(tme, windd, winds, n_sectors, speed_edges)
+
+
+    def save(self, fn):
+        ''' Save the cube as a compressed npz file
+        '''
+
+        np.savez_compressed(fn, counts=self.counts, years=self.years, speed_edges=self.speed_edges)
+
+
+    @classmethod
+    def load(cls, fn):
+        ''' Load a cube saved with save
+        '''
+
+        with np.load(fn) as cube:
+            return cls(cube['counts'], cube['years'], cube['speed_edges'])
+
+
+    def select(self, years=None, months=None, hours=None, bins=None):
+        ''' Sector x speed bin counts for a time slice
+                years, months (1-12) and hours (0-23) are lists, None keeps everything.
+                bins are speed bin lower edges like WindroseAxes.bar, each is snapped to the
+                nearest cube edge at or below it. Returns the table and the edges used
+        '''
+
+        counts = self.counts
+        if years is not None:
+            counts = counts[:, :, np.isin(self.years, years)]
+        if months is not None:
+            counts = counts[:, :, :, np.asarray(months)-1]
+        if hours is not None:
+            counts = counts[:, :, :, :, np.asarray(hours)]
+
+        table = counts.sum(axis=(2, 3, 4))
+
+        if bins is None:
+            return table, self.speed_edges
+
+        ## Sum the fine bins from each edge to the next, the last bin is open ended and
+        ## speeds below the first edge are left out, as WindroseAxes.bar does
+        starts = np.clip(np.searchsorted(self.speed_edges, bins, side='right')-1, 0, None)
+        table = np.add.reduceat(table, starts, axis=1)
+
+        return table, self.speed_edges[starts]
+
+
+def plot_rose_table(table, edges, title, normed=True, units='m/s', opening=0.8, cmap='viridis'):
+    ''' Plot a sector x bin table as stacked wind rose bars, north up and clockwise
+    '''
+
+    n_sectors, n_bins = table.shape
+    if normed:
+        table = table*100./table.sum()
+
+    width = 2*np.pi/n_sectors
+    theta = np.arange(n_sectors)*width
+    colors = plt.get_cmap(cmap)(np.linspace(0, 1, n_bins))
+
+    fig, ax = plt.subplots(subplot_kw={'projection':'polar'}, figsize=(8, 8))
+    ax.set_theta_zero_location('N')
+    ax.set_theta_direction(-1)
+
+    bottom = np.zeros(n_sectors)
+    for j in range(n_bins):
+        label = f'[{edges[j]} : {edges[j+1]})' if j+1 < n_bins else f'[{edges[j]} : inf)'
+        ax.bar(theta, table[:, j], width=width*opening, bottom=bottom, color=colors[j],
+               edgecolor='white', label=label)
+        bottom = bottom+table[:, j]
+
+    ax.legend(title=units, loc='lower left', bbox_to_anchor=(1.0, 0.0))
+    ax.set_title(title, fontsize=20.)
+
+    return ax
+
+
+if __name__ == '__main__':
+
+    file_path = r'/Users/shaunhowe/Documents/research/eckington_aq/data/met/dca_asos/*.csv'
+    cube_fn = r'/Users/shaunhowe/Documents/research/eckington_aq/data/met/dca_asos_cube.npz'
+
+    cube = WindCube.from_files(glob.glob(file_path))
+    cube.save(cube_fn)
+
+    cube = WindCube.load(cube_fn)
+    bins = np.arange(1,5,.5)
+
+    ## Fall rose and a summer afternoon rose from the same cube
+    table, edges = cube.select(months=[9, 10, 11], bins=bins)
+    plot_rose_table(table, edges, 'Reagan National Airport Wind Rose \n Fall - 2007 to 2022')
+
+    table, edges = cube.select(months=[6, 7, 8], hours=range(12, 18), bins=bins)
+    plot_rose_table(table, edges, 'Reagan National Airport Wind Rose \n Summer Afternoons')
+    plt.show()